@@ -0,0 +1,140 @@
+from __future__ import absolute_import, unicode_literals, print_function, division
+
+from collections import OrderedDict
+
+from django.db.models import F, Count, Sum, Avg, Min, Max, FloatField
+from django.db.models.expressions import RawSQL
+from django.db.models.functions import Trunc
+from django.utils import timezone
+
+from main.api.filters import DATA_FILTER_PREFIX
+
+# group by keys on the record columns
+GROUP_BY_COLUMNS = OrderedDict([
+    ('species_name', 'species_name'),
+    ('name_id', 'name_id'),
+    ('site', 'site'),
+    ('dataset', 'dataset'),
+])
+# the record datetime truncated to: datetime__day, datetime__month or datetime__year (in the TIME_ZONE setting)
+DATETIME_GROUP_BY_PREFIX = 'datetime__'
+DATETIME_TRUNC_KINDS = ['day', 'month', 'year']
+
+METRICS = OrderedDict([
+    ('sum', Sum),
+    ('avg', Avg),
+    ('min', Min),
+    ('max', Max),
+])
+NUMERIC_TYPES = ['integer', 'number']
+
+
+def parse_list(value):
+    """
+    'a, b,c' -> ['a', 'b', 'c']
+    """
+    return [v.strip() for v in (value or '').split(',') if v.strip()]
+
+
+def get_aggregation_params(query_params):
+    """
+    :return: the kwargs of aggregate_records from the query parameters group_by=key1,key2 and
+    <metric>=field1,field2 (sum, avg, min, max)
+    """
+    return {
+        'group_by': parse_list(query_params.get('group_by')),
+        'metrics': OrderedDict((name, parse_list(query_params.get(name))) for name in METRICS
+                               if query_params.get(name)),
+    }
+
+
+def _data_expression(queryset, template, field_name, output_field=None):
+    column = '"{table}"."data" ->> %s'.format(table=queryset.model._meta.db_table)
+    return RawSQL(template.format(column), (field_name,), output_field=output_field)
+
+
+def _get_schema_field(dataset, field_name, param):
+    if dataset is None:
+        raise ValueError("The aggregation on the data field '{}' requires a dataset. "
+                         "Use the dataset__id filter.".format(field_name))
+    field = dataset.schema.get_field_by_name(field_name)
+    if field is None:
+        raise ValueError("{param}: the field '{field}' is not in the dataset schema. The fields are: {fields}".format(
+            param=param, field=field_name, fields=dataset.schema.field_names))
+    return field
+
+
+def _group_by_expression(queryset, dataset, key):
+    if key in GROUP_BY_COLUMNS:
+        return F(GROUP_BY_COLUMNS[key])
+    if key.startswith(DATETIME_GROUP_BY_PREFIX):
+        kind = key[len(DATETIME_GROUP_BY_PREFIX):]
+        if kind not in DATETIME_TRUNC_KINDS:
+            raise ValueError("group_by: the datetime can be truncated to {}".format(DATETIME_TRUNC_KINDS))
+        # truncated in the current time zone. Converted to a date in aggregate_records.
+        return Trunc('datetime', kind)
+    if key.startswith(DATA_FILTER_PREFIX):
+        field_name = key[len(DATA_FILTER_PREFIX):]
+        _get_schema_field(dataset, field_name, 'group_by')
+        return _data_expression(queryset, '{}', field_name)
+    raise ValueError("group_by: unknown key '{key}'. Should be one of {columns}, {datetime}<{kinds}> or "
+                     "{data}<field>".format(key=key, columns=list(GROUP_BY_COLUMNS.keys()),
+                                            datetime=DATETIME_GROUP_BY_PREFIX, kinds='|'.join(DATETIME_TRUNC_KINDS),
+                                            data=DATA_FILTER_PREFIX))
+
+
+def aggregate_records(queryset, dataset=None, group_by=None, metrics=None):
+    """
+    Count the records by group and compute metrics on numeric data fields, in one SQL GROUP BY query.
+    All the filters of the queryset apply.
+    :param dataset: the dataset of the records. Required to group by or compute metrics on data fields.
+    :param group_by: list of keys: species_name, name_id, site, dataset, datetime__day|month|year or data.<field>
+    :param metrics: dict {metric: [field names]} with metric in sum, avg, min or max. The fields must be numeric
+    fields of the dataset schema. The values that are not numbers are ignored (see biosys_to_numeric).
+    :return: a list of OrderedDict {<group by key>: value, ..., 'count': int, '<metric>.<field>': float}, ordered by
+    group. Will throw a ValueError if a parameter is invalid.
+    """
+    group_by = group_by or []
+    metrics = metrics or {}
+    group_aliases = OrderedDict()
+    annotations = {}
+    for index, key in enumerate(group_by):
+        alias = 'group_{}'.format(index)
+        group_aliases[alias] = key
+        annotations[alias] = _group_by_expression(queryset, dataset, key)
+
+    metric_aliases = OrderedDict()
+    metric_annotations = {'count': Count('id')}
+    for name, field_names in metrics.items():
+        if name not in METRICS:
+            raise ValueError("Unknown metric '{}'. Should be one of {}".format(name, list(METRICS.keys())))
+        for field_name in field_names:
+            field = _get_schema_field(dataset, field_name, name)
+            if field.type not in NUMERIC_TYPES:
+                raise ValueError("{}: the field '{}' is not numeric".format(name, field_name))
+            alias = 'metric_{}'.format(len(metric_aliases))
+            metric_aliases[alias] = '{}.{}'.format(name, field_name)
+            metric_annotations[alias] = METRICS[name](
+                _data_expression(queryset, 'biosys_to_numeric({})', field_name, output_field=FloatField()),
+                output_field=FloatField())
+
+    # the ordering of the queryset would be added to the GROUP BY
+    queryset = queryset.order_by()
+    if group_aliases:
+        rows = queryset.annotate(**annotations).values(*group_aliases.keys()) \
+            .annotate(**metric_annotations).order_by(*group_aliases.keys())
+    else:
+        rows = [queryset.aggregate(**metric_annotations)]
+    result = []
+    for row in rows:
+        group = OrderedDict()
+        for alias, key in group_aliases.items():
+            value = row[alias]
+            if key.startswith(DATETIME_GROUP_BY_PREFIX) and value is not None:
+                value = timezone.localtime(value).date()
+            group[key] = value
+        group['count'] = row['count']
+        for alias, key in metric_aliases.items():
+            group[key] = row[alias]
+        result.append(group)
+    return result
@@ -0,0 +1,74 @@
+from __future__ import absolute_import, unicode_literals, print_function, division
+
+import json
+
+from django.db import connection, transaction
+from django.utils import timezone
+
+from main.api.reprocessors import RecordReprocessor
+
+
+class CurationError(Exception):
+    def __init__(self, errors):
+        super(CurationError, self).__init__('Some records would not be valid')
+        self.errors = errors
+
+
+def validate_data_patch(dataset, data):
+    """
+    Validate only the patched keys of the records data against the dataset schema.
+    :return: the patch with the numeric fields cast to numbers (like the upload). Will throw a ValueError with a dict
+    {field: message} if a key is not in the schema or its value is not valid.
+    """
+    schema = dataset.schema
+    errors = {}
+    for field_name, value in data.items():
+        try:
+            message = schema.field_validation_error(field_name, value)
+        except Exception as e:
+            message = str(e)
+        if message:
+            errors[field_name] = message
+    if errors:
+        raise ValueError(errors)
+    return schema.cast_numbers(dict(data))
+
+
+def curate_records(dataset, queryset, validated=None, locked=None, data=None, species_facade_class=None):
+    """
+    Set the curation flags and/or patch some keys of the data of all the records of the queryset with one UPDATE.
+    The data keys are merged in the data (jsonb ||): the other keys are not touched. If a patched key is a source of
+    the derived fields (date, geometry, site or species columns), the derived fields of the updated records are
+    recomputed (see RecordReprocessor). If a record would not be valid anymore nothing is changed and a CurationError
+    is raised.
+    :param data: a patch validated with validate_data_patch
+    :return: a dict {'updated': number of records, 'reprocessed': number of records with changed derived fields}
+    """
+    table = connection.ops.quote_name(queryset.model._meta.db_table)
+    sets, params = [], []
+    if data:
+        sets.append('"data" = "data" || %s::jsonb')
+        params.append(json.dumps(data))
+    for column, value in [('validated', validated), ('locked', locked)]:
+        if value is not None:
+            sets.append('"{}" = %s'.format(column))
+            params.append(bool(value))
+    if not sets:
+        return {'updated': 0, 'reprocessed': 0}
+    sets.append('"last_modified" = %s')
+    params.append(timezone.now())
+    select_sql, select_params = queryset.order_by().values('pk').query.sql_with_params()
+    sql = 'UPDATE {table} SET {sets} WHERE "id" IN ({select}) RETURNING "id"'.format(
+        table=table, sets=', '.join(sets), select=select_sql)
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params + list(select_params))
+            record_ids = [row[0] for row in cursor.fetchall()]
+        reprocessed = 0
+        if data and record_ids and RecordReprocessor.source_field_names(dataset) & set(data.keys()):
+            result = RecordReprocessor(dataset, record_ids=record_ids, species_facade_class=species_facade_class).run()
+            if result['error_count']:
+                # rollback
+                raise CurationError(result['errors'])
+            reprocessed = result['updated']
+    return {'updated': len(record_ids), 'reprocessed': reprocessed}
@@ -0,0 +1,322 @@
+from __future__ import absolute_import, unicode_literals, print_function, division
+
+import logging
+import threading
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db import connection, transaction
+from django.utils import timezone
+
+from main.models import Project, Site, Dataset, Record, Media, DatasetMedia, ProjectMedia, ExportJob, DeletionJob, \
+    PendingFileDeletion
+from main.utils_geo import invalidate_tiles
+
+logger = logging.getLogger(__name__)
+
+DELETION_RUNNER_THREAD = 'thread'
+DELETION_RUNNER_WORKER = 'worker'
+DELETION_RUNNER_SYNC = 'sync'
+
+# a file that still can't be deleted after that many attempts stays in the queue with its error.
+MAX_FILE_DELETION_ATTEMPTS = 5
+
+
+class DeletionCancelled(Exception):
+    pass
+
+
+def _table(model):
+    return connection.ops.quote_name(model._meta.db_table)
+
+
+def _column(model, field_name):
+    return connection.ops.quote_name(model._meta.get_field(field_name).column)
+
+
+class BulkDeleter(object):
+    """
+    Delete records, sites, datasets and projects at the SQL level, in batches.
+    QuerySet.delete() loads every object in memory to run the cascade to the media and the SET NULL of the records
+    site. Here the dependent rows are deleted (or nulled) with one statement per batch and the media files are queued
+    (see PendingFileDeletion) to be deleted from the storage by the sweeper.
+    Every batch is committed in its own transaction (a savepoint if called in a transaction).
+    :param on_batch: optional callable called with the deleter after every batch. It can raise DeletionCancelled to
+    stop the delete.
+    """
+
+    def __init__(self, batch_size=None, on_batch=None):
+        self.batch_size = batch_size or settings.BULK_DELETE_BATCH_SIZE
+        self.on_batch = on_batch
+        self.deleted_records = 0
+        self.deleted_sites = 0
+        self.queued_files = 0
+
+    def _batches(self, queryset):
+        """
+        The pk of the queryset, batch_size at a time. Every batch must be deleted before asking for the next one.
+        """
+        queryset = queryset.order_by()
+        while True:
+            ids = list(queryset.values_list('pk', flat=True)[:self.batch_size])
+            if not ids:
+                return
+            yield ids
+
+    def _batch_done(self):
+        if self.on_batch is not None:
+            self.on_batch(self)
+
+    def _queue_files(self, cursor, model, field_name, ids):
+        """
+        Queue the files of the model rows where field_name is in ids. A file shared by several rows (export jobs) is
+        queued once.
+        """
+        cursor.execute(
+            'INSERT INTO {queue} ({name}, {attempts}, {created}) '
+            'SELECT DISTINCT {file}, 0, now() FROM {table} '
+            'WHERE {field} = ANY(%s) AND {file} IS NOT NULL AND {file} <> %s'.format(
+                queue=_table(PendingFileDeletion),
+                name=_column(PendingFileDeletion, 'name'),
+                attempts=_column(PendingFileDeletion, 'attempts'),
+                created=_column(PendingFileDeletion, 'created'),
+                file=_column(model, 'file'),
+                table=_table(model),
+                field=_column(model, field_name)),
+            [list(ids), ''])
+        self.queued_files += max(cursor.rowcount, 0)
+
+    def delete_records(self, queryset):
+        """
+        :param queryset: a Record queryset
+        :return: the number of deleted records
+        """
+        count = 0
+        for ids in self._batches(queryset):
+            with transaction.atomic(), connection.cursor() as cursor:
+                self._queue_files(cursor, Media, 'record', ids)
+                cursor.execute('DELETE FROM {} WHERE {} = ANY(%s)'.format(
+                    _table(Media), _column(Media, 'record')), [ids])
+                cursor.execute('DELETE FROM {} WHERE {} = ANY(%s)'.format(
+                    _table(Record), _column(Record, 'id')), [ids])
+                count += cursor.rowcount
+                self.deleted_records += cursor.rowcount
+            self._batch_done()
+        return count
+
+    def delete_sites(self, queryset):
+        """
+        The records of the sites are kept, their site is set to null.
+        :param queryset: a Site queryset
+        :return: the number of deleted sites
+        """
+        count = 0
+        for ids in self._batches(queryset):
+            with transaction.atomic(), connection.cursor() as cursor:
+                cursor.execute('UPDATE {table} SET {site} = NULL WHERE {site} = ANY(%s)'.format(
+                    table=_table(Record), site=_column(Record, 'site')), [ids])
+                cursor.execute('DELETE FROM {} WHERE {} = ANY(%s)'.format(
+                    _table(Site), _column(Site, 'id')), [ids])
+                count += cursor.rowcount
+                self.deleted_sites += cursor.rowcount
+            self._batch_done()
+        return count
+
+    def delete_dataset(self, dataset):
+        self.delete_records(dataset.record_queryset)
+        with transaction.atomic(), connection.cursor() as cursor:
+            self._queue_files(cursor, DatasetMedia, 'dataset', [dataset.pk])
+            self._queue_files(cursor, ExportJob, 'dataset', [dataset.pk])
+            # the partial indexes of the dataset primary key (upsert), dropped after the commit.
+            dataset.drop_primary_key_indexes()
+            # the records are gone: nothing big left to collect for the cascade.
+            dataset.delete()
+
+    def delete_project(self, project):
+        for dataset in Dataset.objects.filter(project=project):
+            self.delete_dataset(dataset)
+        self.delete_sites(Site.objects.filter(project=project))
+        with transaction.atomic(), connection.cursor() as cursor:
+            self._queue_files(cursor, ProjectMedia, 'project', [project.pk])
+            project.delete()
+
+
+def bulk_delete(target, object_id, ids=None, deleter=None):
+    """
+    Delete the records or sites (all of them if ids is None), the dataset or the project.
+    :param target: one of the DeletionJob targets
+    :param object_id: the dataset pk for the records and dataset targets, the project pk for the sites and project
+    targets
+    :return: the deleter
+    """
+    deleter = deleter or BulkDeleter()
+    if target in [DeletionJob.TARGET_RECORDS, DeletionJob.TARGET_DATASET]:
+        dataset = Dataset.objects.filter(pk=object_id).first()
+        if dataset is None:
+            return deleter
+        if target == DeletionJob.TARGET_RECORDS:
+            queryset = dataset.record_queryset
+            if ids is not None:
+                queryset = queryset.filter(pk__in=ids)
+            deleter.delete_records(queryset)
+            dataset.mark_extent_stale()
+        else:
+            deleter.delete_dataset(dataset)
+            invalidate_tiles(dataset.project_id)
+    elif target == DeletionJob.TARGET_SITES:
+        queryset = Site.objects.filter(project_id=object_id)
+        if ids is not None:
+            queryset = queryset.filter(pk__in=ids)
+        deleter.delete_sites(queryset)
+        invalidate_tiles(object_id)
+    elif target == DeletionJob.TARGET_PROJECT:
+        project = Project.objects.filter(pk=object_id).first()
+        if project is not None:
+            deleter.delete_project(project)
+            invalidate_tiles(object_id)
+    if deleter.queued_files:
+        start_file_sweep()
+    return deleter
+
+
+def use_deletion_job(count):
+    """
+    :param count: the number of records affected by the delete
+    :return: True if the delete should run in a background job
+    """
+    threshold = settings.BULK_DELETE_JOB_THRESHOLD
+    return threshold is not None and count > threshold
+
+
+def request_deletion(target, obj, ids=None, total=None, user=None):
+    """
+    Create and start a deletion job.
+    """
+    job = DeletionJob.objects.create(
+        target=target,
+        object_id=obj.pk,
+        ids=ids,
+        total=total,
+        user=user if user and user.is_authenticated else None
+    )
+    _start(_run_pending_job, job.pk)
+    return job
+
+
+def cancel_deletion_job(job):
+    """
+    A pending job won't run. A running job stops after its current batch.
+    :return: True if the job was cancelled (False if already finished)
+    """
+    return DeletionJob.objects.filter(
+        pk=job.pk,
+        status__in=[DeletionJob.STATUS_PENDING, DeletionJob.STATUS_RUNNING]
+    ).update(status=DeletionJob.STATUS_CANCELLED, completed=timezone.now()) > 0
+
+
+def run_deletion_job(job):
+    job.status = DeletionJob.STATUS_RUNNING
+    job.started = timezone.now()
+    job.save()
+
+    def on_batch(deleter):
+        # report the progress and check for a cancel between the batches
+        deleted = deleter.deleted_sites if job.target == DeletionJob.TARGET_SITES else deleter.deleted_records
+        updated = DeletionJob.objects.filter(pk=job.pk).exclude(status=DeletionJob.STATUS_CANCELLED) \
+            .update(deleted=deleted)
+        if not updated:
+            raise DeletionCancelled()
+
+    deleter = BulkDeleter(on_batch=on_batch)
+    try:
+        bulk_delete(job.target, job.object_id, ids=job.ids, deleter=deleter)
+        job.status = DeletionJob.STATUS_DONE
+    except DeletionCancelled:
+        job.status = DeletionJob.STATUS_CANCELLED
+    except Exception as e:
+        logger.exception("Error while running the deletion job {}".format(job.pk))
+        job.status = DeletionJob.STATUS_FAILED
+        job.error = str(e)
+    job.deleted = deleter.deleted_sites if job.target == DeletionJob.TARGET_SITES else deleter.deleted_records
+    job.completed = timezone.now()
+    job.save()
+    return job
+
+
+def run_pending_deletion_jobs():
+    """
+    Run all the pending jobs. Used by the run_deletion_jobs command.
+    Jobs are claimed one at a time with a row lock so several workers can run concurrently.
+    :return: the number of jobs run
+    """
+    count = 0
+    while True:
+        with transaction.atomic():
+            job = DeletionJob.objects.select_for_update(skip_locked=True) \
+                .filter(status=DeletionJob.STATUS_PENDING).order_by('created').first()
+            if job is None:
+                return count
+            job.status = DeletionJob.STATUS_RUNNING
+            job.save()
+        run_deletion_job(job)
+        count += 1
+
+
+def sweep_pending_files(batch_size=100):
+    """
+    Delete the queued files from the default storage.
+    The files are claimed with a row lock so several sweepers can run concurrently.
+    :return: the number of deleted files
+    """
+    count = 0
+    while True:
+        with transaction.atomic():
+            pending = list(PendingFileDeletion.objects.select_for_update(skip_locked=True)
+                           .filter(attempts__lt=MAX_FILE_DELETION_ATTEMPTS)[:batch_size])
+            if not pending:
+                return count
+            deleted = []
+            for pending_file in pending:
+                try:
+                    default_storage.delete(pending_file.name)
+                    deleted.append(pending_file.pk)
+                except Exception as e:
+                    logger.warning("Error while deleting the file {}: {}".format(pending_file.name, e))
+                    pending_file.attempts += 1
+                    pending_file.error = str(e)
+                    pending_file.save()
+            PendingFileDeletion.objects.filter(pk__in=deleted).delete()
+            count += len(deleted)
+
+
+def start_file_sweep():
+    _start(sweep_pending_files)
+
+
+def _run_pending_job(job_pk):
+    job = DeletionJob.objects.filter(pk=job_pk, status=DeletionJob.STATUS_PENDING).first()
+    if job is not None:
+        run_deletion_job(job)
+
+
+def _start(func, *args):
+    """
+    Run func(*args) according to the DELETION_JOB_RUNNER setting.
+    With the 'worker' runner nothing is done here: the run_deletion_jobs command picks up the pending jobs and sweeps
+    the files.
+    """
+    runner = getattr(settings, 'DELETION_JOB_RUNNER', DELETION_RUNNER_THREAD)
+    if runner == DELETION_RUNNER_SYNC:
+        func(*args)
+    elif runner == DELETION_RUNNER_THREAD:
+        thread = threading.Thread(target=_run_in_thread, args=(func,) + args)
+        thread.daemon = True
+        # the job (or the queued files) must be committed before the thread (other db connection) can see them.
+        transaction.on_commit(thread.start)
+
+
+def _run_in_thread(func, *args):
+    try:
+        func(*args)
+    finally:
+        connection.close()
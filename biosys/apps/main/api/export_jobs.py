@@ -0,0 +1,295 @@
+from __future__ import absolute_import, unicode_literals, print_function, division
+
+import datetime
+import hashlib
+import io
+import json
+import logging
+import tempfile
+import threading
+
+from django.conf import settings
+from django.core.files import File
+from django.db import connection, transaction
+from django.db.models import Max, Count
+from django.utils import six, timezone
+from rest_framework.settings import import_from_string
+
+from main.api.deletions import start_file_sweep
+from main.api.exporters import DefaultExporter
+from main.api.filters import RecordFilterSet, FilterException
+from main.models import ExportJob, PendingFileDeletion, Record
+from main.utils_http import StoredFileResponse
+from main.utils_misc import search_json_fields, order_by_json_field
+
+logger = logging.getLogger(__name__)
+
+EXPORT_RUNNER_THREAD = 'thread'
+EXPORT_RUNNER_WORKER = 'worker'
+EXPORT_RUNNER_SYNC = 'sync'
+
+EXPORT_CONTENT_TYPES = {
+    ExportJob.FORMAT_XLSX: 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+    ExportJob.FORMAT_CSV: 'text/csv',
+    ExportJob.FORMAT_PARQUET: 'application/vnd.apache.parquet',
+}
+
+# the query parameters of the records end-point that don't change the exported records (the dataset is fixed)
+IGNORED_PARAMS = ('output', 'format', 'limit', 'offset', 'fields', 'dataset', 'dataset__id', 'dataset__name')
+
+# a pending or running job older than that is considered dead (e.g. server restarted) and is not reused.
+JOB_TIMEOUT = datetime.timedelta(hours=1)
+
+RECORD_FIELD_NAMES = [f.name for f in Record._meta.get_fields()]
+
+
+def get_exporter_class():
+    exporter_class = DefaultExporter
+    if hasattr(settings, 'EXPORTER_CLASS') and settings.EXPORTER_CLASS:
+        try:
+            exporter_class = import_from_string(settings.EXPORTER_CLASS, 'EXPORTER_CLASS')
+        except Exception:
+            logger.exception("Error while importing exporter class: {}".format(settings.EXPORTER_CLASS))
+    return exporter_class
+
+
+def clean_export_params(params):
+    """
+    :param params: dict or QueryDict of the records filters
+    :return: a dict of the params that filter or order the records
+    """
+    return dict((k, v) for k, v in (params or {}).items() if k not in IGNORED_PARAMS and v not in (None, ''))
+
+
+def get_export_queryset(dataset, params):
+    """
+    Apply the same filters, search and ordering as the records end-point.
+    Will throw a FilterException if the filters are invalid.
+    """
+    params = clean_export_params(params)
+    filter_set = RecordFilterSet(data=params, queryset=dataset.record_queryset.order_by('id'), dataset=dataset)
+    if not filter_set.is_valid():
+        raise FilterException(json.dumps(filter_set.errors))
+    queryset = filter_set.qs
+    field_names = [f.get('name') for f in dataset.schema_data.get('fields', []) if f.get('name')]
+    search = params.get('search')
+    if search and field_names:
+        queryset = search_json_fields(queryset, {
+            'data': field_names,
+            'source_info': ['file_name', 'row']
+        }, search)
+    ordering = params.get('ordering')
+    if ordering:
+        if ordering.lstrip('-') in RECORD_FIELD_NAMES:
+            queryset = queryset.order_by(ordering)
+        else:
+            queryset = order_by_json_field(queryset, 'data', field_names, ordering)
+            queryset = order_by_json_field(queryset, 'source_info', ['file_name', 'row'], ordering)
+    return queryset
+
+
+def get_export_cache_key(dataset, format_, params):
+    """
+    The key identifies the content of an export. It changes if the dataset schema or any of its records change
+    (the records count catches the deletes, the latest last_modified the creates and updates).
+    """
+    version = dataset.record_queryset.aggregate(count=Count('id'), last_modified=Max('last_modified'))
+    parts = [
+        dataset.pk,
+        format_,
+        json.dumps(clean_export_params(params), sort_keys=True),
+        json.dumps(dataset.schema_data, sort_keys=True),
+        version['count'],
+        version['last_modified'].isoformat() if version['last_modified'] else ''
+    ]
+    return hashlib.sha1('|'.join(six.text_type(p) for p in parts).encode('utf-8')).hexdigest()
+
+
+def find_export_job(dataset, format_, params, cache_key=None, user=None):
+    """
+    :param user: if given, only the jobs of this user.
+    :return: the latest job for this export that is done or still in progress, or None
+    """
+    cache_key = cache_key or get_export_cache_key(dataset, format_, params)
+    jobs = ExportJob.objects.filter(dataset=dataset, cache_key=cache_key)
+    if user is not None:
+        jobs = jobs.filter(user=user)
+    done = jobs.filter(status=ExportJob.STATUS_DONE).exclude(file='').exclude(file=None).first()
+    if done is not None:
+        return done
+    return jobs.filter(
+        status__in=[ExportJob.STATUS_PENDING, ExportJob.STATUS_RUNNING],
+        created__gte=timezone.now() - JOB_TIMEOUT
+    ).first()
+
+
+def request_export(dataset, format_, params, user=None):
+    """
+    Return the job of an identical export of the user if any (the users only see their own jobs), or create one.
+    The new job shares the file of an identical finished export of another user if any, otherwise it's started.
+    """
+    params = clean_export_params(params)
+    cache_key = get_export_cache_key(dataset, format_, params)
+    user = user if user and user.is_authenticated else None
+    job = find_export_job(dataset, format_, params, cache_key=cache_key, user=user)
+    if job is not None:
+        return job
+    with transaction.atomic():
+        # locked: a concurrent cleanup can't delete the file while it's shared
+        shared = ExportJob.objects.select_for_update().filter(
+            dataset=dataset, cache_key=cache_key, status=ExportJob.STATUS_DONE
+        ).exclude(file='').exclude(file=None).first()
+        job = ExportJob.objects.create(
+            dataset=dataset,
+            user=user,
+            format=format_,
+            filters=params,
+            cache_key=cache_key
+        )
+        if shared is not None:
+            now = timezone.now()
+            job.file = shared.file.name
+            job.status = ExportJob.STATUS_DONE
+            job.started = job.completed = now
+            job.save()
+            delete_superseded_export_jobs(job)
+    if shared is None:
+        start_export_job(job)
+    return job
+
+
+def delete_export_jobs(jobs):
+    """
+    Delete the jobs. Their files are queued for deletion (see PendingFileDeletion) unless another job shares them.
+    """
+    jobs = list(jobs)
+    with transaction.atomic():
+        names = set(job.file.name for job in jobs if job.file)
+        ExportJob.objects.filter(pk__in=[job.pk for job in jobs]).delete()
+        shared = set(ExportJob.objects.filter(file__in=names).values_list('file', flat=True))
+        PendingFileDeletion.objects.bulk_create(PendingFileDeletion(name=name) for name in sorted(names - shared))
+    if names - shared:
+        start_file_sweep()
+
+
+def delete_superseded_export_jobs(job):
+    """
+    Delete the finished exports of the same records (dataset, format and filters) that the user requested before the
+    given job. They are of a previous version of the records: their files are never served again.
+    """
+    superseded = ExportJob.objects.filter(
+        dataset=job.dataset_id,
+        user=job.user_id,
+        format=job.format,
+        filters=job.filters,
+        status=ExportJob.STATUS_DONE,
+        created__lt=job.created,
+    ).exclude(pk=job.pk).select_for_update()
+    with transaction.atomic():
+        delete_export_jobs(superseded)
+
+
+def start_export_job(job):
+    runner = getattr(settings, 'EXPORT_JOB_RUNNER', EXPORT_RUNNER_THREAD)
+    if runner == EXPORT_RUNNER_SYNC:
+        run_export_job(job)
+    elif runner == EXPORT_RUNNER_THREAD:
+        thread = threading.Thread(target=_run_export_job_in_thread, args=(job.pk,))
+        thread.daemon = True
+        # the job must be committed before the thread (other db connection) can see it.
+        transaction.on_commit(thread.start)
+    # with the 'worker' runner the job is picked up by the run_export_jobs command
+
+
+def _run_export_job_in_thread(job_pk):
+    try:
+        job = ExportJob.objects.filter(pk=job_pk, status=ExportJob.STATUS_PENDING).first()
+        if job is not None:
+            run_export_job(job)
+    finally:
+        connection.close()
+
+
+def export_to_file(exporter, format_, output):
+    """
+    Write the export in the given binary file.
+    """
+    if format_ == ExportJob.FORMAT_XLSX:
+        exporter.to_workbook().save(output)
+    elif format_ == ExportJob.FORMAT_PARQUET:
+        exporter.to_parquet(output)
+    elif six.PY2:
+        # unicodecsv writes bytes
+        exporter.to_csv(output)
+    else:
+        text_output = io.TextIOWrapper(output, encoding='utf-8', newline='')
+        exporter.to_csv(text_output)
+        text_output.flush()
+        text_output.detach()
+
+
+def run_export_job(job):
+    job.status = ExportJob.STATUS_RUNNING
+    job.started = timezone.now()
+    job.save()
+    try:
+        dataset = job.dataset
+        queryset = get_export_queryset(dataset, job.filters or {})
+        exporter = get_exporter_class()(dataset, queryset)
+        file_name = '{name}_{date}.{ext}'.format(
+            name=dataset.name,
+            date=timezone.localtime(job.started).strftime('%Y-%m-%d-%H%M%S'),
+            ext=job.format
+        )
+        with tempfile.TemporaryFile() as output:
+            export_to_file(exporter, job.format, output)
+            output.seek(0)
+            job.file.save(file_name, File(output), save=False)
+        job.status = ExportJob.STATUS_DONE
+    except Exception as e:
+        logger.exception("Error while running the export job {}".format(job.pk))
+        job.status = ExportJob.STATUS_FAILED
+        job.error = str(e)
+    job.completed = timezone.now()
+    job.save()
+    if job.status == ExportJob.STATUS_DONE:
+        delete_superseded_export_jobs(job)
+    return job
+
+
+def run_pending_export_jobs():
+    """
+    Run all the pending jobs. Used by the run_export_jobs command.
+    Jobs are claimed one at a time with a row lock so several workers can run concurrently.
+    :return: the number of jobs run
+    """
+    count = 0
+    while True:
+        with transaction.atomic():
+            job = ExportJob.objects.select_for_update(skip_locked=True) \
+                .filter(status=ExportJob.STATUS_PENDING).order_by('created').first()
+            if job is None:
+                return count
+            job.status = ExportJob.STATUS_RUNNING
+            job.save()
+        run_export_job(job)
+        count += 1
+
+
+def export_job_file_response(job):
+    file_name = job.file.name.split('/')[-1]
+    return StoredFileResponse(job.file.open('rb'), file_name, EXPORT_CONTENT_TYPES.get(job.format))
+
+
+def export_file_response(exporter, format_, file_name):
+    """
+    Generate the export in a temporary file and stream it.
+    """
+    output = tempfile.TemporaryFile()
+    try:
+        export_to_file(exporter, format_, output)
+    except Exception:
+        output.close()
+        raise
+    output.seek(0)
+    return StoredFileResponse(output, file_name, EXPORT_CONTENT_TYPES.get(format_))
@@ -1,37 +1,182 @@
-from django.utils import six
+import copy
+import datetime
+import json
+import re
+import threading
+from decimal import Decimal
+
+try:
+    from importlib.util import find_spec
+except ImportError:
+    # python 2
+    from pkgutil import find_loader as find_spec
+
+from django.db import connection
+from django.utils import six, timezone
+from django.utils.six.moves import queue
+from django.utils.text import slugify
 from openpyxl import Workbook
 from openpyxl.styles import Font
 from openpyxl.writer.write_only import WriteOnlyCell
+from tableschema import Field as TableField
 
-from main.utils_data_package import GenericSchema
+from main.utils_data_package import GenericSchema, SchemaField, cast_date_any_format, cast_datetime_any_format
 
 COLUMN_HEADER_FONT = Font(bold=True)
 
+PARQUET_BATCH_SIZE = 10000
+# the record columns added to the data columns in the parquet export
+PARQUET_RECORD_COLUMNS = ['id', 'geometry', 'datetime', 'species_name', 'name_id']
+PARQUET_NOT_AVAILABLE_MESSAGE = "The parquet export requires the 'pyarrow' package."
+
+
+def parquet_available():
+    return find_spec('pyarrow') is not None
+
+
+def _to_int(value):
+    # same as the tableschema integer cast (default bareNumber)
+    if isinstance(value, six.integer_types):
+        return value
+    if isinstance(value, six.string_types):
+        return int(value)
+    raise ValueError('Not an integer: {}'.format(value))
+
+
+def _to_decimal(value):
+    # same as the tableschema number cast (default decimalChar, groupChar and bareNumber)
+    if isinstance(value, Decimal):
+        return value
+    if isinstance(value, six.string_types):
+        value = re.sub(r'\s', '', value)
+    elif not isinstance(value, six.integer_types + (float,)):
+        raise ValueError('Not a number: {}'.format(value))
+    return Decimal(value)
+
+
+def _boolean_converter(true_values, false_values):
+    true_values = set(true_values)
+    false_values = set(false_values)
+
+    def to_bool(value):
+        if isinstance(value, bool):
+            return value
+        if value in true_values:
+            return True
+        if value in false_values:
+            return False
+        raise ValueError('Not a boolean: {}'.format(value))
+
+    return to_bool
+
+
+def _date_converter(format_, is_datetime):
+    if format_ == 'any':
+        return cast_datetime_any_format if is_datetime else cast_date_any_format
+    if format_ == 'default':
+        pattern = '%Y-%m-%dT%H:%M:%SZ' if is_datetime else '%Y-%m-%d'
+    else:
+        # legacy 'fmt:' prefix
+        pattern = format_[4:] if format_.startswith('fmt:') else format_
+
+    def to_date(value):
+        if is_datetime:
+            if isinstance(value, datetime.datetime):
+                return value
+            return datetime.datetime.strptime(value, pattern)
+        if isinstance(value, datetime.date):
+            return value
+        return datetime.datetime.strptime(value, pattern).date()
+
+    return to_date
+
+
+def _tableschema_converter(descriptor):
+    field = TableField(copy.deepcopy(descriptor))
+    return lambda value: field.cast_value(value, constraints=False)
+
+
+def build_cell_converter(descriptor, strict=False):
+    """
+    Build the function that converts the values of a schema field to native python values for an export.
+    It is built once per column and is much faster than SchemaField.cast: no constraints checking (the data are
+    already validated) and no tableschema call for the common types. The values are the same as the SchemaField.cast
+    ones: integer, number (Decimal), boolean (the SchemaField true and false values), date and datetime are converted
+    here, the other types (time, year...) are cast by tableschema.
+    :param descriptor: the schema field descriptor
+    :param strict: if False a value that can't be converted is returned as is, if True None is returned.
+    :return: a function(value) -> value
+    """
+    type_ = descriptor.get('type') or 'string'
+    format_ = descriptor.get('format') or 'default'
+    number_options = any(option in descriptor for option in ['decimalChar', 'groupChar', 'bareNumber'])
+    if type_ in ['string', 'any']:
+        convert = None
+    elif type_ == 'integer' and not number_options:
+        convert = _to_int
+    elif type_ == 'number' and not number_options:
+        convert = _to_decimal
+    elif type_ == 'boolean':
+        convert = _boolean_converter(
+            descriptor.get('trueValues', SchemaField.TRUE_VALUES),
+            descriptor.get('falseValues', SchemaField.FALSE_VALUES)
+        )
+    elif type_ in ['date', 'datetime']:
+        convert = _date_converter(format_, type_ == 'datetime')
+    else:
+        convert = _tableschema_converter(descriptor)
+
+    def converter(value):
+        if value is None:
+            return None
+        raw = value
+        if isinstance(value, six.string_types):
+            value = value.strip()
+            # TODO: remove that when running in Python3
+            if not isinstance(value, six.text_type):
+                value = six.u(value)
+            if not value:
+                return None
+        if convert is None:
+            return value
+        try:
+            return convert(value)
+        except Exception:
+            return None if strict else raw
+
+    return converter
+
 
 class DefaultExporter:
     def __init__(self, dataset, records=None):
         self.ds = dataset
-        self.schema = GenericSchema(dataset.schema_data)
-        self.headers = self.schema.headers
+        # Note: don't build the GenericSchema here (slow). Only the fields descriptors are needed.
+        self.fields = [f for f in dataset.schema_data.get('fields', []) if f.get('name')]
+        self.headers = [f['name'] for f in self.fields]
+        self._schema = None
         self.warnings = []
         self.errors = []
         self.records = records if records else []
 
+    @property
+    def schema(self):
+        if self._schema is None:
+            self._schema = GenericSchema(self.ds.schema_data)
+        return self._schema
+
     def row_it(self, cast=True):
+        names = self.headers
+        converters = [build_cell_converter(f) for f in self.fields]
         for record in self.records:
-            row = []
-            for field in self.schema.fields:
-                value = record.data.get(field.name, '')
-                if cast:
-                    # Cast to native python type
-                    try:
-                        value = field.cast(value)
-                    except Exception:
-                        pass
+            data = record.data
+            if cast:
+                row = [convert(data.get(name, '')) for name, convert in zip(names, converters)]
+            else:
+                row = [data.get(name, '') for name in names]
                 # TODO: remove that when running in Python3
-                if isinstance(value, six.string_types) and not isinstance(value, six.text_type):
-                    value = six.u(value)
-                row.append(value)
+                if six.PY2:
+                    row = [six.u(v) if isinstance(v, six.string_types) and not isinstance(v, six.text_type) else v
+                           for v in row]
             yield row
 
     def csv_it(self):
@@ -70,6 +215,127 @@ class DefaultExporter:
         for row in self.csv_it():
             writer.writerow(row)
 
+    def _parquet_columns(self, pa):
+        """
+        :return: a list of (column name, arrow type, function(values) -> column value).
+        values is a tuple (id, data, geometry, datetime, species_name, name_id)
+        """
+        types = {
+            'integer': pa.int64(),
+            'number': pa.float64(),
+            'boolean': pa.bool_(),
+            'date': pa.date32(),
+            'datetime': pa.timestamp('us', tz='UTC'),
+        }
+        columns = []
+        for field in self.fields:
+            arrow_type = types.get(field.get('type'), pa.string())
+            columns.append((field['name'], arrow_type, self._parquet_data_getter(field, arrow_type, pa)))
+        # the record columns. Prefixed with 'record_' if a data field has the same name
+        data_names = set(self.headers)
+        record_types = [pa.int64(), pa.binary(), pa.timestamp('us', tz='UTC'), pa.string(), pa.int64()]
+        for index, (name, arrow_type) in enumerate(zip(PARQUET_RECORD_COLUMNS, record_types)):
+            if name in data_names:
+                name = 'record_' + name
+            if index == 1:
+                getter = self._parquet_geometry_getter
+            elif index == 2:
+                getter = self._parquet_datetime_getter
+            else:
+                getter = self._parquet_value_getter(index)
+            columns.append((name, arrow_type, getter))
+        return columns
+
+    @staticmethod
+    def _parquet_value_getter(index):
+        return lambda values: values[index]
+
+    @staticmethod
+    def _parquet_geometry_getter(values):
+        # WKB
+        return bytes(values[1].wkb) if values[1] else None
+
+    @staticmethod
+    def _parquet_datetime_getter(values):
+        value = values[3]
+        if value is not None and timezone.is_aware(value):
+            value = timezone.make_naive(value, timezone.utc)
+        return value
+
+    @staticmethod
+    def _parquet_data_getter(field, arrow_type, pa):
+        name = field['name']
+        is_string = arrow_type == pa.string()
+        is_datetime = arrow_type == pa.timestamp('us', tz='UTC')
+        is_float = arrow_type == pa.float64()
+        # a value that doesn't match the column type is exported as null
+        convert = build_cell_converter(field, strict=True)
+
+        def getter(values):
+            value = values[1].get(name)
+            if value is None or value == '':
+                return None
+            if is_string:
+                return six.text_type(value)
+            value = convert(value)
+            if is_float and isinstance(value, Decimal):
+                value = float(value)
+            if is_datetime and isinstance(value, datetime.datetime) and timezone.is_aware(value):
+                value = timezone.make_naive(value, timezone.utc)
+            return value
+
+        return getter
+
+    def _record_values_it(self):
+        """
+        Iterate through the records as tuples (id, data, geometry, datetime, species_name, name_id).
+        For a queryset the records are read from a server side cursor.
+        """
+        if hasattr(self.records, 'values_list'):
+            for values in self.records.values_list('id', 'data', 'geometry', 'datetime', 'species_name',
+                                                   'name_id').iterator():
+                yield values
+        else:
+            for record in self.records:
+                yield (record.id, record.data, record.geometry, record.datetime, record.species_name,
+                       record.name_id)
+
+    def to_parquet(self, output, batch_size=PARQUET_BATCH_SIZE):
+        """
+        Write the records as a parquet file.
+        The data columns are typed from the schema field types, the values that can't be cast are exported as null.
+        The record columns id, geometry (WKB), datetime, species_name and name_id are added.
+        Requires pyarrow. Will throw an ImportError if not installed.
+        :param output: a binary file like object
+        :param batch_size: number of records per row group
+        """
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        columns = self._parquet_columns(pa)
+        names = [c[0] for c in columns]
+        schema = pa.schema([pa.field(name, arrow_type) for name, arrow_type, getter in columns])
+        writer = pq.ParquetWriter(output, schema)
+
+        def write_batch(batch):
+            arrays = [
+                pa.array([getter(values) for values in batch], type=arrow_type)
+                for name, arrow_type, getter in columns
+            ]
+            writer.write_table(pa.Table.from_arrays(arrays, names))
+
+        try:
+            batch = []
+            for values in self._record_values_it():
+                batch.append(values)
+                if len(batch) >= batch_size:
+                    write_batch(batch)
+                    batch = []
+            if batch:
+                write_batch(batch)
+        finally:
+            writer.close()
+
 
 class BionetExporter(DefaultExporter):
     """
@@ -88,3 +354,212 @@ class BionetExporter(DefaultExporter):
         writer.writerow(['Bionet Ignored Line'])
         for row in self.csv_it():
             writer.writerow(row)
+
+
+def _csv_chunks(rows, rows_per_chunk=1000):
+    """
+    Encode rows as CSV (utf-8).
+    :return: a generator of bytes, one chunk every rows_per_chunk rows.
+    """
+    # TODO: remove when python3
+    if six.PY2:
+        import unicodecsv as csv
+        output = six.BytesIO()
+    else:
+        import csv
+        output = six.StringIO()
+    writer = csv.writer(output, dialect='excel')
+    count = 0
+    for row in rows:
+        writer.writerow(row)
+        count += 1
+        if count % rows_per_chunk == 0:
+            yield _pop_buffer(output)
+    yield _pop_buffer(output)
+
+
+def _pop_buffer(output):
+    data = output.getvalue()
+    output.seek(0)
+    output.truncate(0)
+    return data.encode('utf-8') if isinstance(data, six.text_type) else data
+
+
+class ProjectDataPackageExporter:
+    """
+    Export all the datasets of a project as a Frictionless data package
+    (https://frictionlessdata.io/specs/data-package/)
+    - datapackage.json: one resource per dataset (the dataset resource descriptor) plus a 'sites' resource
+    - data/<resource>.csv: one CSV per resource.
+    The dataset CSVs are generated in parallel (one thread and db connection per dataset, up to 'workers' datasets
+    at the same time) ahead of the zip writer. Each thread can only be 'prefetch' chunks ahead to bound the memory.
+    """
+    SITES_RESOURCE_NAME = 'sites'
+    SITES_SCHEMA = {
+        'fields': [
+            {'name': 'id', 'type': 'integer'},
+            {'name': 'code', 'type': 'string'},
+            {'name': 'name', 'type': 'string'},
+            {'name': 'description', 'type': 'string'},
+            {'name': 'geometry', 'type': 'geojson'},
+            {'name': 'attributes', 'type': 'object'},
+        ],
+        'primaryKey': 'id'
+    }
+    _END = object()
+
+    def __init__(self, project, exporter_class=None, workers=4, prefetch=8):
+        self.project = project
+        self.exporter_class = exporter_class or DefaultExporter
+        self.workers = max(int(workers), 1)
+        self.prefetch = max(int(prefetch), 1)
+        self.datasets = list(project.projects.order_by('name'))
+        self.resource_names = self._build_resource_names()
+
+    def _build_resource_names(self):
+        """
+        Data package resource names must be unique, lowercase and made of alphanumeric, '-', '_' and '.'
+        :return: a list of resource names, one for each dataset
+        """
+        used = {self.SITES_RESOURCE_NAME}
+        names = []
+        for dataset in self.datasets:
+            base_name = slugify(dataset.resource.get('name') or dataset.name) or 'dataset-{}'.format(dataset.pk)
+            name = base_name
+            index = 1
+            while name in used:
+                index += 1
+                name = '{}-{}'.format(base_name, index)
+            used.add(name)
+            names.append(name)
+        return names
+
+    @staticmethod
+    def _resource_path(name):
+        return 'data/{}.csv'.format(name)
+
+    @property
+    def descriptor(self):
+        resources = []
+        for dataset, name in zip(self.datasets, self.resource_names):
+            resource = copy.deepcopy(dataset.resource)
+            resource.update({
+                'name': name,
+                'title': dataset.name,
+                'path': self._resource_path(name),
+                'format': 'csv',
+                'mediatype': 'text/csv',
+                'encoding': 'utf-8',
+                'profile': 'tabular-data-resource',
+            })
+            if dataset.description:
+                resource['description'] = dataset.description
+            resources.append(resource)
+        resources.append({
+            'name': self.SITES_RESOURCE_NAME,
+            'title': 'Sites',
+            'path': self._resource_path(self.SITES_RESOURCE_NAME),
+            'format': 'csv',
+            'mediatype': 'text/csv',
+            'encoding': 'utf-8',
+            'profile': 'tabular-data-resource',
+            'schema': self.SITES_SCHEMA
+        })
+        result = {
+            'name': slugify(self.project.name) or 'project-{}'.format(self.project.pk),
+            'title': self.project.name,
+            'profile': 'tabular-data-package',
+            'created': timezone.now().isoformat(),
+            'resources': resources
+        }
+        if self.project.description:
+            result['description'] = self.project.description
+        return result
+
+    def dataset_csv_chunks(self, dataset):
+        records = dataset.record_queryset.order_by('id').iterator()
+        return _csv_chunks(self.exporter_class(dataset, records).csv_it())
+
+    def sites_csv_chunks(self):
+        def rows():
+            yield [f['name'] for f in self.SITES_SCHEMA['fields']]
+            for site in self.project.site_set.order_by('code').iterator():
+                yield [
+                    site.id,
+                    site.code,
+                    site.name,
+                    site.description or '',
+                    site.geometry.geojson if site.geometry else '',
+                    json.dumps(site.attributes) if site.attributes else ''
+                ]
+        return _csv_chunks(rows())
+
+    def _produce(self, dataset, output, stop):
+        """
+        Thread target: push the dataset CSV chunks in the output queue. Exceptions are passed to the consumer.
+        """
+        def put(item):
+            while not stop.is_set():
+                try:
+                    output.put(item, timeout=1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        try:
+            for chunk in self.dataset_csv_chunks(dataset):
+                if not put(chunk):
+                    return
+        except Exception as e:
+            put(e)
+        finally:
+            put(self._END)
+            connection.close()
+
+    def _consume(self, output):
+        while True:
+            item = output.get()
+            if item is self._END:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+    def _dataset_entries_parallel(self):
+        stop = threading.Event()
+        pending = list(zip(self.datasets, self.resource_names))
+        running = []
+
+        def start_next():
+            dataset, name = pending.pop(0)
+            output = queue.Queue(maxsize=self.prefetch)
+            thread = threading.Thread(target=self._produce, args=(dataset, output, stop))
+            thread.daemon = True
+            thread.start()
+            running.append((name, output))
+
+        try:
+            while pending and len(running) < self.workers:
+                start_next()
+            while running:
+                name, output = running.pop(0)
+                if pending:
+                    start_next()
+                yield self._resource_path(name), self._consume(output)
+        finally:
+            # client gone or error: tell the threads to stop
+            stop.set()
+
+    def entries(self):
+        """
+        :return: a generator of (file name, bytes chunks) for utils_zip.zip_stream
+        """
+        yield 'datapackage.json', [json.dumps(self.descriptor, indent=2).encode('utf-8')]
+        if self.workers > 1:
+            for entry in self._dataset_entries_parallel():
+                yield entry
+        else:
+            for dataset, name in zip(self.datasets, self.resource_names):
+                yield self._resource_path(name), self.dataset_csv_chunks(dataset)
+        yield self._resource_path(self.SITES_RESOURCE_NAME), self.sites_csv_chunks()
@@ -0,0 +1,51 @@
+from __future__ import absolute_import, unicode_literals, print_function, division
+
+import logging
+import threading
+
+from django.conf import settings
+from django.db import connection
+
+from main.models import Dataset
+
+logger = logging.getLogger(__name__)
+
+REFRESH_RUNNER_THREAD = 'thread'
+REFRESH_RUNNER_WORKER = 'worker'
+REFRESH_RUNNER_SYNC = 'sync'
+
+# the datasets whose extent is being refreshed by a thread of this process.
+_refreshing = set()
+_refreshing_lock = threading.Lock()
+
+
+def request_extent_refresh(dataset):
+    """
+    Recompute the stale extent of a dataset according to the DATASET_EXTENT_REFRESH setting. With the 'thread' runner
+    the extent is recomputed in the background and the current request reads the previous extent. With the 'worker'
+    runner nothing is done here: the refresh_extents command recomputes the stale extents.
+    """
+    runner = getattr(settings, 'DATASET_EXTENT_REFRESH', REFRESH_RUNNER_THREAD)
+    if runner == REFRESH_RUNNER_SYNC:
+        dataset.refresh_extent()
+    elif runner == REFRESH_RUNNER_THREAD:
+        with _refreshing_lock:
+            if dataset.pk in _refreshing:
+                return
+            _refreshing.add(dataset.pk)
+        thread = threading.Thread(target=_refresh_in_thread, args=(dataset.pk,))
+        thread.daemon = True
+        thread.start()
+
+
+def _refresh_in_thread(dataset_pk):
+    try:
+        dataset = Dataset.objects.filter(pk=dataset_pk, extent_stale=True).first()
+        if dataset is not None:
+            dataset.refresh_extent()
+    except Exception:
+        logger.exception('Error while refreshing the extent of the dataset {}'.format(dataset_pk))
+    finally:
+        connection.close()
+        with _refreshing_lock:
+            _refreshing.discard(dataset_pk)
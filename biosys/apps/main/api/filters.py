@@ -1,12 +1,18 @@
+import decimal
 import logging
 import json
 
 from django.contrib.auth import get_user_model
+from django.db.models.expressions import RawSQL
 from django_filters import rest_framework as filters, constants
 from django.utils import six
 from rest_framework.exceptions import APIException
 
 from main import models
+from main.api.helpers import to_bool
+from main.constants import MODEL_SRID
+from main.utils_data_package import parse_datetime_day_first, InvalidDateType
+from main.utils_geo import parse_bbox
 
 logger = logging.getLogger(__name__)
 
@@ -49,6 +55,122 @@ class JSONFilter(filters.CharFilter):
         return qs
 
 
+DATA_FILTER_PREFIX = 'data.'
+
+DATA_FILTER_OPERATORS = {
+    'exact': '=',
+    'gt': '>',
+    'gte': '>=',
+    'lt': '<',
+    'lte': '<=',
+}
+DATA_FILTER_LOOKUPS = list(DATA_FILTER_OPERATORS.keys()) + ['in', 'isnull']
+
+
+def _cast_number(value):
+    try:
+        return decimal.Decimal(value.strip())
+    except decimal.InvalidOperation:
+        raise ValueError("'{}' is not a number".format(value))
+
+
+def _cast_boolean(value):
+    value = value.strip().lower()
+    if value in ['true', 't', 'yes', 'y', '1']:
+        return True
+    if value in ['false', 'f', 'no', 'n', '0']:
+        return False
+    raise ValueError("'{}' is not a boolean".format(value))
+
+
+def _cast_date(value):
+    return parse_datetime_day_first(value).date()
+
+
+def _cast_datetime(value):
+    # the records data datetimes are compared without time zone (see biosys_to_timestamp)
+    return parse_datetime_day_first(value).replace(tzinfo=None)
+
+
+# schema field type -> (SQL expression of the data text value, cast of the filter value, supported lookups)
+# The biosys_to_* SQL functions are created by the migration 0024_data_cast_functions.
+DATA_FILTER_TYPES = {
+    'integer': ('biosys_to_numeric({})', _cast_number, DATA_FILTER_LOOKUPS),
+    'number': ('biosys_to_numeric({})', _cast_number, DATA_FILTER_LOOKUPS),
+    'date': ('biosys_to_date({})', _cast_date, DATA_FILTER_LOOKUPS),
+    'datetime': ('biosys_to_timestamp({})', _cast_datetime, DATA_FILTER_LOOKUPS),
+    'boolean': ('biosys_to_boolean({})', _cast_boolean, ['exact', 'in', 'isnull']),
+}
+# any other type is compared as text
+DATA_FILTER_TEXT_TYPE = ("NULLIF({}, '')", lambda value: value, DATA_FILTER_LOOKUPS)
+
+
+def parse_data_filter_key(key):
+    """
+    'data.Count__gte' -> ('Count', 'gte'). The lookup is 'exact' if not given.
+    """
+    name = key[len(DATA_FILTER_PREFIX):]
+    field_name, separator, lookup = name.rpartition('__')
+    if separator and lookup in DATA_FILTER_LOOKUPS:
+        return field_name, lookup
+    return name, 'exact'
+
+
+def filter_data_fields(queryset, dataset, params):
+    """
+    Apply the typed filters on the fields of the records data:
+    data.<field>=value, data.<field>__gt|gte|lt|lte=value, data.<field>__in=value1,value2 and data.<field>__isnull=true
+    The field must be in the dataset schema. The values are compared according to the field type (numbers, dates,
+    datetimes, booleans or text), e.g. biosys_to_numeric(data->>'Count') >= 5.
+    Will throw a FilterException if a field, lookup or value is invalid.
+    :param dataset: the dataset of the records. Required if there's any data filter.
+    :param params: dict or QueryDict of the query parameters
+    """
+    data_filters = [(key, value) for key, value in (params or {}).items()
+                    if key.startswith(DATA_FILTER_PREFIX) and value not in constants.EMPTY_VALUES]
+    if not data_filters:
+        return queryset
+    if dataset is None:
+        raise FilterException("The {}<field> filters require a dataset. Use the dataset__id filter.".format(
+            DATA_FILTER_PREFIX))
+    schema = dataset.schema
+    column = '"{table}"."data"'.format(table=queryset.model._meta.db_table)
+    where = []
+    where_params = []
+    for key, value in data_filters:
+        field_name, lookup = parse_data_filter_key(key)
+        field = schema.get_field_by_name(field_name)
+        if field is None:
+            raise FilterException("Error while filtering {key}. The field '{field}' is not in the dataset schema. "
+                                  "The fields are: {fields}".format(key=key, field=field_name,
+                                                                    fields=schema.field_names))
+        template, cast, lookups = DATA_FILTER_TYPES.get(field.type, DATA_FILTER_TEXT_TYPE)
+        if lookup not in lookups:
+            raise FilterException("Error while filtering {key}. The lookup '{lookup}' is not supported for a field "
+                                  "of type {type}. Supported lookups: {lookups}".format(
+                                      key=key,
+                                      lookup=lookup,
+                                      type=field.type,
+                                      lookups=lookups
+                                  ))
+        expression = template.format('{} ->> %s'.format(column))
+        if lookup == 'isnull':
+            where.append('{} IS {}NULL'.format(expression, '' if to_bool(value) else 'NOT '))
+            where_params.append(field_name)
+            continue
+        try:
+            values = [cast(v) for v in (value.split(',') if lookup == 'in' else [value])]
+        except (TypeError, ValueError, OverflowError, InvalidDateType) as e:
+            raise FilterException("Error while filtering {key} with value: '{value}'. Expected a {type}. {e}".format(
+                key=key, value=value, type=field.type, e=e))
+        if lookup == 'in':
+            where.append('{} IN ({})'.format(expression, ', '.join(['%s'] * len(values))))
+        else:
+            where.append('{} {} %s'.format(expression, DATA_FILTER_OPERATORS[lookup]))
+        where_params += [field_name] + values
+    return queryset.extra(where=where, params=where_params)
+
+
 class GeometryFilter(filters.CharFilter):
     """
     The purpose of this class is just to catch exception that can be raise while filtering the geometry.
@@ -70,6 +192,64 @@ class GeometryFilter(filters.CharFilter):
             raise FilterException(message)
 
 
+class SpatialFilterSet(filters.FilterSet):
+    """
+    Index friendly spatial filters for a model with a 'geometry' field:
+    - bbox=minx,miny,maxx,maxy: geometry bounding box overlaps (&& operator, GiST index)
+    - dwithin=lon,lat,meters: geometry within a distance in meters (ST_DWithin on geography, geography GiST index)
+    - nearest=lon,lat: order by distance (KNN <-> operator). Use it with the pagination 'limit' to get the k nearest.
+      It can't be combined with the 'ordering' param.
+    Coordinates are WGS84.
+    """
+    bbox = filters.CharFilter(method='filter_bbox')
+    dwithin = filters.CharFilter(method='filter_dwithin')
+    nearest = filters.CharFilter(method='filter_nearest')
+
+    @staticmethod
+    def _parse_numbers(name, value, count, expected):
+        try:
+            numbers = [float(v) for v in value.split(',')]
+        except (AttributeError, TypeError, ValueError):
+            numbers = []
+        if len(numbers) != count:
+            raise FilterException("Error while filtering {name}. Expected '{expected}'. Got: '{value}'".format(
+                name=name,
+                expected=expected,
+                value=value
+            ))
+        return numbers
+
+    @staticmethod
+    def _geometry_column(queryset):
+        return '"{table}"."geometry"'.format(table=queryset.model._meta.db_table)
+
+    def filter_bbox(self, queryset, name, value):
+        try:
+            bbox = parse_bbox(value)
+        except ValueError as e:
+            raise FilterException("Error while filtering {}. {}".format(name, e))
+        return queryset.filter(geometry__bboverlaps=bbox)
+
+    def filter_dwithin(self, queryset, name, value):
+        lon, lat, distance = self._parse_numbers(name, value, 3, 'lon,lat,meters')
+        where = 'ST_DWithin({column}::geography, ST_SetSRID(ST_MakePoint(%s, %s), {srid})::geography, %s)'.format(
+            column=self._geometry_column(queryset),
+            srid=MODEL_SRID
+        )
+        return queryset.extra(where=[where], params=[lon, lat, distance])
+
+    def filter_nearest(self, queryset, name, value):
+        if self.data.get('ordering'):
+            raise FilterException("Error while filtering {name}. The results are ordered by distance: "
+                                  "it can't be combined with the ordering param.".format(name=name))
+        lon, lat = self._parse_numbers(name, value, 2, 'lon,lat')
+        distance = RawSQL('{column} <-> ST_SetSRID(ST_MakePoint(%s, %s), {srid})'.format(
+            column=self._geometry_column(queryset),
+            srid=MODEL_SRID
+        ), (lon, lat))
+        return queryset.filter(geometry__isnull=False).order_by(distance)
+
+
 class UserFilterSet(filters.FilterSet):
     project__id = filters.CharFilter(name='project', method='filter_project_id_custodians')
     project__name = filters.CharFilter(name='project', method='filter_project_name_custodians')
@@ -141,11 +321,53 @@ class DatasetFilterSet(filters.FilterSet):
         }
 
 
-class RecordFilterSet(filters.FilterSet):
+class SiteFilterSet(SpatialFilterSet):
+    class Meta:
+        model = models.Site
+        fields = {
+            'id': ['exact', 'in'],
+            'name': ['exact'],
+            'code': ['exact'],
+            'project__name': ['exact'],
+            'project__code': ['exact'],
+            'project__id': ['exact'],
+        }
+
+
+class RecordFilterSet(SpatialFilterSet):
     # TODO: how to document these filters so that a description appears in the swagger.
-    data__contains = JSONFilter(field_name='data', lookup_expr='contains', distinct=True)
-    data__has_key = filters.CharFilter(field_name='data', lookup_expr='has_key', distinct=True)
-    geometry__within = GeometryFilter(field_name='geometry', lookup_expr='within', distinct=True)
+    # No distinct: these lookups are on the record columns (no join), a record can't be returned twice and a DISTINCT
+    # over the wide data rows would prevent an index driven plan. data__contains uses the GIN (jsonb_path_ops) index.
+    data__contains = JSONFilter(field_name='data', lookup_expr='contains')
+    data__has_key = filters.CharFilter(field_name='data', lookup_expr='has_key')
+    geometry__within = GeometryFilter(field_name='geometry', lookup_expr='within')
+
+    def __init__(self, data=None, *args, **kwargs):
+        # the dataset of the data.<field> filters. If not given: the dataset__id filter or the view dataset.
+        self.dataset = kwargs.pop('dataset', None)
+        super(RecordFilterSet, self).__init__(data, *args, **kwargs)
+
+    def get_dataset(self):
+        if self.dataset is None:
+            dataset_id = self.data.get('dataset__id') if self.data else None
+            if dataset_id:
+                try:
+                    self.dataset = models.Dataset.objects.filter(pk=int(dataset_id)).first()
+                except (TypeError, ValueError):
+                    pass
+            else:
+                view = (getattr(self.request, 'parser_context', None) or {}).get('view')
+                self.dataset = getattr(view, 'dataset', None)
+        return self.dataset
+
+    @property
+    def qs(self):
+        if not hasattr(self, '_data_fields_qs'):
+            queryset = super(RecordFilterSet, self).qs
+            if any(key.startswith(DATA_FILTER_PREFIX) for key in (self.data or {})):
+                queryset = filter_data_fields(queryset, self.get_dataset(), self.data)
+            self._data_fields_qs = queryset
+        return self._data_fields_qs
 
     class Meta:
         model = models.Record
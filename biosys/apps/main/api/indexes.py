@@ -0,0 +1,54 @@
+from __future__ import absolute_import, unicode_literals, print_function, division
+
+import logging
+import threading
+
+from django.conf import settings
+from django.db import connection
+
+from main.models import Dataset
+
+logger = logging.getLogger(__name__)
+
+INDEX_RUNNER_THREAD = 'thread'
+INDEX_RUNNER_WORKER = 'worker'
+INDEX_RUNNER_SYNC = 'sync'
+
+# the datasets whose primary key index is being built by a thread of this process.
+_building = set()
+_building_lock = threading.Lock()
+
+
+def request_primary_key_index(dataset):
+    """
+    Build the primary key index of a dataset (see Dataset.create_primary_key_index), or drop the indexes of a previous
+    primary key, according to the PRIMARY_KEY_INDEX_BUILD setting. With the 'thread' runner the index is built in the
+    background. With the 'worker' runner nothing is done here: the build_primary_key_indexes command builds them.
+    Until the index is built the upserts of the dataset match the rows without it.
+    """
+    runner = getattr(settings, 'PRIMARY_KEY_INDEX_BUILD', INDEX_RUNNER_THREAD)
+    if runner == INDEX_RUNNER_WORKER or not dataset.primary_key_index_outdated:
+        return
+    if runner == INDEX_RUNNER_SYNC:
+        dataset.create_primary_key_index()
+    elif runner == INDEX_RUNNER_THREAD:
+        with _building_lock:
+            if dataset.pk in _building:
+                return
+            _building.add(dataset.pk)
+        thread = threading.Thread(target=_build_in_thread, args=(dataset.pk,))
+        thread.daemon = True
+        thread.start()
+
+
+def _build_in_thread(dataset_pk):
+    try:
+        dataset = Dataset.objects.filter(pk=dataset_pk).first()
+        if dataset is not None:
+            dataset.create_primary_key_index()
+    except Exception:
+        logger.exception('Error while building the primary key index of the dataset {}'.format(dataset_pk))
+    finally:
+        connection.close()
+        with _building_lock:
+            _building.discard(dataset_pk)
@@ -0,0 +1,139 @@
+from __future__ import absolute_import, unicode_literals, print_function, division
+
+import logging
+
+from django.db import transaction
+
+from main.api.uploaders import RecordCreator
+from main.utils_data_package import GeometryParser
+from main.utils_db import bulk_update
+from main.utils_geo import invalidate_tiles
+from main.utils_species import get_species_facade_class
+
+logger = logging.getLogger(__name__)
+
+
+class RecordReprocessor(object):
+    """
+    Recompute the fields of the records derived from their data (site, datetime, geometry, species name and name id)
+    with the current schema of the dataset and the current datum and timezone of the project. To be run after one of
+    them changed.
+    The records are processed in batches of batch_size (keyset pagination on the id): the derivation is the one of
+    the upload (see RecordCreator.set_derived_fields), with the sites of the project loaded once and the geometries
+    transformed to the model srid by the UPDATE. Only the records whose derived fields changed are written, with one
+    UPDATE per batch.
+    The records that now fail the validation are not updated and are reported.
+    :param record_ids: optional list of ids to reprocess only some records of the dataset.
+    :param on_batch: optional callable called with the reprocessor after every batch (e.g. progress).
+    """
+    BATCH_SIZE = 1000
+    # the derived fields (and the modification date, see bulk_update). The data is not changed.
+    FIELDS = ['site', 'datetime', 'geometry', 'species_name', 'name_id', 'last_modified']
+    # only the changed records are written. The geometries are compared once transformed (see bulk_update).
+    CHANGED_SQL = 't."site_id" IS DISTINCT FROM v."site_id" ' \
+                  'OR t."datetime" IS DISTINCT FROM v."datetime" ' \
+                  'OR ST_AsEWKB(t."geometry") IS DISTINCT FROM ST_AsEWKB(ST_Transform(v."geometry", {srid})) ' \
+                  'OR t."species_name" IS DISTINCT FROM v."species_name" ' \
+                  'OR t."name_id" IS DISTINCT FROM v."name_id"'
+
+    def __init__(self, dataset, batch_size=None, species_facade_class=None, max_errors=1000, record_ids=None,
+                 on_batch=None):
+        self.dataset = dataset
+        self.record_ids = sorted(record_ids) if record_ids is not None else None
+        self.batch_size = batch_size or self.BATCH_SIZE
+        self.max_errors = max_errors
+        self.on_batch = on_batch
+        # the creator does the derivation only: no site creation, no save.
+        self.creator = RecordCreator(dataset, [], commit=False, create_site=False,
+                                     species_facade_class=species_facade_class or get_species_facade_class(),
+                                     validation_workers=1)
+        self.processed = 0
+        self.updated = 0
+        self.error_count = 0
+        # [{'id': record id, 'errors': {column: message}}], at most max_errors
+        self.errors = []
+
+    @staticmethod
+    def source_field_names(dataset):
+        """
+        :return: the set of the names of the schema fields the derived fields are computed from.
+        """
+        schema = dataset.schema
+        parsers = [GeometryParser(schema), getattr(schema, 'date_parser', None),
+                   getattr(schema, 'species_name_parser', None)]
+        return set(field.name for parser in parsers if parser is not None for field in parser.get_active_fields())
+
+    def _batches(self):
+        queryset = self.dataset.record_queryset.order_by('id').only('id', 'dataset', 'data', *self.FIELDS)
+        if self.record_ids is not None:
+            for start in range(0, len(self.record_ids), self.batch_size):
+                yield list(queryset.filter(id__in=self.record_ids[start:start + self.batch_size]))
+            return
+        last_id = 0
+        while True:
+            records = list(queryset.filter(id__gt=last_id)[:self.batch_size])
+            if not records:
+                return
+            last_id = records[-1].id
+            yield records
+
+    def run(self):
+        """
+        :return: a dict {'processed': int, 'updated': int, 'error_count': int, 'errors': [...]}
+        """
+        where = self.CHANGED_SQL.format(srid=int(self.dataset.record_model._meta.get_field('geometry').srid))
+        for records in self._batches():
+            changed = [record for record in records if self._reprocess(record)]
+            with transaction.atomic():
+                self.updated += len(bulk_update(changed, self.FIELDS, where=where))
+            self.processed += len(records)
+            if self.on_batch:
+                self.on_batch(self)
+        if self.updated:
+            # the geometries and the tile properties may have changed
+            self.dataset.mark_extent_stale()
+            invalidate_tiles(self.dataset.project_id)
+        logger.info('Dataset %s reprocessed: %s record(s), %s updated, %s error(s)', self.dataset.pk, self.processed,
+                    self.updated, self.error_count)
+        return {
+            'processed': self.processed,
+            'updated': self.updated,
+            'error_count': self.error_count,
+            'errors': self.errors,
+        }
+
+    @staticmethod
+    def _set_derived_values(record, derived):
+        """
+        Like RecordSerializer, a field is only set when a value is derived: the values not derived by the dataset type
+        (e.g. the datetime and geometry of a generic record given by the client) are kept.
+        """
+        if derived.site is not None:
+            record.site = derived.site
+        if derived.datetime is not None:
+            record.datetime = derived.datetime
+        if derived.geometry is not None:
+            record.geometry = derived.geometry
+        if derived.species_name is not None:
+            record.species_name = derived.species_name
+            record.name_id = derived.name_id
+
+    def _reprocess(self, record):
+        """
+        Set the derived fields of the record.
+        :return: False if the record is not valid anymore (and reported)
+        """
+        validator_result = self.creator.validator.validate(record.data)
+        if validator_result.is_valid:
+            derived = self.dataset.record_model(dataset=self.dataset, data=record.data)
+            try:
+                self.creator.set_derived_fields(derived, record.data, validator_result)
+            except Exception as e:
+                validator_result.add_column_error('unknown', str(e))
+        if validator_result.is_valid:
+            self._set_derived_values(record, derived)
+            return True
+        self.error_count += 1
+        if len(self.errors) < self.max_errors:
+            self.errors.append({'id': record.id, 'errors': validator_result.errors})
+        return False
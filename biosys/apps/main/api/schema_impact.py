@@ -0,0 +1,91 @@
+from __future__ import absolute_import, unicode_literals, print_function, division
+
+import itertools
+from collections import deque
+
+from django.conf import settings
+
+from main.api.uploaders import ValidationSummary, SiteFinder, validate_chunks
+from main.api.validators import get_record_validator_for_dataset
+from main.models import Dataset
+from main.utils_species import get_species_facade_class
+
+
+class SchemaImpactChecker(object):
+    """
+    Validate the existing records of a dataset against a proposed data package, without changing anything.
+    The records are read in chunks (keyset pagination on the id) and, if there's more than one chunk, validated in a
+    pool of processes like the upload (UPLOAD_VALIDATION_WORKERS and UPLOAD_VALIDATION_CHUNK_SIZE settings, see
+    main.api.uploaders.validate_chunks). At most workers + 1 chunks are read ahead.
+    The species and the sites are looked up like in the upload: the species names mapping of the species facade and
+    the site of a code in the dataset project first, then in any project.
+    The result is a ValidationSummary of the records (the rows are the record ids).
+    :param strict: if True the schema errors are errors, not warnings (like a strict upload).
+    """
+
+    def __init__(self, dataset, data_package, strict=False, workers=None, chunk_size=None, species_facade_class=None):
+        self.dataset = dataset
+        self.data_package = data_package
+        # the dataset with the proposed schema. Not saved.
+        self.proposed_dataset = Dataset(type=dataset.type, data_package=data_package, project=dataset.project)
+        species_name_id_mapping = None
+        if dataset.type == Dataset.TYPE_SPECIES_OBSERVATION:
+            species_facade_class = species_facade_class or get_species_facade_class()
+            # an empty mapping (no species facade) doesn't check the name ids
+            species_name_id_mapping = species_facade_class().name_id_by_species_name() or None
+        self.sites = SiteFinder(dataset.project)
+        self.validator = get_record_validator_for_dataset(self.proposed_dataset,
+                                                          species_name_id_mapping=species_name_id_mapping,
+                                                          site_getter=self.sites.find_site)
+        self.validator.schema_error_as_warning = not strict
+        self.workers = workers if workers is not None else getattr(settings, 'UPLOAD_VALIDATION_WORKERS', 1)
+        self.chunk_size = chunk_size or getattr(settings, 'UPLOAD_VALIDATION_CHUNK_SIZE', 1000)
+
+    def run(self, sample_size=5):
+        """
+        :return: a ValidationSummary
+        """
+        summary = ValidationSummary(sample_size=sample_size)
+        for record_ids, results in self._validated_chunks():
+            for record_id, result in zip(record_ids, results):
+                summary.add(record_id, result)
+        return summary
+
+    def _chunks(self):
+        """
+        :return: a generator of (record ids, record data) of chunk_size records
+        """
+        queryset = self.dataset.record_queryset.order_by('id').values_list('id', 'data')
+        last_id = 0
+        while True:
+            rows = list(queryset.filter(id__gt=last_id)[:self.chunk_size])
+            if not rows:
+                return
+            last_id = rows[-1][0]
+            yield [row[0] for row in rows], [row[1] for row in rows]
+
+    def _validated_chunks(self):
+        """
+        :return: a generator of (record ids, validator results)
+        """
+        chunks = self._chunks()
+        first_chunk = next(chunks, None)
+        if first_chunk is None:
+            return
+        if self.workers <= 1 or len(first_chunk[0]) < self.chunk_size:
+            # no workers or a small dataset: not worth starting processes.
+            for record_ids, rows in itertools.chain([first_chunk], chunks):
+                yield record_ids, [self.validator.validate(row) for row in rows]
+            return
+        # the record ids of the chunks being validated, in the chunks order
+        pending_ids = deque()
+
+        def rows_of(chunks):
+            for record_ids, rows in chunks:
+                pending_ids.append(record_ids)
+                yield rows
+
+        validated_chunks = validate_chunks(rows_of(itertools.chain([first_chunk], chunks)), self.proposed_dataset,
+                                           self.validator, self.workers, project_sites=self.sites.project_sites)
+        for rows, results in validated_chunks:
+            yield pending_ids.popleft(), results
@@ -2,19 +2,29 @@ from __future__ import absolute_import, unicode_literals, print_function, divisi
 
 import datetime
 
+from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.contrib.auth.password_validation import validate_password
 from django.core.exceptions import ValidationError
 from django.core.validators import RegexValidator
-from django.utils import timezone
+from django.db import transaction
+from django.utils import six, timezone
 
+from django.urls import reverse
 from rest_framework import serializers, fields, validators
 from rest_framework_gis import serializers as serializers_gis
 from drf_extra_fields.fields import Base64ImageField
 
+from main.api.export_jobs import get_export_queryset
+from main.api.exporters import parquet_available, PARQUET_NOT_AVAILABLE_MESSAGE
+from main.api.curation import validate_data_patch
+from main.api.filters import FilterException
+from main.api.schema_impact import SchemaImpactChecker
 from main.api.validators import get_record_validator_for_dataset
+from main import utils_metrics
 from main.constants import MODEL_SRID
-from main.models import Program, Project, Site, Dataset, Record, Media, DatasetMedia, ProjectMedia
+from main.models import Program, Project, Site, Dataset, Record, Media, DatasetMedia, ProjectMedia, ExportJob, \
+    DeletionJob, SpeciesSummary
 from main.utils_auth import is_admin
 from main.utils_species import get_key_for_value
 
@@ -153,27 +163,45 @@ class DatasetSerializer(serializers.ModelSerializer):
     )
 
     def update(self, instance, validated_data):
-        has_data = Record.objects.filter(dataset=instance).count() > 0
-        if has_data:
-            different_type = instance.type != validated_data.get('type')
-            different_data_package = instance.data_package != validated_data.get('data_package')
-            # TODO: implement a smart risk-checking of changing dataset schema when there's data.
-            different_data_package = False
-            if different_type or different_data_package:
-                message = "This dataset already contains records. " \
-                          "You cannot change this field. " \
-                          "In order to change this dataset you first need to delete all its records."
-                response = {}
+        with transaction.atomic():
+            # Lock the dataset row: a record insert (foreign key check) waits until the schema is saved, so the
+            # checked records are all the records.
+            Dataset.objects.select_for_update().get(pk=instance.pk)
+            record_count = Record.objects.filter(dataset=instance).count()
+            if record_count > 0:
+                different_type = instance.type != validated_data.get('type')
                 if different_type:
-                    response['type'] = message
-                if different_data_package:
-                    response['data_package'] = message
-                raise serializers.ValidationError(response)
-        return super(DatasetSerializer, self).update(instance, validated_data)
+                    message = "This dataset already contains records. " \
+                              "You cannot change this field. " \
+                              "In order to change this dataset you first need to delete all its records."
+                    raise serializers.ValidationError({'type': message})
+                data_package = validated_data.get('data_package')
+                if data_package is not None and instance.data_package != data_package:
+                    self.check_schema_impact(instance, data_package, record_count)
+            return super(DatasetSerializer, self).update(instance, validated_data)
+
+    @staticmethod
+    def check_schema_impact(instance, data_package, record_count):
+        """
+        The schema can change as long as the existing records are still valid (see the schema-impact end-point for
+        the details of the invalid records). The records are validated in the request, without a pool of processes,
+        so a dataset of more than DATASET_SCHEMA_CHECK_MAX_RECORDS records must use the schema-impact end-point.
+        """
+        max_records = getattr(settings, 'DATASET_SCHEMA_CHECK_MAX_RECORDS', 10000)
+        if record_count > max_records:
+            message = "This dataset has {count} records. Its schema can only be changed with the schema-impact " \
+                      "end-point (with apply).".format(count=record_count)
+            raise serializers.ValidationError({'data_package': message})
+        summary = SchemaImpactChecker(instance, data_package, strict=False, workers=1).run(sample_size=0)
+        if summary.valid_rows != summary.rows:
+            message = "{invalid} of the {rows} records of this dataset would not be valid with this schema. " \
+                      "Use the schema-impact end-point for the details.".format(
+                        invalid=summary.rows - summary.valid_rows, rows=summary.rows)
+            raise serializers.ValidationError({'data_package': message})
 
     class Meta:
         model = Dataset
-        fields = '__all__'
+        exclude = ('cached_extent', 'extent_stale', 'extent_version')
         validators = [
             serializers.UniqueTogetherValidator(
                 queryset=Dataset.objects.all(),
@@ -330,7 +358,8 @@ class RecordSerializer(serializers.ModelSerializer):
             self.species_naming_facade_class is not None,
             callable(getattr(self.species_naming_facade_class, 'name_id_by_species_name'))
         ]):
-            self.species_name_id_mapping_cached = self.species_naming_facade_class().name_id_by_species_name()
+            with utils_metrics.timer('species'):
+                self.species_name_id_mapping_cached = self.species_naming_facade_class().name_id_by_species_name()
         return self.species_name_id_mapping_cached
 
     def set_fields_from_data(self, instance, validated_data):
@@ -449,3 +478,108 @@ class GeometrySerializer(serializers.Serializer):
 
 class GeoConvertSerializer(GeometrySerializer):
     data = serializers.JSONField(required=False)
+
+
+class SchemaImpactSerializer(serializers.Serializer):
+    data_package = serializers.JSONField()
+    # the schema errors are errors (not warnings) like in a strict upload
+    strict = serializers.BooleanField(default=False)
+    # apply the schema if all the records are valid
+    apply = serializers.BooleanField(default=False)
+
+    def validate_data_package(self, value):
+        dataset = self.context['dataset']
+        Dataset.validate_data_package(value, dataset.type, dataset.project)
+        return value
+
+
+class RecordsCurationSerializer(serializers.Serializer):
+    # a list of record ids or 'all'. The records filters of the query parameters apply too.
+    ids = serializers.JSONField()
+    validated = serializers.BooleanField(required=False)
+    locked = serializers.BooleanField(required=False)
+    # {field: value} merged into the records data. The other fields of the data are not changed.
+    data = serializers.JSONField(required=False)
+
+    def validate_ids(self, value):
+        if value == 'all':
+            return value
+        if not isinstance(value, list) or not all(
+                isinstance(v, six.integer_types) and not isinstance(v, bool) for v in value):
+            raise ValidationError("A list of record ids must be provided or 'all'")
+        return value
+
+    def validate_data(self, value):
+        if not isinstance(value, dict) or not value:
+            raise ValidationError('The data must be an object of {field: value}')
+        try:
+            return validate_data_patch(self.context['dataset'], value)
+        except ValueError as e:
+            raise ValidationError(e.args[0])
+
+    def validate(self, attrs):
+        if not any(key in attrs for key in ('validated', 'locked', 'data')):
+            raise ValidationError('Nothing to update. Set validated, locked or data.')
+        return attrs
+
+
+class RecordClusterSerializer(serializers.Serializer):
+    count = serializers.IntegerField()
+    centroid = serializers_gis.GeometryField()
+    # group by values
+    species_name = serializers.CharField(required=False)
+    dataset = serializers.IntegerField(required=False, source='dataset_id')
+
+
+class ExportJobSerializer(serializers.ModelSerializer):
+    format = serializers.ChoiceField(choices=ExportJob.FORMAT_CHOICES, default=ExportJob.FORMAT_XLSX)
+    filters = serializers.JSONField(required=False)
+    download_url = serializers.SerializerMethodField()
+
+    def get_download_url(self, job):
+        if not job.is_done:
+            return None
+        url = reverse('api:export-job-download', kwargs={'pk': job.pk})
+        request = self.context.get('request')
+        return request.build_absolute_uri(url) if request else url
+
+    def validate_format(self, value):
+        if value == ExportJob.FORMAT_PARQUET and not parquet_available():
+            raise ValidationError(PARQUET_NOT_AVAILABLE_MESSAGE)
+        return value
+
+    def validate_filters(self, value):
+        if value and not isinstance(value, dict):
+            raise ValidationError('The filters must be an object of the records end-point query parameters.')
+        return value or {}
+
+    def validate(self, attrs):
+        try:
+            get_export_queryset(attrs['dataset'], attrs.get('filters') or {})
+        except FilterException as e:
+            raise serializers.ValidationError({'filters': e.detail})
+        return attrs
+
+    class Meta:
+        model = ExportJob
+        fields = ('id', 'dataset', 'user', 'format', 'filters', 'status', 'error', 'created', 'started', 'completed',
+                  'download_url')
+        read_only_fields = ('user', 'status', 'error', 'created', 'started', 'completed')
+
+
+class DeletionJobSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = DeletionJob
+        fields = ('id', 'target', 'object_id', 'ids', 'user', 'status', 'total', 'deleted', 'error', 'created',
+                  'started', 'completed')
+        read_only_fields = fields
+
+
+class SpeciesSummarySerializer(serializers.ModelSerializer):
+    bbox = serializers.ListField(child=serializers.FloatField(), read_only=True)
+
+    class Meta:
+        model = SpeciesSummary
+        fields = ('species_name', 'name_id', 'record_count', 'dataset_count', 'first_observed', 'last_observed',
+                  'bbox')
+        read_only_fields = fields
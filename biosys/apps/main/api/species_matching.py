@@ -0,0 +1,89 @@
+from __future__ import absolute_import, unicode_literals, print_function, division
+
+import logging
+
+from django.db import connection, transaction
+
+from main.models import Dataset, SpeciesSummary
+from main.utils_geo import invalidate_tiles
+from main.utils_species import get_species_facade_class
+
+logger = logging.getLogger(__name__)
+
+# number of (species_name, name_id) pairs per UPDATE statement
+REMATCH_BATCH_SIZE = 1000
+
+RESOLVE_SQL = """
+WITH updated AS (
+    UPDATE main_record AS r SET name_id = v.name_id, last_modified = now()
+    FROM (VALUES {values}) AS v (species_name, name_id)
+    WHERE r.name_id = -1 AND r.species_name = v.species_name
+    RETURNING r.dataset_id
+)
+SELECT dataset_id, count(*) FROM updated GROUP BY dataset_id
+"""
+
+RENAME_SQL = """
+WITH updated AS (
+    UPDATE main_record AS r SET species_name = v.species_name, last_modified = now()
+    FROM (VALUES {values}) AS v (name_id, species_name)
+    WHERE r.name_id = v.name_id AND r.species_name IS DISTINCT FROM v.species_name
+    RETURNING r.dataset_id
+)
+SELECT dataset_id, count(*) FROM updated GROUP BY dataset_id
+"""
+
+
+def rematch_species(species_facade_class=None, batch_size=REMATCH_BATCH_SIZE):
+    """
+    Re-resolve the species of the records against the current species database:
+    - the records with an unknown species (name_id=-1) get the name id of their species name if it is now known.
+    - the records with a name id get the current species name of this name id (renamed species).
+    The species database is loaded once and the distinct (species_name, name_id) of the records are read from the
+    species summary, not from the records. The records are updated with one UPDATE per batch of names.
+    The names that are no longer in the species database are left as they are.
+    :return: a dict {'resolved': number of records, 'renamed': number of records}
+    """
+    species_facade_class = species_facade_class or get_species_facade_class()
+    name_id_by_species_name = species_facade_class().name_id_by_species_name()
+    result = {'resolved': 0, 'renamed': 0}
+    if not name_id_by_species_name:
+        # no species database: nothing can be matched.
+        return result
+    species_name_by_name_id = dict((int(name_id), name) for name, name_id in name_id_by_species_name.items())
+
+    # the candidates. The updates below are conditional: a stale summary can only miss some names.
+    SpeciesSummary.refresh()
+    to_resolve = []
+    to_rename = []
+    for species_name, name_id in SpeciesSummary.objects.order_by().values_list('species_name', 'name_id'):
+        if name_id == -1:
+            if species_name in name_id_by_species_name:
+                to_resolve.append((species_name, int(name_id_by_species_name[species_name])))
+        elif name_id in species_name_by_name_id and species_name_by_name_id[name_id] != species_name:
+            to_rename.append((name_id, species_name_by_name_id[name_id]))
+    # the same name id can appear with several names: one update per name id.
+    to_rename = sorted(set(to_rename))
+
+    updated_datasets = set()
+    for key, sql, pairs, row_sql in [
+        ('resolved', RESOLVE_SQL, to_resolve, '(%s::varchar, %s::integer)'),
+        ('renamed', RENAME_SQL, to_rename, '(%s::integer, %s::varchar)'),
+    ]:
+        for start in range(0, len(pairs), batch_size):
+            batch = pairs[start:start + batch_size]
+            params = [value for pair in batch for value in pair]
+            with transaction.atomic(), connection.cursor() as cursor:
+                cursor.execute(sql.format(values=', '.join([row_sql] * len(batch))), params)
+                for dataset_id, count in cursor.fetchall():
+                    updated_datasets.add(dataset_id)
+                    result[key] += count
+
+    # the species are properties of the vector tiles
+    project_ids = Dataset.objects.filter(pk__in=updated_datasets).values_list('project_id', flat=True).distinct()
+    for project_id in project_ids:
+        invalidate_tiles(project_id)
+    if updated_datasets:
+        SpeciesSummary.refresh()
+    logger.info('Species re-matching: %(resolved)s record(s) resolved, %(renamed)s record(s) renamed', result)
+    return result
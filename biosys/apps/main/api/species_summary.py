@@ -0,0 +1,46 @@
+from __future__ import absolute_import, unicode_literals, print_function, division
+
+import logging
+import threading
+
+from django.conf import settings
+from django.db import connection
+
+from main.models import SpeciesSummary
+
+logger = logging.getLogger(__name__)
+
+REFRESH_RUNNER_THREAD = 'thread'
+REFRESH_RUNNER_WORKER = 'worker'
+REFRESH_RUNNER_SYNC = 'sync'
+
+# at most one refresh thread per process. The advisory lock of SpeciesSummary.refresh protects across processes.
+_refresh_thread_lock = threading.Lock()
+
+
+def request_species_summary_refresh():
+    """
+    Refresh the species summary if the records changed since the last refresh, according to the
+    SPECIES_SUMMARY_REFRESH setting. With the 'thread' runner the refresh is done in the background and the current
+    request reads the previous state of the summary. With the 'worker' runner nothing is done here: the
+    refresh_species_summary command refreshes the summary.
+    """
+    runner = getattr(settings, 'SPECIES_SUMMARY_REFRESH', REFRESH_RUNNER_THREAD)
+    if runner == REFRESH_RUNNER_WORKER or not SpeciesSummary.is_stale():
+        return
+    if runner == REFRESH_RUNNER_SYNC:
+        SpeciesSummary.refresh()
+    elif runner == REFRESH_RUNNER_THREAD and _refresh_thread_lock.acquire(False):
+        thread = threading.Thread(target=_refresh_in_thread)
+        thread.daemon = True
+        thread.start()
+
+
+def _refresh_in_thread():
+    try:
+        SpeciesSummary.refresh()
+    except Exception:
+        logger.exception('Error while refreshing the species summary')
+    finally:
+        connection.close()
+        _refresh_thread_lock.release()
@@ -1,18 +1,27 @@
 import codecs
 import datetime
+import heapq
+import itertools
+import multiprocessing
+import timeit
+from collections import OrderedDict, deque
 from os import path
 
 import datapackage
 from django.conf import settings
+from django.db import connection, connections
 from django.utils import six, timezone
 from django.utils.text import slugify
 from openpyxl import load_workbook
 
+from main import utils_metrics
 from main.api.validators import get_record_validator_for_dataset
 from main.constants import MODEL_SRID
-from main.models import Site, Dataset
+from main.models import Site, Dataset, Project
 from main.utils_data_package import GeometryParser, ObservationSchema, SpeciesObservationSchema, BiosysSchema, \
-    SpeciesNameParser
+    SpeciesNameParser, is_blank_value
+from main.utils_db import bulk_update
+from main.utils_geo import merge_extents
 from main.utils_misc import get_value
 from main.utils_species import HerbieFacade, get_key_for_value
 
@@ -225,9 +234,357 @@ class SiteUploader(FileReader):
         return attributes
 
 
+class _NoStage(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+class NoUploadProfiler(object):
+    """
+    Default profiler of the RecordCreator: does nothing.
+    """
+    _no_stage = _NoStage()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def stage(self, name):
+        return self._no_stage
+
+    def start_row(self, row):
+        pass
+
+    def end_row(self):
+        pass
+
+
+class _Stage(object):
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        self.start = timeit.default_timer()
+        return self
+
+    def __exit__(self, *args):
+        self.profiler.add(self.name, timeit.default_timer() - self.start)
+        return False
+
+
+class UploadProfiler(NoUploadProfiler):
+    """
+    Aggregate the time and the SQL queries of every stage of a records import across all the rows.
+    Usage:
+        with UploadProfiler() as profiler:
+            with profiler.stage('file'):
+                reader = FileReader(file_)
+            for record, result in RecordCreator(dataset, reader, profiler=profiler):
+                ...
+        report = profiler.report()
+    The SQL queries are counted from the connection queries log, the debug cursor is forced while profiling.
+    """
+
+    def __init__(self, slowest_rows=10):
+        self.slowest_rows_count = slowest_rows
+        self.stages = OrderedDict()
+        self.rows = 0
+        self.slowest_rows = []
+        self.seconds = 0
+        self._start = None
+        self._force_debug_cursor = None
+        self._last_query = None
+        self._row = None
+        self._row_start = None
+        self._row_queries = 0
+
+    def __enter__(self):
+        self._force_debug_cursor = connection.force_debug_cursor
+        connection.force_debug_cursor = True
+        self._last_query = connection.queries_log[-1] if connection.queries_log else None
+        self._start = timeit.default_timer()
+        return self
+
+    def __exit__(self, *args):
+        self.seconds += timeit.default_timer() - self._start
+        connection.force_debug_cursor = self._force_debug_cursor
+        return False
+
+    def _new_queries(self):
+        """
+        The number of queries since the last call.
+        Note: the queries log is a bounded deque, we can't rely on its length.
+        """
+        log = connection.queries_log
+        count = 0
+        for query in reversed(log):
+            if query is self._last_query:
+                break
+            count += 1
+        self._last_query = log[-1] if log else None
+        return count
+
+    def stage(self, name):
+        return _Stage(self, name)
+
+    def add(self, name, seconds):
+        stage = self.stages.get(name)
+        if stage is None:
+            stage = self.stages[name] = {'seconds': 0, 'queries': 0, 'calls': 0}
+        queries = self._new_queries()
+        stage['seconds'] += seconds
+        stage['queries'] += queries
+        stage['calls'] += 1
+        self._row_queries += queries
+
+    def start_row(self, row):
+        self._row = row
+        self._row_start = timeit.default_timer()
+        self._row_queries = 0
+
+    def end_row(self):
+        self.rows += 1
+        seconds = timeit.default_timer() - self._row_start
+        item = (seconds, self._row, self._row_queries)
+        if len(self.slowest_rows) < self.slowest_rows_count:
+            heapq.heappush(self.slowest_rows, item)
+        else:
+            heapq.heappushpop(self.slowest_rows, item)
+
+    def report(self):
+        seconds = self.seconds or sum(s['seconds'] for s in self.stages.values())
+        queries = sum(s['queries'] for s in self.stages.values())
+        stages = OrderedDict()
+        for name, stage in self.stages.items():
+            stages[name] = OrderedDict([
+                ('seconds', round(stage['seconds'], 4)),
+                ('percent', round(100 * stage['seconds'] / seconds, 1) if seconds else 0),
+                ('queries', stage['queries']),
+                ('calls', stage['calls']),
+            ])
+        return OrderedDict([
+            ('rows', self.rows),
+            ('seconds', round(seconds, 4)),
+            ('rowsPerSecond', round(self.rows / seconds, 1) if seconds else None),
+            ('queries', queries),
+            ('queriesPerRow', round(queries / self.rows, 2) if self.rows else None),
+            ('stages', stages),
+            ('slowestRows', [
+                OrderedDict([('row', row), ('seconds', round(row_seconds, 4)), ('queries', row_queries)])
+                for row_seconds, row, row_queries in sorted(self.slowest_rows, reverse=True)
+            ]),
+        ])
+
+
+# the validator of a validation worker process, see RecordCreator._validate_in_parallel
+_worker_validator = None
+# the sites by code of a validation worker: the project sites given by the main process and the sites of other
+# projects found since.
+_worker_sites = {}
+_inherited_connections = []
+
+
+def _init_validation_worker(dataset_type, data_package, datum, schema_error_as_warning, species_name_id_mapping,
+                            project_sites=None):
+    """
+    Build the validator once per worker process from the dataset schema. The dataset and project are not saved.
+    The site lookup of a row geometry uses the project sites by code given by the main process (project_sites), a
+    site of another project is queried in a connection of the worker.
+    """
+    global _worker_validator, _worker_sites, _inherited_connections
+    # The forked process inherits the parent db connections. They must not be used (or closed) here: keep a reference
+    # on them so they are not garbage collected and let django open new ones if a site needs to be looked up.
+    _inherited_connections = [conn.connection for conn in connections.all()]
+    for conn in connections.all():
+        conn.connection = None
+    dataset = Dataset(type=dataset_type, data_package=data_package, project=Project(datum=datum))
+    _worker_validator = get_record_validator_for_dataset(dataset, species_name_id_mapping=species_name_id_mapping)
+    _worker_validator.schema_error_as_warning = schema_error_as_warning
+    _worker_sites = dict(project_sites or {})
+    _worker_validator.site_getter = _find_worker_site
+
+
+def _find_worker_site(code):
+    # same lookup as SiteFinder.find_site
+    if is_blank_value(code):
+        return None
+    if code not in _worker_sites:
+        _worker_sites[code] = Site.objects.filter(code=code).first()
+    return _worker_sites[code]
+
+
+def _validate_rows(rows):
+    return [_worker_validator.validate(row) for row in rows]
+
+
+def validate_chunks(chunks, dataset, validator, workers, project_sites=None, profiler=None):
+    """
+    Validate chunks of rows of a dataset in a pool of processes. Used by the upload (RecordCreator) and the schema
+    impact check (see main.api.schema_impact).
+    Every worker builds its own validator from the dataset schema (the dataset doesn't need to be saved), with the
+    schema errors mode and the species mapping of the given validator. The geometry of a row from a site code is
+    looked up in project_sites (the sites of the dataset project by code, see SiteFinder), then in the database.
+    :param chunks: an iterable of lists of rows (data dicts). At most workers + 1 chunks are read ahead, so the rows
+    are not all loaded in memory.
+    :return: a generator of (chunk, validator results), in the chunks order.
+    """
+    profiler = profiler or NoUploadProfiler()
+    pool = multiprocessing.Pool(
+        workers,
+        initializer=_init_validation_worker,
+        initargs=(
+            dataset.type,
+            dataset.data_package,
+            dataset.project.datum,
+            validator.schema_error_as_warning,
+            getattr(validator, 'species_name_id_mapping', None),
+            project_sites
+        )
+    )
+    pending = deque()
+
+    def pop_validated_chunk():
+        chunk, async_result = pending.popleft()
+        with profiler.stage('validation'):
+            return chunk, async_result.get()
+
+    try:
+        for chunk in chunks:
+            pending.append((chunk, pool.apply_async(_validate_rows, (chunk,))))
+            if len(pending) > workers:
+                yield pop_validated_chunk()
+        while pending:
+            yield pop_validated_chunk()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+class SiteFinder(object):
+    """
+    The site lookup of the geometry of the rows of a dataset from a site code: a site of the dataset project first,
+    then of any project. The project sites are loaded with one query on first use.
+    """
+
+    def __init__(self, project):
+        self.project = project
+        self._project_sites = None
+        # the sites of other projects by code (the geometry can come from a site of any project).
+        self._other_sites = {}
+
+    @property
+    def project_sites(self):
+        """
+        :return: the sites of the project by code.
+        """
+        if self._project_sites is None:
+            self._project_sites = dict(
+                (site.code, site) for site in Site.objects.filter(project=self.project)
+            )
+        return self._project_sites
+
+    def find_project_site(self, code):
+        if is_blank_value(code):
+            return None
+        return self.project_sites.get(code)
+
+    def find_site(self, code):
+        site = self.find_project_site(code)
+        if site is None and not is_blank_value(code):
+            if code not in self._other_sites:
+                self._other_sites[code] = Site.objects.filter(code=code).first()
+            site = self._other_sites[code]
+        return site
+
+
+class ValidationSummary(object):
+    """
+    A compact report of the validation of many rows: the errors and warnings grouped by column and message with a
+    sample of the rows concerned.
+    """
+
+    def __init__(self, sample_size=5):
+        self.sample_size = sample_size
+        self.rows = 0
+        self.valid_rows = 0
+        self.errors = OrderedDict()
+        self.warnings = OrderedDict()
+
+    @staticmethod
+    def _add(groups, row, messages, sample_size):
+        for column, message in messages.items():
+            group = groups.get((column, message))
+            if group is None:
+                group = groups[(column, message)] = {'count': 0, 'rows': []}
+            group['count'] += 1
+            if len(group['rows']) < sample_size:
+                group['rows'].append(row)
+
+    def add(self, row, validator_result):
+        self.rows += 1
+        if validator_result.is_valid:
+            self.valid_rows += 1
+        self._add(self.errors, row, validator_result.errors, self.sample_size)
+        self._add(self.warnings, row, validator_result.warnings, self.sample_size)
+
+    @staticmethod
+    def _groups_to_list(groups):
+        return [
+            OrderedDict([('column', column), ('message', message), ('count', group['count']), ('rows', group['rows'])])
+            for (column, message), group in sorted(groups.items(), key=lambda item: -item[1]['count'])
+        ]
+
+    def to_dict(self):
+        return OrderedDict([
+            ('rows', self.rows),
+            ('validRows', self.valid_rows),
+            ('invalidRows', self.rows - self.valid_rows),
+            ('errors', self._groups_to_list(self.errors)),
+            ('warnings', self._groups_to_list(self.warnings)),
+        ])
+
+
 class RecordCreator:
+    UPSERT_BATCH_SIZE = 1000
+    # the record fields set from the uploaded row. Updated on upsert.
+    UPSERT_FIELDS = ['data', 'site', 'datetime', 'geometry', 'species_name', 'name_id', 'source_info',
+                     'last_modified']
+
     def __init__(self, dataset, data_generator,
-                 commit=True, create_site=False, validator=None, species_facade_class=HerbieFacade):
+                 commit=True, create_site=False, validator=None, species_facade_class=HerbieFacade,
+                 profiler=None, batch_size=None, row_offset=0, validation_workers=None, upsert=False):
+        """
+        :param batch_size: if > 1 and commit, the records are saved with bulk inserts of batch_size records. The
+        results of a batch are yielded once the batch is saved.
+        :param upsert: if the dataset has a primary key, the rows are matched on it with the existing records: new
+        rows are inserted, changed records are updated (same id) and unchanged records are not touched. The action is
+        set on every saved record as record.upsert_action ('created', 'updated' or 'unchanged').
+        :param row_offset: the number of data rows before the first row of the generator (when importing a file in
+        chunks). Used for the source_info row.
+        :param validation_workers: number of processes validating the rows in parallel. Default to the
+        UPLOAD_VALIDATION_WORKERS setting. Must be 1 if the creator runs in a daemon process (e.g. a pool worker).
+        """
+        if validation_workers is None:
+            validation_workers = getattr(settings, 'UPLOAD_VALIDATION_WORKERS', 1)
+        self.validation_workers = validation_workers
+        self.validation_chunk_size = getattr(settings, 'UPLOAD_VALIDATION_CHUNK_SIZE', 1000)
+        self.profiler = profiler or NoUploadProfiler()
+        self.batch_size = batch_size if commit and batch_size and batch_size > 1 else None
+        self.upsert = bool(upsert and commit and dataset.has_primary_key)
+        if self.upsert:
+            self.batch_size = self.batch_size or self.UPSERT_BATCH_SIZE
+            self.primary_key_fields = dataset.primary_key_fields
+            self._upserted_keys = set()
+            self._has_updates = False
+            # the index on the primary key is built in the background when the dataset is saved (see main.api.indexes)
+        self.row_offset = row_offset
         self.dataset = dataset
         self.generator = data_generator
         self.create_site = create_site
@@ -238,35 +595,213 @@ class RecordCreator:
         # if species. First load species list from herbie. Should raise an exception if problem.
         self.species_id_by_name = {}
         if dataset.type == Dataset.TYPE_SPECIES_OBSERVATION:
-            self.species_id_by_name = species_facade_class().name_id_by_species_name()
+            with utils_metrics.timer('species'), self.profiler.stage('species_list'):
+                self.species_id_by_name = species_facade_class().name_id_by_species_name()
         # Schema foreign key for site.
         self.site_fk = self.schema.get_fk_for_model('Site')
         self.commit = commit
         self.file_name = self.generator.file_name if hasattr(self.generator, 'file_name') else None
         # Trick: use GeometryParser to get the site code
         self.geo_parser = GeometryParser(self.schema)
+        # bounding box of the created records. Used to expand the dataset extent once at the end.
+        self.extent = None
+        self.sites = SiteFinder(dataset.project)
+        if getattr(self.validator, 'site_getter', False) is None:
+            self.validator.site_getter = self.sites.find_site
 
     def __iter__(self):
-        counter = 0
-        for data in self.generator:
-            counter += 1
-            yield self._create_record(data, counter)
+        # concurrent upserts of the dataset could insert the same new primary key twice
+        session_lock = self._lock_upsert()
+        try:
+            counter = self.row_offset
+            batch = []
+            for data, validator_result in self._validated_rows():
+                counter += 1
+                self.profiler.start_row(counter + 1)
+                result = self._create_record(data, counter, validator_result=validator_result)
+                self.profiler.end_row()
+                if self.batch_size:
+                    batch.append(result)
+                    if len(batch) >= self.batch_size:
+                        for result in self._save_batch(batch):
+                            yield result
+                        batch = []
+                else:
+                    yield result
+            for result in self._save_batch(batch):
+                yield result
+            if self.upsert and self._has_updates:
+                # the updated records may have moved
+                self.dataset.mark_extent_stale()
+            elif self.commit and self.extent:
+                with self.profiler.stage('extent'):
+                    self.dataset.expand_extent(self.extent)
+        finally:
+            if session_lock:
+                with connection.cursor() as cursor:
+                    cursor.execute('SELECT pg_advisory_unlock(%s, %s)', [Dataset.UPSERT_LOCK_ID, self.dataset.pk])
+
+    def _lock_upsert(self):
+        """
+        Serialize the upserts of the dataset: the duplicate primary keys are only detected within an upsert. In a
+        transaction the lock is held until the commit.
+        :return: True if a session lock was taken and must be released.
+        """
+        if not self.upsert:
+            return False
+        with connection.cursor() as cursor:
+            if connection.in_atomic_block:
+                cursor.execute('SELECT pg_advisory_xact_lock(%s, %s)', [Dataset.UPSERT_LOCK_ID, self.dataset.pk])
+                return False
+            cursor.execute('SELECT pg_advisory_lock(%s, %s)', [Dataset.UPSERT_LOCK_ID, self.dataset.pk])
+        return True
 
-    def _create_record(self, row, counter):
+    def _validated_rows(self):
+        """
+        :return: a generator of (row, validator result). The result is None if the row has not been validated yet.
+        """
+        iterator = iter(self.generator)
+        # The workers validate the chunks ahead of the record creation: with create_site they would look up the sites
+        # of a chunk before the sites of the previous chunks are created.
+        if self.validation_workers and self.validation_workers > 1 and not self.create_site:
+            for item in self._validate_in_parallel(iterator):
+                yield item
+            return
+        while True:
+            try:
+                with self.profiler.stage('read'):
+                    data = next(iterator)
+            except StopIteration:
+                return
+            yield data, None
+
+    def _validate_in_parallel(self, iterator):
+        """
+        Validate chunks of rows in a pool of processes (see validate_chunks). The results are yielded in the rows
+        order. The pool is only started if there's more than one chunk of rows.
+        """
+        def read_chunks():
+            while True:
+                with self.profiler.stage('read'):
+                    chunk = list(itertools.islice(iterator, self.validation_chunk_size))
+                if not chunk:
+                    return
+                yield chunk
+
+        chunks = read_chunks()
+        first_chunk = next(chunks, [])
+        if len(first_chunk) < self.validation_chunk_size:
+            # small upload: not worth starting processes.
+            for data in first_chunk:
+                yield data, None
+            return
+        validated_chunks = validate_chunks(itertools.chain([first_chunk], chunks), self.dataset, self.validator,
+                                           self.validation_workers, project_sites=self.sites.project_sites,
+                                           profiler=self.profiler)
+        for chunk, results in validated_chunks:
+            for item in zip(chunk, results):
+                yield item
+
+    def _save_batch(self, batch):
+        if self.upsert:
+            self._upsert_batch(batch)
+            return batch
+        records = [record for record, validator_result in batch if record is not None and validator_result.is_valid]
+        if records:
+            with self.profiler.stage('save'):
+                self.record_model.objects.bulk_create(records)
+        return batch
+
+    def _primary_key(self, data):
+        """
+        The primary key values as text, like data->>'field' in SQL.
+        """
+        key = []
+        for field in self.primary_key_fields:
+            value = data.get(field)
+            if is_blank_value(value):
+                value = None
+            elif isinstance(value, bool):
+                value = 'true' if value else 'false'
+            else:
+                value = six.text_type(value)
+            key.append(value)
+        return tuple(key)
+
+    def _find_records_by_primary_key(self, keys):
+        """
+        :return: a dict primary key -> record id of the existing records (uses the dataset primary key index)
+        """
+        if not keys:
+            return {}
+        expressions = ', '.join(['(data ->> %s)'] * len(self.primary_key_fields))
+        row_sql = '(' + ', '.join(['%s'] * len(self.primary_key_fields)) + ')'
+        sql = 'SELECT id, {expressions} FROM main_record ' \
+              'WHERE dataset_id = %s AND ({expressions}) IN ({values})'.format(
+                expressions=expressions,
+                values=', '.join([row_sql] * len(keys)))
+        params = list(self.primary_key_fields) + [self.dataset.pk] + list(self.primary_key_fields)
+        for key in keys:
+            params += list(key)
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            return dict((tuple(row[1:]), row[0]) for row in cursor.fetchall())
+
+    def _upsert_batch(self, batch):
+        matched = []
+        key_column = self.primary_key_fields[0]
+        for record, validator_result in batch:
+            if record is None or not validator_result.is_valid:
+                continue
+            key = self._primary_key(record.data)
+            if None in key:
+                validator_result.add_column_error(key_column, 'The primary key value is missing')
+            elif key in self._upserted_keys:
+                message = 'Duplicate primary key {}'.format(', '.join(key))
+                validator_result.add_column_error(key_column, message)
+            else:
+                self._upserted_keys.add(key)
+                matched.append((key, record))
+        with self.profiler.stage('match'):
+            existing = self._find_records_by_primary_key([key for key, record in matched])
+        new_records, existing_records = [], []
+        for key, record in matched:
+            record_id = existing.get(key)
+            if record_id is None:
+                record.upsert_action = 'created'
+                new_records.append(record)
+            else:
+                record.id = record_id
+                existing_records.append(record)
+        with self.profiler.stage('save'):
+            if new_records:
+                self.record_model.objects.bulk_create(new_records)
+            # only the records whose data changed are written
+            updated = set(bulk_update(existing_records, self.UPSERT_FIELDS,
+                                      where='t."data" IS DISTINCT FROM v."data"'))
+        for record in existing_records:
+            record.upsert_action = 'updated' if record.id in updated else 'unchanged'
+        if updated:
+            self._has_updates = True
+
+    def _create_record(self, row, counter, validator_result=None):
         """
         :param row: a {column(string): value(string)} dictionary
+        :param validator_result: the result of the row validation if already done.
         :return: record, RecordValidatorResult
         """
-        validator_result = self.validator.validate(row)
+        profiler = self.profiler
+        if validator_result is None:
+            with profiler.stage('validation'):
+                validator_result = self.validator.validate(row)
         record = None
         # The row values comes as string but we want to save numeric field as json number not string to allow a
         # correct ordering. The next call will cast the numeric field into python int or float.
-        row = self.schema.cast_numbers(row)
+        with profiler.stage('cast_numbers'):
+            row = self.schema.cast_numbers(row)
         try:
             if validator_result.is_valid:
-                site = self._get_or_create_site(row)
                 record = self.record_model(
-                    site=site,
                     dataset=self.dataset,
                     data=row,
                     source_info={
@@ -274,55 +809,78 @@ class RecordCreator:
                         'row': counter + 1  # add one to match excel/csv row id
                     }
                 )
-                # specific fields
-                if self.dataset.type == Dataset.TYPE_OBSERVATION or self.dataset.type == Dataset.TYPE_SPECIES_OBSERVATION:
-                    observation_date = self.schema.cast_record_observation_date(row)
-                    if observation_date:
-                        # convert to datetime with timezone awareness
-                        if isinstance(observation_date, datetime.date):
-                            observation_date = datetime.datetime.combine(observation_date, datetime.time.min)
-                        tz = self.dataset.project.timezone or timezone.get_current_timezone()
-                        record.datetime = timezone.make_aware(observation_date, tz)
-
-                    # geometry
-                    geometry = self.schema.cast_geometry(row, default_srid=self.dataset.project.datum or MODEL_SRID)
-                    record.geometry = geometry
-                    if self.dataset.type == Dataset.TYPE_SPECIES_OBSERVATION:
-                        # species stuff. Lookup for species match in herbie.
-                        # either a species name or a nameId
-                        species_name = self.schema.cast_species_name(row)
-                        name_id = self.schema.cast_species_name_id(row)
-                        # name id takes precedence
-                        if name_id:
-                            species_name = get_key_for_value(self.species_id_by_name, int(name_id), None)
-                            if not species_name:
-                                column_name = self.schema.species_name_parser.name_id_field.name
-                                message = "Cannot find a species with nameId={}".format(name_id)
-                                validator_result.add_column_error(column_name, message)
-                                return record, validator_result
-                        elif species_name:
-                            name_id = int(self.species_id_by_name.get(species_name, -1))
-                        record.species_name = species_name
-                        record.name_id = name_id
+                if not self.set_derived_fields(record, row, validator_result):
+                    return record, validator_result
                 if self.commit:
-                    record.save()
+                    if not self.batch_size:
+                        with profiler.stage('save'):
+                            record.save()
+                    if record.geometry:
+                        self.extent = merge_extents(self.extent, record.geometry.extent)
         except Exception as e:
             # catch all errors
             message = str(e)
             validator_result.add_column_error('unknown', message)
         return record, validator_result
 
-    def _get_or_create_site(self, row):
+    def set_derived_fields(self, record, row, validator_result):
+        """
+        Set the record fields derived from the row: site, datetime, geometry, species name and name id.
+        Also used to reprocess existing records (see main.api.reprocessors).
+        :return: False if the species name id is unknown (the error is added to the validator result). Will throw an
+        exception if the date or geometry can't be cast.
+        """
+        profiler = self.profiler
+        with profiler.stage('site'):
+            record.site = self._get_or_create_site(row, validator_result)
+        # specific fields
+        if self.dataset.type == Dataset.TYPE_OBSERVATION or self.dataset.type == Dataset.TYPE_SPECIES_OBSERVATION:
+            with profiler.stage('date'):
+                observation_date = self.schema.cast_record_observation_date(row)
+                if observation_date:
+                    # convert to datetime with timezone awareness
+                    if isinstance(observation_date, datetime.date):
+                        observation_date = datetime.datetime.combine(observation_date, datetime.time.min)
+                    tz = self.dataset.project.timezone or timezone.get_current_timezone()
+                    record.datetime = timezone.make_aware(observation_date, tz)
+
+            # geometry
+            with profiler.stage('geometry'):
+                geometry = self.schema.cast_geometry(
+                    row, default_srid=self.dataset.project.datum or MODEL_SRID, site_getter=self.sites.find_site)
+            record.geometry = geometry
+            if self.dataset.type == Dataset.TYPE_SPECIES_OBSERVATION:
+                # species stuff. Lookup for species match in herbie.
+                # either a species name or a nameId
+                with profiler.stage('species'):
+                    species_name = self.schema.cast_species_name(row)
+                    name_id = self.schema.cast_species_name_id(row)
+                # name id takes precedence
+                if name_id:
+                    species_name = get_key_for_value(self.species_id_by_name, int(name_id), None)
+                    if not species_name:
+                        column_name = self.schema.species_name_parser.name_id_field.name
+                        message = "Cannot find a species with nameId={}".format(name_id)
+                        validator_result.add_column_error(column_name, message)
+                        return False
+                elif species_name:
+                    name_id = int(self.species_id_by_name.get(species_name, -1))
+                record.species_name = species_name
+                record.name_id = name_id
+        return True
+
+    def _get_or_create_site(self, row, validator_result):
         site = None
         if self.geo_parser.is_valid() and self.geo_parser.is_site_code:
             site_code = self.geo_parser.get_site_code(row)
-            kwargs = {
-                "project": self.dataset.project,
-                "code": site_code
-            }
-            site = Site.objects.filter(**kwargs).first()
-            if site is None and self.create_site:
-                site = Site.objects.create(**kwargs)
+            site = self.sites.find_project_site(site_code)
+            if site is None and self.create_site and not is_blank_value(site_code):
+                if self.commit:
+                    site = Site.objects.create(project=self.dataset.project, code=site_code)
+                    self.sites.project_sites[site_code] = site
+                else:
+                    message = "The site {} does not exist and will be created".format(site_code)
+                    validator_result.add_column_warning(self.geo_parser.site_code_field.name, message)
         return site
 
 
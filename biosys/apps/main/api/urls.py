@@ -17,6 +17,8 @@ router.register(r'records?', api_views.RecordViewSet, 'record')
 router.register(r'media', api_views.MediaViewSet, 'media')
 router.register(r'project-media', api_views.ProjectMediaViewSet, 'project-media')
 router.register(r'dataset-media', api_views.DatasetMediaViewSet, 'dataset-media')
+router.register(r'export-jobs?', api_views.ExportJobViewSet, 'export-job')
+router.register(r'deletion-jobs?', api_views.DeletionJobViewSet, 'deletion-job')
 
 
 url_patterns = [
@@ -24,12 +26,23 @@ url_patterns = [
     url(r'projects?/(?P<pk>\d+)/sites/?', api_views.ProjectSitesView.as_view(), name='project-sites'),  # bulk sites
     url(r'projects?/(?P<pk>\d+)/upload-sites/?', api_views.ProjectSitesUploadView.as_view(),
         name='upload-sites'),  # file upload for sites
+    url(r'projects?/(?P<pk>\d+)/export/?', api_views.ProjectExportView.as_view(),
+        name='project-export'),  # zipped data package of all the datasets
+    url(r'datasets?/(?P<pk>\d+)/records/aggregate/?', api_views.DatasetRecordsAggregateView.as_view(),
+        name='dataset-records-aggregate'),
     url(r'datasets?/(?P<pk>\d+)/records/?', api_views.DatasetRecordsView.as_view(), name='dataset-records'),
+    # vector tiles
+    url(r'datasets?/(?P<pk>\d+)/tiles/(?P<z>\d+)/(?P<x>\d+)/(?P<y>\d+)\.pbf$', api_views.DatasetTilesView.as_view(),
+        name='dataset-tiles'),
+    url(r'projects?/(?P<pk>\d+)/tiles/(?P<z>\d+)/(?P<x>\d+)/(?P<y>\d+)\.pbf$', api_views.ProjectTilesView.as_view(),
+        name='project-tiles'),
     # upload data files
     url(r'datasets?/(?P<pk>\d+)/upload-records/?', api_views.DatasetUploadRecordsView.as_view(),
         name='dataset-upload'),
     url(r'statistics/?', api_views.StatisticsView.as_view(), name="statistics"),
+    url(r'metrics/?', api_views.MetricsView.as_view(), name="metrics"),
     url(r'whoami/?', api_views.WhoamiView.as_view(), name="whoami"),
+    url(r'species/(?P<species_name>[^/]+)/?$', api_views.SpeciesDetailView.as_view(), name="species-detail"),
     url(r'species/?', api_views.SpeciesView.as_view(), name="species"),
     url(r'logout/?', api_views.LogoutView.as_view(), name="logout"),
     # utils
@@ -104,6 +104,8 @@ class ObservationValidator(GenericRecordValidator):
         self.site_col = self.schema.site_code_field.name if self.schema.site_code_field else None
         self.geometry_parser = self.schema.geometry_parser
         self.date_parser = self.schema.date_parser
+        # optional function site_code -> Site (see main.api.uploaders.SiteFinder)
+        self.site_getter = kwargs.get('site_getter')
 
     def validate(self, data):
         result = super(ObservationValidator, self).validate(data)
@@ -137,7 +139,7 @@ class ObservationValidator(GenericRecordValidator):
     def validate_geometry(self, data):
         result = RecordValidatorResult()
         try:
-            self.schema.cast_geometry(data, default_srid=self.default_srid or MODEL_SRID)
+            self.schema.cast_geometry(data, default_srid=self.default_srid or MODEL_SRID, site_getter=self.site_getter)
         except Exception as e:
             msg = str(e)
             # the fields involved in the geometry can be many.
@@ -150,7 +152,7 @@ class ObservationValidator(GenericRecordValidator):
 
 class SpeciesObservationValidator(ObservationValidator):
     def __init__(self, dataset, schema_error_as_warning=True, **kwargs):
-        super(SpeciesObservationValidator, self).__init__(dataset, schema_error_as_warning)
+        super(SpeciesObservationValidator, self).__init__(dataset, schema_error_as_warning, **kwargs)
         self.parser = self.schema.species_name_parser
         self.species_name_id_mapping = kwargs.get('species_name_id_mapping')
 
@@ -1,34 +1,51 @@
 from __future__ import absolute_import, unicode_literals, print_function, division
 
 import datetime
+import hashlib
 import logging
 from collections import OrderedDict
 from os import path
 
 from django.contrib.auth import get_user_model, logout
+from django.core.cache import cache
 from django.core.files.uploadhandler import TemporaryFileUploadHandler
-from django.db.models import Q
+from django.db import transaction
+from django.db.models import Q, Max, Count
+from django.http import HttpResponse
 from django.shortcuts import get_object_or_404
+from django.utils.text import slugify
 from django.conf import settings
 from dry_rest_permissions.generics import DRYPermissions
-from rest_framework import viewsets, generics, status
+from rest_framework import viewsets, generics, status, mixins
+from rest_framework.decorators import action
 from rest_framework.parsers import MultiPartParser, FormParser, FileUploadParser, JSONParser
 from rest_framework.permissions import IsAuthenticated, BasePermission, SAFE_METHODS
 from rest_framework.views import APIView, Response
 from rest_framework.settings import import_from_string
 
-from main import models, constants
+from main import models, constants, utils_metrics
 from main.api import serializers
 from main.api import filters
 from main.api.helpers import to_bool
-from main.api.uploaders import SiteUploader, FileReader, RecordCreator, DataPackageBuilder
+from main.api.uploaders import SiteUploader, FileReader, RecordCreator, DataPackageBuilder, UploadProfiler, \
+    NoUploadProfiler, ValidationSummary
 from main.api.validators import get_record_validator_for_dataset
-from main.models import Project, Site, Dataset, Record
+from main.api.curation import curate_records, CurationError
+from main.api.aggregations import aggregate_records, get_aggregation_params
+from main.api.schema_impact import SchemaImpactChecker
+from main.api.species_summary import request_species_summary_refresh
+from main.api.deletions import BulkDeleter, bulk_delete, use_deletion_job, request_deletion, cancel_deletion_job
+from main.models import Project, Site, Dataset, Record, SpeciesSummary
 from main.utils_auth import is_admin
-from main.api.exporters import DefaultExporter
+from main.api.export_jobs import get_exporter_class, find_export_job, request_export, export_job_file_response, \
+    export_file_response, delete_export_jobs
+from main.api.exporters import parquet_available, PARQUET_NOT_AVAILABLE_MESSAGE, ProjectDataPackageExporter
 from main.utils_http import WorkbookResponse, CSVFileResponse
 from main.utils_species import NoSpeciesFacade
+from main.utils_zip import ZipStreamResponse
 from main.utils_misc import search_json_fields, order_by_json_field
+from main.utils_geo import is_valid_tile, queryset_to_mvt, get_tile_generation, invalidate_tiles, parse_bbox, \
+    cluster_queryset
 
 
 logger = logging.getLogger(__name__)
@@ -65,6 +82,38 @@ class UserPermission(BasePermission):
         return request.method in SAFE_METHODS or is_admin(request.user) or is_owner
 
 
+_timed_serializer_classes = {}
+
+
+def timed_serializer_class(serializer_class):
+    """
+    :return: a subclass of serializer_class that adds its to_representation time to the request 'serialization' metric.
+    """
+    timed_class = _timed_serializer_classes.get(serializer_class)
+    if timed_class is None:
+        def to_representation(self, instance):
+            with utils_metrics.timer('serialization', count=False):
+                return super(timed_class, self).to_representation(instance)
+
+        # same name so the swagger definitions don't change.
+        timed_class = type(serializer_class.__name__, (serializer_class,), {'to_representation': to_representation})
+        _timed_serializer_classes[serializer_class] = timed_class
+    return timed_class
+
+
+class MetricsMixin(object):
+    """
+    Measure the serialization time of the view when the request metrics are enabled
+    (see main.middleware.RequestMetricsMiddleware).
+    """
+
+    def get_serializer_class(self):
+        serializer_class = super(MetricsMixin, self).get_serializer_class()
+        if utils_metrics.current_metrics() is None:
+            return serializer_class
+        return timed_serializer_class(serializer_class)
+
+
 class UserViewSet(viewsets.ModelViewSet):
     permission_classes = (IsAuthenticated, UserPermission,)
     queryset = get_user_model().objects.all()
@@ -78,19 +127,38 @@ class UserViewSet(viewsets.ModelViewSet):
             return self.serializer_class
 
 
-class ProgramViewSet(viewsets.ModelViewSet):
+def bulk_delete_response(request, target, obj, count, ids=None):
+    """
+    Delete in the request or, if more than BULK_DELETE_JOB_THRESHOLD records are affected, in a background job.
+    In that case the response is a 202 with the job (see DeletionJobViewSet).
+    :param count: the number of records affected by the delete
+    """
+    if use_deletion_job(count):
+        job = request_deletion(target, obj, ids=ids, total=count, user=request.user)
+        serializer = serializers.DeletionJobSerializer(job, context={'request': request})
+        return Response(serializer.data, status=status.HTTP_202_ACCEPTED)
+    bulk_delete(target, obj.pk, ids=ids)
+    return Response(status=status.HTTP_204_NO_CONTENT)
+
+
+class ProgramViewSet(MetricsMixin, viewsets.ModelViewSet):
     permission_classes = (IsAuthenticated, DRYPermissions)
     queryset = models.Program.objects.all()
     serializer_class = serializers.ProgramSerializer
     filter_class = filters.ProgramFilterSet
 
 
-class ProjectViewSet(viewsets.ModelViewSet):
+class ProjectViewSet(MetricsMixin, viewsets.ModelViewSet):
     permission_classes = (IsAuthenticated, DRYPermissions)
     queryset = models.Project.objects.all()
     serializer_class = serializers.ProjectSerializer
     filter_class = filters.ProjectFilterSet
 
+    def destroy(self, request, *args, **kwargs):
+        project = self.get_object()
+        count = Record.objects.filter(dataset__project=project).count()
+        return bulk_delete_response(request, models.DeletionJob.TARGET_PROJECT, project, count)
+
 
 class ProjectPermission(BasePermission):
     def has_permission(self, request, view):
@@ -101,9 +169,10 @@ class ProjectPermission(BasePermission):
             or (hasattr(view, 'project') and view.project and view.project.is_custodian(user))
 
 
-class ProjectSitesView(generics.ListCreateAPIView, generics.DestroyAPIView):
+class ProjectSitesView(MetricsMixin, generics.ListCreateAPIView, generics.DestroyAPIView):
     permission_classes = (IsAuthenticated, ProjectPermission)
     serializer_class = serializers.SiteSerializer
+    filter_class = filters.SiteFilterSet
 
     def __init__(self, **kwargs):
         super(ProjectSitesView, self).__init__(**kwargs)
@@ -130,16 +199,40 @@ class ProjectSitesView(generics.ListCreateAPIView, generics.DestroyAPIView):
                 r['project'] = self.project.pk
         return ser
 
+    def perform_create(self, serializer):
+        super(ProjectSitesView, self).perform_create(serializer)
+        invalidate_tiles(self.project.pk)
+
     def destroy(self, request, *args, **kwargs):
         site_ids = request.data
         if isinstance(site_ids, list):
             qs = Site.objects.filter(project=self.project, id__in=site_ids)
         elif site_ids == 'all':
             qs = Site.objects.filter(project=self.project)
+            site_ids = None
         else:
             return Response("A list of site ids must be provided or 'all'", status=status.HTTP_400_BAD_REQUEST)
-        qs.delete()
-        return Response(status=status.HTTP_204_NO_CONTENT)
+        # the cost is in setting the site of the records to null
+        count = Record.objects.filter(site__in=qs).count()
+        return bulk_delete_response(request, models.DeletionJob.TARGET_SITES, self.project, count, ids=site_ids)
+
+
+class ProjectExportView(APIView):
+    """
+    Download all the datasets and sites of a project as a zipped data package.
+    The zip is generated on the fly and streamed.
+    """
+    permission_classes = (IsAuthenticated,)
+
+    def get(self, request, *args, **kwargs):
+        project = get_object_or_404(models.Project, pk=kwargs.get('pk'))
+        exporter = ProjectDataPackageExporter(
+            project,
+            exporter_class=get_exporter_class(),
+            workers=settings.PROJECT_EXPORT_WORKERS
+        )
+        file_name = '{}_{}.zip'.format(slugify(project.name), datetime.datetime.now().strftime('%Y-%m-%d-%H%M%S'))
+        return ZipStreamResponse(exporter.entries(), file_name)
 
 
 class ProjectSitesUploadView(APIView):
@@ -181,15 +274,20 @@ class ProjectSitesUploadView(APIView):
                 result['error'] = str(error)
             data[row] = result
         uploader.close()
+        invalidate_tiles(self.project.pk)
         status_code = status.HTTP_200_OK if not has_error else status.HTTP_400_BAD_REQUEST
         return Response(data, status=status_code)
 
 
-class SiteViewSet(viewsets.ModelViewSet):
+class SiteViewSet(MetricsMixin, viewsets.ModelViewSet):
     permission_classes = (IsAuthenticated, DRYPermissions)
     queryset = models.Site.objects.all()
     serializer_class = serializers.SiteSerializer
-    filter_fields = ('id', 'name', 'code', 'project__name', 'project__code', 'project__id')
+    filter_class = filters.SiteFilterSet
+
+    def perform_create(self, serializer):
+        site = serializer.save()
+        invalidate_tiles(site.project_id)
 
     def perform_update(self, serializer):
         """
@@ -206,15 +304,61 @@ class SiteViewSet(viewsets.ModelViewSet):
         serializer.save()
         instance.refresh_from_db()
         if instance.geometry is not None:
+            for dataset in models.Dataset.objects.filter(pk__in=records.values('dataset_id')):
+                dataset.mark_extent_stale()
             records.update(geometry=instance.geometry)
+        invalidate_tiles(instance.project_id)
 
+    def perform_destroy(self, instance):
+        project_id = instance.project_id
+        # don't load the site records to set their site to null
+        BulkDeleter().delete_sites(Site.objects.filter(pk=instance.pk))
+        invalidate_tiles(project_id)
 
-class DatasetViewSet(viewsets.ModelViewSet):
+
+class DatasetViewSet(MetricsMixin, viewsets.ModelViewSet):
     permission_classes = (IsAuthenticated, DRYPermissions)
     serializer_class = serializers.DatasetSerializer
     filter_class = filters.DatasetFilterSet
     queryset = models.Dataset.objects.all().distinct()
 
+    def destroy(self, request, *args, **kwargs):
+        dataset = self.get_object()
+        return bulk_delete_response(request, models.DeletionJob.TARGET_DATASET, dataset, dataset.record_count)
+
+    @action(detail=True, methods=['post'], url_path='schema-impact')
+    def schema_impact(self, request, *args, **kwargs):
+        """
+        Validate the records of the dataset against a proposed data package, without changing anything.
+        Body: {'data_package': {...}, 'strict': false, 'apply': false}
+        With apply=true the data package is saved if all the records are valid.
+        :return: a summary of the validation (see ValidationSummary, the rows are the record ids) with 'safe': true if
+        all the records are valid and 'applied'.
+        """
+        dataset = self.get_object()
+        serializer = serializers.SchemaImpactSerializer(data=request.data, context={'dataset': dataset})
+        serializer.is_valid(raise_exception=True)
+        data_package = serializer.validated_data['data_package']
+        checker = SchemaImpactChecker(dataset, data_package, strict=serializer.validated_data['strict'])
+        applied = False
+        if serializer.validated_data['apply']:
+            with transaction.atomic():
+                # no record can be added (foreign key check on the locked row) between the check and the save.
+                Dataset.objects.select_for_update().get(pk=dataset.pk)
+                summary = checker.run()
+                safe = summary.valid_rows == summary.rows
+                if safe:
+                    dataset.data_package = data_package
+                    dataset.save(update_fields=['data_package'])
+                    applied = True
+        else:
+            summary = checker.run()
+            safe = summary.valid_rows == summary.rows
+        data = summary.to_dict()
+        data['safe'] = safe
+        data['applied'] = applied
+        return Response(data)
+
 
 class DatasetRecordsPermission(BasePermission):
     def has_permission(self, request, view):
@@ -235,7 +379,7 @@ class SpeciesMixin(object):
             logger.exception(msg)
 
 
-class DatasetRecordsView(generics.ListAPIView, generics.DestroyAPIView, SpeciesMixin):
+class DatasetRecordsView(MetricsMixin, generics.ListAPIView, generics.DestroyAPIView, SpeciesMixin):
     permission_classes = (IsAuthenticated, DatasetRecordsPermission)
     # TODO: the filters don't appear in the swagger
     filter_class = filters.RecordFilterSet
@@ -313,18 +457,190 @@ class DatasetRecordsView(generics.ListAPIView, generics.DestroyAPIView, SpeciesM
             qs = Record.objects.filter(dataset=self.dataset, id__in=record_ids)
         elif record_ids == 'all':
             qs = Record.objects.filter(dataset=self.dataset)
+            record_ids = None
         else:
             return Response("A list of record ids must be provided or 'all'", status=status.HTTP_400_BAD_REQUEST)
-        qs.delete()
-        return Response(status=status.HTTP_204_NO_CONTENT)
+        return bulk_delete_response(request, models.DeletionJob.TARGET_RECORDS, self.dataset, qs.count(),
+                                    ids=record_ids)
+
+    def patch(self, request, *args, **kwargs):
+        """
+        Bulk curation of the records: set the validated and/or locked flags or patch some fields of the data.
+        Body: {'ids': [record ids] or 'all', 'validated': bool, 'locked': bool, 'data': {field: value}}
+        The records filters of the query parameters apply (e.g. ?data.Count__gt=10). Only the patched fields are
+        validated. The derived fields (date, geometry, site, species) are recomputed if a field they come from is
+        patched.
+        :return: {'updated': number of records, 'reprocessed': number of records with changed derived fields}
+        """
+        serializer = serializers.RecordsCurationSerializer(data=request.data, context={'dataset': self.dataset})
+        serializer.is_valid(raise_exception=True)
+        params = serializer.validated_data
+        queryset = self.filter_queryset(self.get_queryset())
+        if params['ids'] != 'all':
+            queryset = queryset.filter(id__in=params['ids'])
+        try:
+            result = curate_records(self.dataset, queryset, validated=params.get('validated'),
+                                    locked=params.get('locked'), data=params.get('data'),
+                                    species_facade_class=self.species_facade_class)
+        except CurationError as e:
+            return Response({'records': e.errors}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(result)
+
+
+def aggregate_response(queryset, dataset, query_params):
+    try:
+        groups = aggregate_records(queryset, dataset=dataset, **get_aggregation_params(query_params))
+    except ValueError as e:
+        return Response(str(e), status=status.HTTP_400_BAD_REQUEST)
+    return Response(groups)
+
+
+class DatasetRecordsAggregateView(DatasetRecordsView):
+    """
+    Aggregation of the dataset records. See RecordViewSet.aggregate.
+    """
+    http_method_names = ['get', 'head', 'options']
+
+    def get(self, request, *args, **kwargs):
+        queryset = self.filter_queryset(self.get_queryset())
+        return aggregate_response(queryset, self.dataset, request.query_params)
+
+
+class TileView(generics.GenericAPIView):
+    """
+    Base view for the Mapbox vector tiles end-points (https://github.com/mapbox/vector-tile-spec).
+    The url must provide the z, x and y of the tile (osm/google scheme).
+    Tiles are cached. The cache key includes the query parameters and the version of the data.
+    """
+    permission_classes = (IsAuthenticated,)
+    filter_class = filters.RecordFilterSet
+    content_type = 'application/vnd.mapbox-vector-tile'
+    cache_prefix = 'tiles'
+    # columns of the records and sites exposed as tile feature attributes
+    record_properties = ('id', 'dataset_id', 'site_id', 'species_name', 'name_id', 'datetime')
+    site_properties = ('id', 'code', 'name')
+
+    def get_object(self):
+        raise NotImplementedError('`get_object()` must be implemented.')
+
+    def get_project(self):
+        raise NotImplementedError('`get_project()` must be implemented.')
+
+    def get_queryset(self):
+        raise NotImplementedError('`get_queryset()` must be implemented.')
+
+    def build_tile(self, z, x, y):
+        """
+        :return: the tile content as bytes
+        """
+        return queryset_to_mvt(self.filter_queryset(self.get_queryset()), 'records', z, x, y,
+                               properties=self.record_properties)
+
+    def get_data_version(self):
+        """
+        A string that changes when the data of the tile may have changed.
+        Computing the records statistics is not free, so the version is also cached for a short time.
+        """
+        obj = self.get_object()
+        key = '{prefix}-version:{model}:{pk}'.format(prefix=self.cache_prefix, model=obj._meta.model_name, pk=obj.pk)
+        version = cache.get(key)
+        if version is None:
+            stats = self.get_queryset().aggregate(count=Count('id'), last_modified=Max('last_modified'))
+            version = '{count}-{last_modified}'.format(
+                count=stats['count'],
+                last_modified=stats['last_modified'].isoformat() if stats['last_modified'] else ''
+            )
+            cache.set(key, version, settings.TILE_VERSION_CACHE_TIMEOUT)
+        return '{}-{}'.format(get_tile_generation(self.get_project().pk), version)
+
+    def get_cache_key(self, z, x, y):
+        obj = self.get_object()
+        query = sorted(self.request.query_params.lists())
+        digest = hashlib.md5('{version}:{query}'.format(
+            version=self.get_data_version(),
+            query=query
+        ).encode('utf-8')).hexdigest()
+        return '{prefix}:{model}:{pk}:{z}/{x}/{y}:{digest}'.format(
+            prefix=self.cache_prefix,
+            model=obj._meta.model_name,
+            pk=obj.pk,
+            z=z, x=x, y=y,
+            digest=digest
+        )
+
+    def get(self, request, *args, **kwargs):
+        z, x, y = int(kwargs.get('z')), int(kwargs.get('x')), int(kwargs.get('y'))
+        if not is_valid_tile(z, x, y):
+            return Response("Invalid tile {}/{}/{}".format(z, x, y), status=status.HTTP_400_BAD_REQUEST)
+        key = self.get_cache_key(z, x, y)
+        tile = cache.get(key)
+        if tile is None:
+            tile = self.build_tile(z, x, y)
+            cache.set(key, tile, settings.TILE_CACHE_TIMEOUT)
+        if not tile:
+            return HttpResponse(status=status.HTTP_204_NO_CONTENT)
+        return HttpResponse(tile, content_type=self.content_type)
+
+
+class DatasetTilesView(TileView):
+    """
+    Vector tiles of the records geometry of a dataset.
+    The tiles have one layer: 'records'. All the record filters can be applied.
+    """
+
+    def dispatch(self, request, *args, **kwargs):
+        self.dataset = get_object_or_404(models.Dataset, pk=kwargs.get('pk'))
+        return super(DatasetTilesView, self).dispatch(request, *args, **kwargs)
+
+    def get_object(self):
+        return self.dataset
+
+    def get_project(self):
+        return self.dataset.project
+
+    def get_queryset(self):
+        return self.dataset.record_queryset
+
+
+class ProjectTilesView(TileView):
+    """
+    Vector tiles of a project.
+    The tiles have two layers: 'sites' and 'records'. The record filters apply only to the records layer.
+    """
+
+    def dispatch(self, request, *args, **kwargs):
+        self.project = get_object_or_404(models.Project, pk=kwargs.get('pk'))
+        return super(ProjectTilesView, self).dispatch(request, *args, **kwargs)
+
+    def get_object(self):
+        return self.project
+
+    def get_project(self):
+        return self.project
+
+    def get_queryset(self):
+        return Record.objects.filter(dataset__project=self.project)
 
+    def build_tile(self, z, x, y):
+        sites_layer = queryset_to_mvt(Site.objects.filter(project=self.project), 'sites', z, x, y,
+                                      properties=self.site_properties)
+        # MVT layers can be concatenated
+        return sites_layer + super(ProjectTilesView, self).build_tile(z, x, y)
 
-class RecordViewSet(viewsets.ModelViewSet, SpeciesMixin):
+
+class RecordViewSet(MetricsMixin, viewsets.ModelViewSet, SpeciesMixin):
     # TODO: implement a patch for the data JSON field. Ability to partially update some of the data properties.
     permission_classes = (IsAuthenticated, DRYPermissions)
     queryset = models.Record.objects.all()
     serializer_class = serializers.RecordSerializer
     filter_class = filters.RecordFilterSet
+    # clustering
+    CLUSTER_CELLS_PER_TILE = 8
+    CLUSTER_DEFAULT_GRID = 1.0  # degree
+    CLUSTER_GROUP_BY = {
+        'species_name': 'species_name',
+        'dataset': 'dataset_id'
+    }
 
     def __init__(self, **kwargs):
         super(RecordViewSet, self).__init__(**kwargs)
@@ -380,26 +696,25 @@ class RecordViewSet(viewsets.ModelViewSet, SpeciesMixin):
     def list(self, request, *args, **kwargs):
         # don't use 'format' param as it's kind of reserved by DRF
         output = self.request.query_params.get('output')
-        if output in ['xlsx', 'csv']:
+        if output in ['xlsx', 'csv', 'parquet']:
             if not self.dataset:
                 return Response(status=status.HTTP_400_BAD_REQUEST, data="No dataset specified")
+            if output == 'parquet' and not parquet_available():
+                return Response(status=status.HTTP_501_NOT_IMPLEMENTED, data=PARQUET_NOT_AVAILABLE_MESSAGE)
+            # serve the file of a previous identical export if the records haven't changed since.
+            job = find_export_job(self.dataset, output, request.query_params)
+            if job is not None and job.is_done:
+                return export_job_file_response(job)
             qs = self.filter_queryset(self.get_queryset())
-
-            # exporter class
-            exporter_class = DefaultExporter
-            if hasattr(settings, 'EXPORTER_CLASS') and settings.EXPORTER_CLASS:
-                try:
-                    exporter_class = import_from_string(settings.EXPORTER_CLASS, 'EXPORTER_CLASS')
-                except Exception:
-                    logger.exception("Error while importing exporter class: {}".format(settings.EXPORTER_CLASS))
-
-            exporter = exporter_class(self.dataset, qs)
+            exporter = get_exporter_class()(self.dataset, qs)
             now = datetime.datetime.now()
             file_name = self.dataset.name + '_' + now.strftime('%Y-%m-%d-%H%M%S')
             if output == 'xlsx':
                 file_name += '.xlsx'
                 wb = exporter.to_workbook()
                 response = WorkbookResponse(wb, file_name)
+            elif output == 'parquet':
+                response = export_file_response(exporter, output, file_name + '.parquet')
             else:
                 # csv
                 file_name += '.csv'
@@ -414,6 +729,160 @@ class RecordViewSet(viewsets.ModelViewSet, SpeciesMixin):
         self.dataset = instance.dataset
         return super(RecordViewSet, self).update(request, *args, **kwargs)
 
+    def perform_create(self, serializer):
+        instance = serializer.save()
+        if instance.geometry:
+            instance.dataset.expand_extent(instance.geometry.extent)
+
+    def perform_update(self, serializer):
+        previous_geometry = serializer.instance.geometry
+        instance = serializer.save()
+        if instance.geometry != previous_geometry:
+            instance.dataset.mark_extent_stale()
+
+    def perform_destroy(self, instance):
+        dataset = instance.dataset
+        super(RecordViewSet, self).perform_destroy(instance)
+        if instance.geometry:
+            dataset.mark_extent_stale()
+
+    @action(detail=False, methods=['get'])
+    def aggregate(self, request, *args, **kwargs):
+        """
+        Count the records by group and compute metrics on numeric data fields. All the record filters apply.
+        Query parameters:
+        - group_by: comma separated list of species_name, name_id, site, dataset, datetime__day, datetime__month,
+        datetime__year or data.<field>
+        - sum, avg, min, max: comma separated list of numeric fields of the dataset schema
+        The data fields require a dataset (dataset__id filter).
+        :return: a list of {<group_by key>: value, ..., 'count': int, '<metric>.<field>': number}
+        """
+        queryset = self.filter_queryset(self.get_queryset())
+        return aggregate_response(queryset, self.dataset, request.query_params)
+
+    @action(detail=False, methods=['get'])
+    def clusters(self, request, *args, **kwargs):
+        """
+        Aggregate the records geometry in clusters. All the record filters apply.
+        Query parameters:
+        - bbox: minx,miny,maxx,maxy (WGS84) limit to the records within the bounding box (see SpatialFilterSet)
+        - grid: the size of a cluster cell in degrees, or
+        - zoom: a map zoom level. The grid size is computed to have CLUSTER_CELLS_PER_TILE cells per tile
+        - k: use a k-means clustering in k clusters instead of a grid
+        - group_by: 'species_name' or 'dataset'. Clusters are computed by group.
+        :return: a list of {'count': int, 'centroid': geojson point, [group_by]: value}
+        """
+        queryset = self.filter_queryset(self.get_queryset())
+        try:
+            # the bbox filter is applied by the filter set. We just need it for the grid size.
+            bbox = request.query_params.get('bbox')
+            if bbox:
+                bbox = parse_bbox(bbox)
+            group_by = request.query_params.get('group_by')
+            if group_by and group_by not in self.CLUSTER_GROUP_BY:
+                raise ValueError("group_by must be one of {}".format(list(self.CLUSTER_GROUP_BY.keys())))
+            k = request.query_params.get('k')
+            k = int(k) if k else None
+            if k is not None and k <= 0:
+                raise ValueError("k must be a positive integer")
+            grid = request.query_params.get('grid')
+            zoom = request.query_params.get('zoom')
+            if grid:
+                grid = float(grid)
+            elif zoom:
+                grid = 360.0 / (2 ** int(zoom)) / self.CLUSTER_CELLS_PER_TILE
+            elif bbox:
+                minx, miny, maxx, maxy = bbox.extent
+                grid = max(maxx - minx, maxy - miny) / self.CLUSTER_CELLS_PER_TILE
+            else:
+                grid = self.CLUSTER_DEFAULT_GRID
+            if grid <= 0:
+                raise ValueError("The grid size must be positive")
+        except ValueError as e:
+            return Response(str(e), status=status.HTTP_400_BAD_REQUEST)
+        clusters = cluster_queryset(queryset, grid_size=grid, k=k, group_by=self.CLUSTER_GROUP_BY.get(group_by))
+        serializer = serializers.RecordClusterSerializer(clusters, many=True)
+        return Response(serializer.data)
+
+
+class ExportJobViewSet(mixins.CreateModelMixin,
+                       mixins.RetrieveModelMixin,
+                       mixins.DestroyModelMixin,
+                       mixins.ListModelMixin,
+                       viewsets.GenericViewSet):
+    """
+    Records export generated in the background.
+    Post {dataset, format, filters} where filters are the records end-point query parameters.
+    If an identical export of the user exists and the records haven't changed since, the existing job is returned.
+    When the job status is 'done' the file can be downloaded at the download_url.
+    A user sees only its own jobs, an admin sees all of them.
+    """
+    permission_classes = (IsAuthenticated, DRYPermissions)
+    queryset = models.ExportJob.objects.all()
+    serializer_class = serializers.ExportJobSerializer
+    filter_fields = ('dataset', 'format', 'status', 'user')
+
+    def get_queryset(self):
+        queryset = super(ExportJobViewSet, self).get_queryset()
+        user = self.request.user
+        if is_admin(user):
+            return queryset
+        if not user.is_authenticated:
+            return queryset.none()
+        return queryset.filter(user=user)
+
+    def create(self, request, *args, **kwargs):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        data = serializer.validated_data
+        job = request_export(data['dataset'], data['format'], data.get('filters'), user=request.user)
+        status_code = status.HTTP_200_OK if job.is_done else status.HTTP_202_ACCEPTED
+        return Response(self.get_serializer(job).data, status=status_code)
+
+    def perform_destroy(self, instance):
+        # the file can be shared with the jobs of other users
+        delete_export_jobs([instance])
+
+    @action(detail=True, methods=['get'])
+    def download(self, request, *args, **kwargs):
+        job = self.get_object()
+        if not job.is_done:
+            return Response("The export is not available. Status: {}".format(job.status),
+                            status=status.HTTP_409_CONFLICT)
+        return export_job_file_response(job)
+
+
+class DeletionJobViewSet(mixins.RetrieveModelMixin,
+                         mixins.ListModelMixin,
+                         viewsets.GenericViewSet):
+    """
+    The large deletes of records, sites, datasets and projects run in the background.
+    A job can be cancelled with a post to its cancel url: it stops after the current batch and what has been deleted
+    stays deleted.
+    A user sees only its own jobs, an admin sees all of them.
+    """
+    permission_classes = (IsAuthenticated, DRYPermissions)
+    queryset = models.DeletionJob.objects.all()
+    serializer_class = serializers.DeletionJobSerializer
+    filter_fields = ('target', 'object_id', 'status', 'user')
+
+    def get_queryset(self):
+        queryset = super(DeletionJobViewSet, self).get_queryset()
+        user = self.request.user
+        if is_admin(user):
+            return queryset
+        if not user.is_authenticated:
+            return queryset.none()
+        return queryset.filter(user=user)
+
+    @action(detail=True, methods=['post'])
+    def cancel(self, request, *args, **kwargs):
+        job = self.get_object()
+        if not cancel_deletion_job(job):
+            return Response("The job is already {}".format(job.status), status=status.HTTP_409_CONFLICT)
+        job.refresh_from_db()
+        return Response(self.get_serializer(job).data)
+
 
 class MediaViewSet(viewsets.ModelViewSet):
     permission_classes = (IsAuthenticated, DRYPermissions)
@@ -503,6 +972,23 @@ class StatisticsView(APIView):
         return Response(data)
 
 
+class MetricsPermission(BasePermission):
+    def has_permission(self, request, view):
+        return is_admin(request.user)
+
+
+class MetricsView(APIView):
+    """
+    The request metrics counters in the prometheus text format. Admin only.
+    The counters are collected by the main.middleware.RequestMetricsMiddleware (REQUEST_METRICS setting) and are per
+    process.
+    """
+    permission_classes = (IsAuthenticated, MetricsPermission)
+
+    def get(self, request, *args, **kwargs):
+        return HttpResponse(utils_metrics.render_prometheus(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
 class WhoamiView(APIView):
     serializers = serializers.WhoAmISerializer
 
@@ -534,34 +1020,64 @@ class DatasetUploadRecordsView(APIView, SpeciesMixin):
         create_site = 'create_site' in request.data and to_bool(request.data['create_site'])
         delete_previous = 'delete_previous' in request.data and to_bool(request.data['delete_previous'])
         strict = 'strict' in request.data and to_bool(request.data['strict'])
+        # opt-in profiling: the response is {'rows': [...], 'profile': {...}}
+        profile = 'profile' in request.data and to_bool(request.data['profile'])
+        # validate only: nothing is deleted or saved and the response is a summary of the errors (see
+        # ValidationSummary)
+        dry_run = 'dry_run' in request.data and to_bool(request.data['dry_run'])
+        # match the rows with the existing records on the schema primary key (insert, update or skip)
+        upsert = 'upsert' in request.data and to_bool(request.data['upsert'])
 
         if file_obj.content_type not in FileReader.SUPPORTED_TYPES:
             msg = "Wrong file type {}. Should be one of: {}".format(file_obj.content_type, SiteUploader.SUPPORTED_TYPES)
             return Response(msg, status=status.HTTP_501_NOT_IMPLEMENTED)
-
-        if delete_previous:
-            self.dataset.record_queryset.delete()
-        generator = FileReader(file_obj)
-        validator = get_record_validator_for_dataset(self.dataset)
-        validator.schema_error_as_warning = not strict
-        creator = RecordCreator(self.dataset, generator,
-                                validator=validator, create_site=create_site, commit=True,
-                                species_facade_class=self.species_facade_class)
-        data = []
-        has_error = False
-        row = 1  # starts at 1 to match excel row id
-        for record, validator_result in creator:
-            row += 1
-            result = {
-                'row': row
-            }
-            if validator_result.has_errors:
-                has_error = True
-            else:
-                result['recordId'] = record.id
-            result.update(validator_result.to_dict())
-            data.append(result)
+        if upsert and not self.dataset.has_primary_key:
+            msg = "The upsert option requires a primaryKey in the dataset schema."
+            return Response(msg, status=status.HTTP_400_BAD_REQUEST)
+        if upsert and delete_previous:
+            msg = "The upsert and delete_previous options can't be used together."
+            return Response(msg, status=status.HTTP_400_BAD_REQUEST)
+
+        profiler = UploadProfiler() if profile else NoUploadProfiler()
+        with profiler:
+            if delete_previous and not dry_run:
+                with profiler.stage('delete_previous'):
+                    bulk_delete(models.DeletionJob.TARGET_RECORDS, self.dataset.pk)
+            with profiler.stage('file'):
+                generator = FileReader(file_obj)
+            validator = get_record_validator_for_dataset(self.dataset)
+            validator.schema_error_as_warning = not strict
+            creator = RecordCreator(self.dataset, generator,
+                                    validator=validator, create_site=create_site, commit=not dry_run,
+                                    species_facade_class=self.species_facade_class, profiler=profiler,
+                                    upsert=upsert)
+            data = []
+            summary = ValidationSummary()
+            has_error = False
+            row = 1  # starts at 1 to match excel row id
+            for record, validator_result in creator:
+                row += 1
+                if validator_result.has_errors:
+                    has_error = True
+                if dry_run:
+                    summary.add(row, validator_result)
+                    continue
+                result = {
+                    'row': row
+                }
+                if not validator_result.has_errors:
+                    result['recordId'] = record.id
+                    if upsert:
+                        result['action'] = record.upsert_action
+                result.update(validator_result.to_dict())
+                data.append(result)
         status_code = status.HTTP_200_OK if not has_error else status.HTTP_400_BAD_REQUEST
+        if dry_run:
+            data = summary.to_dict()
+            if profile:
+                data['profile'] = profiler.report()
+        elif profile:
+            data = OrderedDict([('rows', data), ('profile', profiler.report())])
         return Response(data, status=status_code)
 
 
@@ -571,8 +1087,9 @@ class SpeciesView(APIView, SpeciesMixin):
         Get a list of all species name present in the system
         :return: a list of species name.
         """
-        qs = Record.objects.exclude(species_name__isnull=True)
-        qs = self.filter_queryset(qs)
+        # read from the species summary (one row per species name and name id) instead of scanning the records.
+        request_species_summary_refresh()
+        qs = self.filter_queryset(SpeciesSummary.objects.all())
         # we output just the species name
         data = qs \
             .distinct('species_name') \
@@ -593,6 +1110,21 @@ class SpeciesView(APIView, SpeciesMixin):
         return queryset.filter(query)
 
 
+class SpeciesDetailView(APIView):
+    permission_classes = (IsAuthenticated,)
+
+    def get(self, request, species_name, *args, **kwargs):
+        """
+        Get the occurrence summary of a species: number of records and datasets, first and last observation and the
+        bounding box of the records, one per name id of the species name.
+        """
+        request_species_summary_refresh()
+        summaries = SpeciesSummary.objects.filter(species_name=species_name).order_by('name_id')
+        if not summaries:
+            return Response(status=status.HTTP_404_NOT_FOUND)
+        return Response(data=serializers.SpeciesSummarySerializer(summaries, many=True).data)
+
+
 class LogoutView(APIView):
     def get(self, request, *args, **kwargs):
         """
@@ -0,0 +1,65 @@
+from __future__ import absolute_import, unicode_literals, print_function, division
+
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from main.utils_benchmark import Benchmark, DATASET_TYPES, compare_to_baseline, load_baseline, save_results
+
+
+class Command(BaseCommand):
+    help = "Benchmark the records upload, validation, list, export and statistics on synthetic datasets. " \
+           "The results can be saved as a baseline and later runs compared against it. " \
+           "Run it against a local database: the benchmark data are created then deleted."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=1000,
+                            help='Number of records per dataset.')
+        parser.add_argument('--types', default=','.join(DATASET_TYPES),
+                            help='Comma separated dataset types to benchmark.')
+        parser.add_argument('--extra-columns', type=int, default=0,
+                            help='Number of extra columns added to the dataset schemas.')
+        parser.add_argument('--seed', type=int, default=0,
+                            help='Random seed of the synthetic data.')
+        parser.add_argument('--baseline',
+                            help='Path of a baseline (json) to compare the results with.')
+        parser.add_argument('--tolerance', type=float, default=0.2,
+                            help='Allowed slowdown ratio compared to the baseline.')
+        parser.add_argument('--save-baseline',
+                            help='Save the results (json) at this path.')
+        parser.add_argument('--keep', action='store_true', default=False,
+                            help="Don't delete the benchmark project and records.")
+        parser.add_argument('--no-fail', action='store_true', default=False,
+                            help="Report the regressions but don't exit with an error.")
+
+    def handle(self, *args, **options):
+        dataset_types = [t.strip() for t in options['types'].split(',') if t.strip()]
+        unknown = [t for t in dataset_types if t not in DATASET_TYPES]
+        if unknown:
+            raise CommandError('Unknown dataset type(s): {}. Choices: {}'.format(
+                ', '.join(unknown), ', '.join(DATASET_TYPES)))
+        baseline = load_baseline(options['baseline']) if options['baseline'] else None
+
+        benchmark = Benchmark(
+            rows=options['rows'],
+            dataset_types=dataset_types,
+            extra_columns=options['extra_columns'],
+            keep=options['keep'],
+            seed=options['seed'],
+            log=lambda message: self.stderr.write(message) if options['verbosity'] > 1 else None
+        )
+        results = benchmark.run()
+        self.stdout.write(json.dumps(results, indent=2))
+
+        if options['save_baseline']:
+            save_results(results, options['save_baseline'])
+            self.stdout.write('Results saved in {}'.format(options['save_baseline']))
+
+        if baseline is not None:
+            regressions = compare_to_baseline(results, baseline, tolerance=options['tolerance'])
+            for name, message in regressions:
+                self.stderr.write('Regression {}: {}'.format(name, message))
+            if regressions and not options['no_fail']:
+                raise CommandError('{} regression(s) compared to the baseline'.format(len(regressions)))
+            if not regressions:
+                self.stdout.write('No regression compared to the baseline')
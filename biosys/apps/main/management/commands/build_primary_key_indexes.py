@@ -0,0 +1,17 @@
+from __future__ import absolute_import, unicode_literals, print_function, division
+
+from django.core.management.base import BaseCommand
+
+from main.models import Dataset
+
+
+class Command(BaseCommand):
+    help = "Build the missing or invalid primary key indexes of the datasets and drop the indexes of a previous " \
+           "primary key. Meant to be run periodically (cron) with the PRIMARY_KEY_INDEX_BUILD 'worker' runner."
+
+    def handle(self, *args, **options):
+        count = 0
+        for dataset in Dataset.objects.all().iterator():
+            if dataset.primary_key_index_outdated and dataset.create_primary_key_index():
+                count += 1
+        self.stdout.write('{} dataset primary key index(es) built'.format(count))
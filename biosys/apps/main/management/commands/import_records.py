@@ -0,0 +1,355 @@
+from __future__ import absolute_import, unicode_literals, print_function, division
+
+import csv
+import io
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
+import timeit
+
+from django.core.files import File
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction
+from django.utils import six
+
+from main.api.deletions import bulk_delete
+from main.api.uploaders import FileReader, RecordCreator, UploadProfiler, NoUploadProfiler, xlsx_to_csv
+from main.api.validators import get_record_validator_for_dataset
+from main.models import Dataset, DeletionJob
+from main.utils_species import get_species_facade_class
+
+# species names -> name id, loaded once by the main process and given to the workers (see _init_worker).
+_species_name_id = {}
+# with several workers: the chunks are committed in order (see _wait_for_turn). Shared with the pool workers.
+_commit_state = None
+_commit_condition = None
+
+
+class PreloadedSpeciesFacade(object):
+    def name_id_by_species_name(self):
+        return _species_name_id
+
+
+class LocalFile(File):
+    """
+    A local file that looks like an uploaded file for the FileReader.
+    """
+
+    def __init__(self, file_path):
+        super(LocalFile, self).__init__(open(file_path, 'rb'), name=os.path.basename(file_path))
+        extension = os.path.splitext(file_path)[1].lower()
+        self.content_type = FileReader.CSV_TYPES[0] if extension == '.csv' else FileReader.XLSX_TYPES[0]
+
+
+class ChunkAborted(Exception):
+    pass
+
+
+def _init_worker(species_name_id, commit_state=None, commit_condition=None):
+    global _species_name_id, _commit_state, _commit_condition
+    _species_name_id = species_name_id
+    _commit_state = commit_state
+    _commit_condition = commit_condition
+
+
+def _wait_for_turn(index):
+    """
+    Block until all the chunks before this one are committed. Will throw a ChunkAborted if one of them failed.
+    The chunk is processed in a transaction that is only committed after the previous chunks, so the imported rows
+    are always the rows before the first failed chunk: the import can be resumed from its start.
+    """
+    if _commit_state is None:
+        return
+    with _commit_condition:
+        while _commit_state['next'] != index and not _commit_state['failed']:
+            _commit_condition.wait()
+        if _commit_state['failed']:
+            raise ChunkAborted('Chunk {} not imported because a previous chunk failed'.format(index))
+
+
+def _end_turn(index, failed=False):
+    if _commit_state is None:
+        return
+    with _commit_condition:
+        if failed:
+            _commit_state['failed'] = True
+        else:
+            _commit_state['next'] = index + 1
+        _commit_condition.notify_all()
+
+
+def _open_csv(file_path, mode):
+    if six.PY3:
+        return io.open(file_path, mode, encoding='utf-8', newline='')
+    return open(file_path, mode + 'b')
+
+
+def split_csv(file_path, chunks_dir, offset, limit, chunk_size):
+    """
+    Read the csv file once and write its data rows [offset:offset + limit] in csv files of chunk_size rows (with the
+    header), so that a worker only parses the rows of its chunk.
+    :return: (number of data rows in the file, [(start, stop, chunk file path)])
+    """
+    chunks = []
+    total = 0
+    writer = chunk_file = None
+    stop = None if limit is None else offset + limit
+    with _open_csv(file_path, 'r') as source:
+        reader = csv.reader(source)
+        header = next(reader, None)
+        try:
+            for row in reader:
+                if not row:
+                    # like the csv.DictReader of the FileReader
+                    continue
+                if offset <= total and (stop is None or total < stop):
+                    if writer is None or total - chunks[-1][0] >= chunk_size:
+                        if chunk_file is not None:
+                            chunk_file.close()
+                        path = os.path.join(chunks_dir, 'chunk_{}.csv'.format(len(chunks)))
+                        chunk_file = _open_csv(path, 'w')
+                        writer = csv.writer(chunk_file)
+                        writer.writerow(header)
+                        chunks.append([total, total, path])
+                    writer.writerow(row)
+                    chunks[-1][1] = total + 1
+                total += 1
+        finally:
+            if chunk_file is not None:
+                chunk_file.close()
+    return total, [tuple(chunk) for chunk in chunks]
+
+
+def import_chunk(options):
+    """
+    Import a chunk of rows of the file, in a transaction. Run in a worker process.
+    :return: a dict with the counts, the errors and the optional profile of the chunk
+    """
+    index, start, stop = options['index'], options['start'], options['stop']
+    dataset = Dataset.objects.get(pk=options['dataset'])
+    validator = get_record_validator_for_dataset(dataset)
+    validator.schema_error_as_warning = not options['strict']
+    profiler = UploadProfiler() if options['profile'] else NoUploadProfiler()
+    result = {'start': start, 'stop': stop, 'rows': 0, 'imported': 0, 'errors': [], 'profile': None}
+    local_file = LocalFile(options['file'])
+    try:
+        with transaction.atomic():
+            with profiler:
+                with profiler.stage('file'):
+                    reader = FileReader(local_file)
+                    # for the records source_info
+                    reader.file_name = options['file_name']
+                creator = RecordCreator(
+                    dataset,
+                    reader,
+                    validator=validator,
+                    create_site=options['create_site'],
+                    commit=True,
+                    species_facade_class=PreloadedSpeciesFacade,
+                    profiler=profiler,
+                    batch_size=options['batch_size'],
+                    row_offset=start,
+                    upsert=options['upsert'],
+                    # the pool workers are daemon processes: they can't start their own pool.
+                    validation_workers=1 if options['workers'] > 1 else None
+                )
+                row = start + 1  # to match excel row id
+                for record, validator_result in creator:
+                    row += 1
+                    result['rows'] += 1
+                    if validator_result.has_errors:
+                        errors = validator_result.to_dict()
+                        errors['row'] = row
+                        result['errors'].append(errors)
+                    else:
+                        result['imported'] += 1
+            _wait_for_turn(index)
+        _end_turn(index)
+        if options['profile']:
+            result['profile'] = profiler.report()
+    except Exception:
+        _end_turn(index, failed=True)
+        raise
+    finally:
+        local_file.close()
+        # the worker processes are reused by the pool, don't leave the connection opened.
+        if options['workers'] > 1:
+            connections.close_all()
+    return result
+
+
+class Command(BaseCommand):
+    help = "Import the records of a csv or xlsx file into a dataset, out of band of the upload API. " \
+           "Same validation and record creation as the API upload, with bulk inserts, parallel processing of chunks " \
+           "of rows and the possibility to resume an import with --offset. Every chunk is imported in a transaction " \
+           "and the chunks are committed in order."
+
+    def add_arguments(self, parser):
+        parser.add_argument('dataset', type=int, help='Dataset id.')
+        parser.add_argument('file', help='Path of a csv or xlsx file. The first row must be the header.')
+        parser.add_argument('--offset', type=int, default=0,
+                            help='Number of data rows (after the header) to skip. Used to resume an import.')
+        parser.add_argument('--limit', type=int, default=None,
+                            help='Maximum number of rows to import.')
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Number of records per bulk insert.')
+        parser.add_argument('--chunk-size', type=int, default=50000,
+                            help='Number of rows processed by a worker at a time.')
+        parser.add_argument('--workers', type=int, default=1,
+                            help='Number of worker processes.')
+        parser.add_argument('--create-site', action='store_true', default=False,
+                            help='Create the sites that are referenced by code and not found.')
+        parser.add_argument('--strict', action='store_true', default=False,
+                            help='Schema errors are errors and not warnings.')
+        parser.add_argument('--delete-previous', action='store_true', default=False,
+                            help='Delete all the dataset records before importing.')
+        parser.add_argument('--upsert', action='store_true', default=False,
+                            help='Match the rows with the existing records on the dataset primaryKey: insert the new '
+                                 'ones, update the changed ones and skip the others.')
+        parser.add_argument('--errors-file',
+                            help='Write the row errors in this file (one json per line).')
+        parser.add_argument('--profile', action='store_true', default=False,
+                            help='Print a profile of the import stages per chunk.')
+
+    def handle(self, *args, **options):
+        dataset = Dataset.objects.filter(pk=options['dataset']).first()
+        if dataset is None:
+            raise CommandError('Dataset {} not found'.format(options['dataset']))
+        file_path = options['file']
+        if not os.path.isfile(file_path):
+            raise CommandError('File {} not found'.format(file_path))
+        extension = os.path.splitext(file_path)[1].lower()
+        if extension not in ['.csv', '.xlsx']:
+            raise CommandError('Unsupported file {}. Should be a csv or xlsx file.'.format(file_path))
+        if options['upsert'] and not dataset.has_primary_key:
+            raise CommandError('--upsert requires a primaryKey in the dataset schema')
+        if options['upsert'] and options['delete_previous']:
+            raise CommandError("--upsert and --delete-previous can't be used together")
+        if options['delete_previous'] and options['offset']:
+            raise CommandError("--delete-previous can't be used when resuming an import (--offset)")
+        workers = max(1, options['workers'])
+        if options['upsert'] and workers > 1:
+            # the upsert of a dataset is serialized (see RecordCreator), the chunks can't be upserted in parallel.
+            raise CommandError("--upsert can't be used with more than one worker")
+        if workers > 1 and options['create_site']:
+            # parallel chunks would race to create the same sites
+            self.stdout.write('--create-site: the chunks are imported with one worker')
+            workers = 1
+        offset = max(0, options['offset'])
+
+        file_name = os.path.basename(file_path)
+        temp_dirs = []
+        try:
+            if extension == '.xlsx':
+                # convert once instead of in every chunk
+                self.stdout.write('Converting {} to csv'.format(file_path))
+                temp_dir = tempfile.mkdtemp()
+                temp_dirs.append(temp_dir)
+                csv_path = os.path.join(temp_dir, os.path.splitext(os.path.basename(file_path))[0] + '.csv')
+                with open(file_path, 'rb') as xlsx_file:
+                    content = xlsx_to_csv(xlsx_file).getvalue()
+                with open(csv_path, 'wb') as csv_file:
+                    csv_file.write(content if isinstance(content, bytes) else content.encode('utf-8'))
+                file_path = csv_path
+
+            chunk_size = max(1, options['chunk_size'])
+            chunks_dir = tempfile.mkdtemp()
+            temp_dirs.append(chunks_dir)
+            total, chunk_bounds = split_csv(file_path, chunks_dir, offset, options['limit'], chunk_size)
+            if not chunk_bounds:
+                self.stdout.write('Nothing to import: {} rows in the file, offset {}'.format(total, offset))
+                return
+            stop = chunk_bounds[-1][1]
+
+            if options['upsert']:
+                # once, before the workers start. Not built yet if the dataset was saved with the 'worker' runner.
+                if not dataset.create_primary_key_index():
+                    self.stdout.write('The primary key index is being built by another process: the upserts may be '
+                                      'slow until it is done')
+
+            if options['delete_previous']:
+                # in batches, the media files are deleted by the sweeper (as the upload end-point)
+                bulk_delete(DeletionJob.TARGET_RECORDS, dataset.pk)
+
+            species_name_id = {}
+            if dataset.type == Dataset.TYPE_SPECIES_OBSERVATION:
+                species_name_id = get_species_facade_class()().name_id_by_species_name()
+
+            chunks = [dict(
+                index=index,
+                dataset=dataset.pk,
+                file=chunk_path,
+                file_name=file_name,
+                start=start,
+                stop=chunk_stop,
+                batch_size=options['batch_size'],
+                create_site=options['create_site'],
+                strict=options['strict'],
+                profile=options['profile'],
+                upsert=options['upsert'],
+                workers=workers,
+            ) for index, (start, chunk_stop, chunk_path) in enumerate(chunk_bounds)]
+            self.stdout.write('Importing rows {} to {} of {} in {} chunk(s) with {} worker(s)'.format(
+                offset + 1, stop, total, len(chunks), workers))
+            self.run_chunks(chunks, workers, species_name_id, offset, stop, options)
+        finally:
+            for temp_dir in temp_dirs:
+                shutil.rmtree(temp_dir, ignore_errors=True)
+
+    def run_chunks(self, chunks, workers, species_name_id, offset, stop, options):
+        errors_file = open(options['errors_file'], 'a') if options['errors_file'] else None
+        imported = errors = done = 0
+        start_time = timeit.default_timer()
+        pool = manager = None
+        next_chunk = chunks[0]
+        try:
+            if workers > 1:
+                # the forked workers must not share the parent connection.
+                connections.close_all()
+                manager = multiprocessing.Manager()
+                commit_state = manager.dict({'next': 0, 'failed': False})
+                pool = multiprocessing.Pool(workers, initializer=_init_worker,
+                                            initargs=(species_name_id, commit_state, manager.Condition()))
+                results = pool.imap(import_chunk, chunks)
+            else:
+                _init_worker(species_name_id)
+                results = (import_chunk(chunk) for chunk in chunks)
+            # imap returns the results in order and the chunks are committed in order: every reported offset is
+            # fully imported and nothing after it is.
+            for index, result in enumerate(results):
+                next_chunk = chunks[index + 1] if index + 1 < len(chunks) else None
+                done += result['rows']
+                imported += result['imported']
+                errors += len(result['errors'])
+                if errors_file:
+                    for error in result['errors']:
+                        errors_file.write(json.dumps(error) + '\n')
+                    errors_file.flush()
+                seconds = timeit.default_timer() - start_time
+                self.stdout.write('{done}/{total} rows ({imported} imported, {errors} errors), {rate:.0f} rows/s. '
+                                  'Resume with --offset {offset}'.format(
+                                    done=done,
+                                    total=stop - offset,
+                                    imported=imported,
+                                    errors=errors,
+                                    rate=done / seconds if seconds else 0,
+                                    offset=result['stop']))
+                if result['profile']:
+                    self.stdout.write(json.dumps(result['profile'], indent=2))
+        except Exception as e:
+            if next_chunk is None:
+                raise
+            message = 'Import failed in the chunk starting at row {row}: {error}. Nothing was imported from ' \
+                      'this chunk on. Resume with --offset {offset}'
+            raise CommandError(message.format(row=next_chunk['start'] + 1, error=e, offset=next_chunk['start']))
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+            if manager is not None:
+                manager.shutdown()
+            if errors_file:
+                errors_file.close()
+        self.stdout.write('Done: {} records imported, {} rows with errors'.format(imported, errors))
@@ -0,0 +1,22 @@
+from __future__ import absolute_import, unicode_literals, print_function, division
+
+from django.core.management.base import BaseCommand
+
+from main.models import Dataset
+
+
+class Command(BaseCommand):
+    help = "Recompute the stale datasets extent. Meant to be run periodically (cron) so the extents " \
+           "are not recomputed on read."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', default=False,
+                            help='Recompute the extent of all the datasets, not only the stale ones.')
+
+    def handle(self, *args, **options):
+        datasets = Dataset.objects.all() if options['all'] else Dataset.objects.filter(extent_stale=True)
+        count = 0
+        for dataset in datasets.iterator():
+            dataset.refresh_extent()
+            count += 1
+        self.stdout.write('{} dataset extent(s) refreshed'.format(count))
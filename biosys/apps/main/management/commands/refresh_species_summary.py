@@ -0,0 +1,30 @@
+from __future__ import absolute_import, unicode_literals, print_function, division
+
+import time
+
+from django.core.management.base import BaseCommand
+
+from main.models import SpeciesSummary
+
+
+class Command(BaseCommand):
+    help = "Recompute the species summary of the species whose records changed since the last refresh. " \
+           "Use it with SPECIES_SUMMARY_REFRESH='worker'."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--force', action='store_true', default=False,
+                            help='Recompute the summary of all the species.')
+        parser.add_argument('--loop', action='store_true', default=False,
+                            help='Keep polling for changes instead of exiting after the first check.')
+        parser.add_argument('--interval', type=float, default=60,
+                            help='Polling interval in seconds when using --loop.')
+
+    def handle(self, *args, **options):
+        force = options['force']
+        while True:
+            if SpeciesSummary.refresh(force=force):
+                self.stdout.write('Species summary refreshed')
+            force = False
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
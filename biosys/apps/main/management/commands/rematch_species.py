@@ -0,0 +1,28 @@
+from __future__ import absolute_import, unicode_literals, print_function, division
+
+import time
+
+from django.core.management.base import BaseCommand
+
+from main.api.species_matching import rematch_species, REMATCH_BATCH_SIZE
+
+
+class Command(BaseCommand):
+    help = "Re-resolve the species of the records against the species database (SPECIES_FACADE_CLASS): set the name " \
+           "id of the records with an unknown species and the current species name of renamed species."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=REMATCH_BATCH_SIZE,
+                            help='Number of species names updated per statement.')
+        parser.add_argument('--loop', action='store_true', default=False,
+                            help='Run again every --interval seconds instead of exiting.')
+        parser.add_argument('--interval', type=float, default=24 * 3600,
+                            help='Interval in seconds between two runs when using --loop (default: one day).')
+
+    def handle(self, *args, **options):
+        while True:
+            result = rematch_species(batch_size=options['batch_size'])
+            self.stdout.write('{resolved} record(s) resolved, {renamed} record(s) renamed'.format(**result))
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,37 @@
+from __future__ import absolute_import, unicode_literals, print_function, division
+
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from main.api.reprocessors import RecordReprocessor
+from main.models import Dataset
+
+
+class Command(BaseCommand):
+    help = "Recompute the site, datetime, geometry and species of the records from their data, after a change of " \
+           "the dataset schema or of the project datum or timezone. The records that are no longer valid are not " \
+           "updated and are reported."
+
+    def add_arguments(self, parser):
+        parser.add_argument('datasets', type=int, nargs='*', help='Dataset ids.')
+        parser.add_argument('--project', type=int, default=None, help='Reprocess all the datasets of this project.')
+        parser.add_argument('--batch-size', type=int, default=RecordReprocessor.BATCH_SIZE,
+                            help='Number of records processed and updated at a time.')
+        parser.add_argument('--max-errors', type=int, default=1000,
+                            help='Maximum number of invalid records reported per dataset.')
+
+    def handle(self, *args, **options):
+        datasets = Dataset.objects.filter(pk__in=options['datasets'])
+        if options['project'] is not None:
+            datasets |= Dataset.objects.filter(project_id=options['project'])
+        elif not options['datasets']:
+            raise CommandError('Give some dataset ids or a --project.')
+        for dataset in datasets.order_by('pk'):
+            reprocessor = RecordReprocessor(dataset, batch_size=options['batch_size'],
+                                            max_errors=options['max_errors'])
+            result = reprocessor.run()
+            self.stdout.write('Dataset {pk} ({name}): {processed} record(s), {updated} updated, '
+                              '{error_count} error(s)'.format(pk=dataset.pk, name=dataset.name, **result))
+            for error in result['errors']:
+                self.stdout.write('  record {}: {}'.format(error['id'], json.dumps(error['errors'])))
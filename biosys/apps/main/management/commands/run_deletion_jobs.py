@@ -0,0 +1,30 @@
+from __future__ import absolute_import, unicode_literals, print_function, division
+
+import time
+
+from django.core.management.base import BaseCommand
+
+from main.api.deletions import run_pending_deletion_jobs, sweep_pending_files
+
+
+class Command(BaseCommand):
+    help = "Run the pending deletion jobs and delete the files of the deleted media from the storage. " \
+           "Use it with DELETION_JOB_RUNNER='worker'."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--loop', action='store_true', default=False,
+                            help='Keep polling for new jobs and files instead of exiting when there is nothing left.')
+        parser.add_argument('--interval', type=float, default=5,
+                            help='Polling interval in seconds when using --loop.')
+
+    def handle(self, *args, **options):
+        while True:
+            count = run_pending_deletion_jobs()
+            if count:
+                self.stdout.write('{} deletion job(s) run'.format(count))
+            count = sweep_pending_files()
+            if count:
+                self.stdout.write('{} file(s) deleted'.format(count))
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
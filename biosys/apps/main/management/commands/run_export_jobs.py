@@ -0,0 +1,26 @@
+from __future__ import absolute_import, unicode_literals, print_function, division
+
+import time
+
+from django.core.management.base import BaseCommand
+
+from main.api.export_jobs import run_pending_export_jobs
+
+
+class Command(BaseCommand):
+    help = "Run the pending records export jobs. Use it with EXPORT_JOB_RUNNER='worker'."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--loop', action='store_true', default=False,
+                            help='Keep polling for new jobs instead of exiting when there is no more pending job.')
+        parser.add_argument('--interval', type=float, default=5,
+                            help='Polling interval in seconds when using --loop.')
+
+    def handle(self, *args, **options):
+        while True:
+            count = run_pending_export_jobs()
+            if count:
+                self.stdout.write('{} export job(s) run'.format(count))
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,119 @@
+from __future__ import absolute_import, unicode_literals, print_function, division
+
+import logging
+import timeit
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+
+from main import utils_metrics
+
+logger = logging.getLogger(__name__)
+
+
+class RequestMetricsMiddleware(object):
+    """
+    Collect per request metrics: number of SQL queries and SQL time, dataset schema builds, species facade calls and
+    serialization time (see main.api.views.MetricsMixin).
+    The metrics are returned in a Server-Timing header, added to the process counters (see MetricsView) and the
+    requests over the REQUEST_METRICS_SLOW_* thresholds are logged with their most repeated queries.
+    The queries are counted by a wrapper of the database cursors (see utils_metrics.install_query_counter). For a
+    streaming response (e.g. the records export) the queries run while the content is streamed are counted too and the
+    request is recorded once its content is streamed, but the Server-Timing header, sent first, has only the metrics
+    of the view.
+    The counters are per process: with several gunicorn workers, every worker has its own.
+    Enabled with the REQUEST_METRICS setting.
+    """
+
+    def __init__(self, get_response):
+        if not getattr(settings, 'REQUEST_METRICS', False):
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+
+    def __call__(self, request):
+        for connection in connections.all():
+            utils_metrics.install_query_counter(connection)
+        metrics = utils_metrics.start_request_metrics()
+        start = timeit.default_timer()
+        try:
+            response = self.get_response(request)
+        finally:
+            duration = timeit.default_timer() - start
+            utils_metrics.stop_request_metrics()
+
+        response['Server-Timing'] = self.server_timing(metrics, duration)
+        if response.streaming:
+            response.streaming_content = self.stream(response.streaming_content, request, response, metrics, start)
+        else:
+            self.record(request, response, metrics, duration)
+        return response
+
+    def stream(self, content, request, response, metrics, start):
+        """
+        Generate the content of a streaming response with the request metrics active and record the request at the
+        end.
+        """
+        content = iter(content)
+        try:
+            while True:
+                utils_metrics.start_request_metrics(metrics)
+                try:
+                    chunk = next(content)
+                except StopIteration:
+                    break
+                finally:
+                    utils_metrics.stop_request_metrics()
+                yield chunk
+        finally:
+            self.record(request, response, metrics, timeit.default_timer() - start)
+
+    def record(self, request, response, metrics, duration):
+        view = self.view_name(request)
+        slow_seconds = getattr(settings, 'REQUEST_METRICS_SLOW_SECONDS', None)
+        slow_queries = getattr(settings, 'REQUEST_METRICS_SLOW_QUERIES', None)
+        slow = (slow_seconds is not None and duration > slow_seconds) or \
+               (slow_queries is not None and metrics.counts['queries'] > slow_queries)
+        utils_metrics.record_request(view, request.method, response.status_code, duration, metrics, slow=slow)
+        if slow:
+            self.log_slow_request(request, view, duration, metrics)
+
+    @staticmethod
+    def view_name(request):
+        match = getattr(request, 'resolver_match', None)
+        if match is None:
+            return 'unknown'
+        return match.view_name or match.func.__name__
+
+    @staticmethod
+    def server_timing(metrics, duration):
+        """
+        See https://www.w3.org/TR/server-timing/
+        """
+        timings = [
+            'sql;dur={:.1f};desc="{} queries"'.format(metrics.timings['sql'] * 1000, metrics.counts['queries']),
+            'schema;desc="{} builds"'.format(metrics.counts['schema']),
+            'species;dur={:.1f};desc="{} calls"'.format(metrics.timings['species'] * 1000, metrics.counts['species']),
+            'serialization;dur={:.1f}'.format(metrics.timings['serialization'] * 1000),
+            'total;dur={:.1f}'.format(duration * 1000),
+        ]
+        return ', '.join(timings)
+
+    @staticmethod
+    def log_slow_request(request, view, duration, metrics):
+        message = 'Slow request {method} {path} ({view}): {duration:.3f}s, {count} queries ({sql:.3f}s), ' \
+                  '{schema} schema builds, {species} species calls, serialization {serialization:.3f}s'.format(
+                    method=request.method,
+                    path=request.get_full_path(),
+                    view=view,
+                    duration=duration,
+                    count=metrics.counts['queries'],
+                    sql=metrics.timings['sql'],
+                    schema=metrics.counts['schema'],
+                    species=metrics.counts['species'],
+                    serialization=metrics.timings['serialization'])
+        repeated = utils_metrics.top_repeated_queries(metrics.queries)
+        if repeated:
+            message += '\nMost repeated queries:\n' + '\n'.join(
+                '{} x {}'.format(count, sql) for count, sql in repeated)
+        logger.warning(message)
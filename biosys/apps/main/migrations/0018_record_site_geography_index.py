@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    """
+    GiST indexes on the geometry cast to geography, used by the dwithin (distance in meters) filter.
+    """
+
+    dependencies = [
+        ('main', '0017_datasetmedia_projectmedia'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            sql='CREATE INDEX main_record_geography_idx ON main_record USING GIST ((geometry::geography));',
+            reverse_sql='DROP INDEX IF EXISTS main_record_geography_idx;'
+        ),
+        migrations.RunSQL(
+            sql='CREATE INDEX main_site_geography_idx ON main_site USING GIST ((geometry::geography));',
+            reverse_sql='DROP INDEX IF EXISTS main_site_geography_idx;'
+        ),
+    ]
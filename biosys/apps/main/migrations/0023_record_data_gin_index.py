@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    """
+    GIN index on the records data for the containment queries (data @> {...}): the data__contains filter and the
+    parents/children foreign key lookups. jsonb_path_ops is smaller and faster than the default jsonb_ops but only
+    supports @>. Combined with a dataset filter the planner can AND it with the dataset_id index.
+    """
+
+    dependencies = [
+        ('main', '0022_deletionjob_pendingfiledeletion'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            sql='CREATE INDEX main_record_data_path_ops_idx ON main_record USING GIN (data jsonb_path_ops);',
+            reverse_sql='DROP INDEX IF EXISTS main_record_data_path_ops_idx;'
+        ),
+    ]
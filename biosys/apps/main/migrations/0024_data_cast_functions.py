@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+# Casts of the records data text values (data->>'field') used by the typed data.<field> filters
+# (see main.api.filters.filter_data_fields).
+# They return NULL instead of raising an error for a value that can't be cast (the data of a dataset can have schema
+# errors stored as warnings) and they are IMMUTABLE so expression indexes can be created on them, e.g:
+# CREATE INDEX ON main_record ((biosys_to_numeric(data->>'Count'))) WHERE dataset_id = 1;
+CREATE_FUNCTIONS = r"""
+CREATE OR REPLACE FUNCTION biosys_to_numeric(value text) RETURNS numeric AS $$
+    SELECT CASE WHEN value ~ '^\s*[-+]?(\d+\.?\d*|\.\d+)([eE][-+]?\d+)?\s*$' THEN value::numeric END;
+$$ LANGUAGE sql IMMUTABLE;
+
+CREATE OR REPLACE FUNCTION biosys_to_boolean(value text) RETURNS boolean AS $$
+    SELECT CASE
+        WHEN lower(trim(value)) IN ('true', 't', 'yes', 'y', '1') THEN true
+        WHEN lower(trim(value)) IN ('false', 'f', 'no', 'n', '0') THEN false
+    END;
+$$ LANGUAGE sql IMMUTABLE;
+
+-- the date or NULL if it doesn't exist (e.g. 31/02). Checked before make_date that would raise an error.
+CREATE OR REPLACE FUNCTION biosys_make_date(y integer, m integer, d integer) RETURNS date AS $$
+BEGIN
+    IF y < 1 OR m < 1 OR m > 12 OR d < 1 THEN
+        RETURN NULL;
+    END IF;
+    IF d > extract(day FROM make_date(y, m, 1) + interval '1 month - 1 day') THEN
+        RETURN NULL;
+    END IF;
+    RETURN make_date(y, m, d);
+END;
+$$ LANGUAGE plpgsql IMMUTABLE STRICT;
+
+-- the month number of an english month name or abbreviation (at least 3 letters): 'Mar', 'march', 'Sept'
+CREATE OR REPLACE FUNCTION biosys_month(name text) RETURNS integer AS $$
+    SELECT m.number::integer
+    FROM unnest(ARRAY['january', 'february', 'march', 'april', 'may', 'june', 'july', 'august', 'september',
+                      'october', 'november', 'december']) WITH ORDINALITY AS m (name, number)
+    WHERE length($1) >= 3 AND m.name LIKE lower($1) || '%';
+$$ LANGUAGE sql IMMUTABLE STRICT;
+
+-- The date formats read by the upload (main.utils_data_package.parse_datetime_day_first), day first when ambiguous:
+-- yyyy-mm-dd, yyyy/mm/dd, yyyymmdd, dd/mm/yyyy, dd-mm-yyyy, dd.mm.yyyy, 20 Mar 2018, 20-March-2018, March 20, 2018.
+-- Anything after the date (a time) is ignored. The 2 digits years are not read: their century depends on the
+-- current date, the function must be IMMUTABLE.
+-- No EXCEPTION block (a subtransaction per call): the values are matched and checked before being converted.
+CREATE OR REPLACE FUNCTION biosys_to_date(value text) RETURNS date AS $$
+DECLARE
+    parts text[];
+BEGIN
+    parts := regexp_match(value, '^\s*(\d{4})[-/.](\d{1,2})[-/.](\d{1,2})(?!\d)');
+    IF parts IS NOT NULL THEN
+        RETURN biosys_make_date(parts[1]::integer, parts[2]::integer, parts[3]::integer);
+    END IF;
+    parts := regexp_match(value, '^\s*(\d{4})(\d{2})(\d{2})(?!\d)');
+    IF parts IS NOT NULL THEN
+        RETURN biosys_make_date(parts[1]::integer, parts[2]::integer, parts[3]::integer);
+    END IF;
+    parts := regexp_match(value, '^\s*(\d{1,2})[-/.](\d{1,2})[-/.](\d{4})(?!\d)');
+    IF parts IS NOT NULL THEN
+        -- day first, unless the month can't be one (mm/dd/yyyy)
+        IF parts[2]::integer > 12 THEN
+            RETURN biosys_make_date(parts[3]::integer, parts[1]::integer, parts[2]::integer);
+        END IF;
+        RETURN biosys_make_date(parts[3]::integer, parts[2]::integer, parts[1]::integer);
+    END IF;
+    parts := regexp_match(value, '^\s*(\d{1,2})(?:st|nd|rd|th)?[-/. ]*([A-Za-z]{3,9})\.?[-/., ]*(\d{4})(?!\d)');
+    IF parts IS NOT NULL THEN
+        RETURN biosys_make_date(parts[3]::integer, biosys_month(parts[2]), parts[1]::integer);
+    END IF;
+    parts := regexp_match(value, '^\s*([A-Za-z]{3,9})\.?[-/. ]*(\d{1,2})(?:st|nd|rd|th)?[-/., ]*(\d{4})(?!\d)');
+    IF parts IS NOT NULL THEN
+        RETURN biosys_make_date(parts[3]::integer, biosys_month(parts[1]), parts[2]::integer);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql IMMUTABLE;
+
+-- a date (see biosys_to_date) and its time if any: hh:mm or hh:mm:ss[.ffffff] (the time zone if any is ignored),
+-- or a date at midnight
+CREATE OR REPLACE FUNCTION biosys_to_timestamp(value text) RETURNS timestamp AS $$
+DECLARE
+    day date;
+    parts text[];
+BEGIN
+    day := biosys_to_date(value);
+    IF day IS NULL THEN
+        RETURN NULL;
+    END IF;
+    parts := regexp_match(value, '[ T](\d{1,2}):(\d{2})(?::(\d{2}(?:\.\d+)?))?');
+    IF parts IS NULL THEN
+        RETURN day::timestamp;
+    END IF;
+    IF parts[1]::integer > 23 OR parts[2]::integer > 59 OR coalesce(parts[3], '0')::numeric >= 60 THEN
+        RETURN NULL;
+    END IF;
+    RETURN day + make_time(parts[1]::integer, parts[2]::integer, coalesce(parts[3], '0')::double precision);
+END;
+$$ LANGUAGE plpgsql IMMUTABLE;
+"""
+
+DROP_FUNCTIONS = """
+DROP FUNCTION IF EXISTS biosys_to_timestamp(text);
+DROP FUNCTION IF EXISTS biosys_to_date(text);
+DROP FUNCTION IF EXISTS biosys_month(text);
+DROP FUNCTION IF EXISTS biosys_make_date(integer, integer, integer);
+DROP FUNCTION IF EXISTS biosys_to_boolean(text);
+DROP FUNCTION IF EXISTS biosys_to_numeric(text);
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0023_record_data_gin_index'),
+    ]
+
+    operations = [
+        migrations.RunSQL(sql=CREATE_FUNCTIONS, reverse_sql=DROP_FUNCTIONS),
+    ]
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import django.contrib.gis.db.models.fields
+from django.contrib.postgres.operations import TrigramExtension
+from django.db import migrations, models
+
+# The changed species of a statement on the records: logged once. A change already logged is locked (FOR KEY SHARE)
+# until the end of the transaction so a refresh can't take it before the records of this transaction are committed.
+LOG_CHANGES_SQL = """
+        WITH changed AS (
+            SELECT DISTINCT k.species_name, k.name_id FROM ({keys}) AS k WHERE k.species_name IS NOT NULL
+        ), logged AS (
+            SELECT c.species_name, c.name_id FROM main_speciessummarychange c
+            JOIN changed k ON c.species_name = k.species_name AND c.name_id = k.name_id
+            FOR KEY SHARE OF c SKIP LOCKED
+        )
+        INSERT INTO main_speciessummarychange (species_name, name_id)
+        SELECT k.species_name, k.name_id FROM changed k
+        WHERE NOT EXISTS (SELECT 1 FROM logged l WHERE l.species_name = k.species_name AND l.name_id = k.name_id);
+"""
+
+INSERTED_KEYS = 'SELECT species_name, name_id FROM new_records'
+DELETED_KEYS = 'SELECT species_name, name_id FROM old_records'
+# the old and new species of the records whose summarized fields changed
+UPDATED_KEYS = """
+            SELECT v.species_name, v.name_id
+            FROM old_records o JOIN new_records n ON n.id = o.id,
+                 LATERAL (VALUES (o.species_name, o.name_id), (n.species_name, n.name_id)) AS v (species_name, name_id)
+            WHERE (o.species_name, o.name_id, o.dataset_id, o.datetime, o.geometry)
+                  IS DISTINCT FROM (n.species_name, n.name_id, n.dataset_id, n.datetime, n.geometry)
+"""
+
+CREATE_SUMMARY = """
+CREATE TABLE main_speciessummary (
+    id bigint PRIMARY KEY,
+    species_name varchar(500) NOT NULL,
+    name_id integer NOT NULL,
+    record_count integer NOT NULL,
+    dataset_count integer NOT NULL,
+    first_observed timestamp with time zone,
+    last_observed timestamp with time zone,
+    extent geometry(GEOMETRY, 4326)
+);
+CREATE UNIQUE INDEX main_speciessummary_species_idx ON main_speciessummary (species_name, name_id);
+-- the species search: icontains is UPPER("species_name"::text) LIKE UPPER(%s)
+CREATE INDEX main_speciessummary_species_trgm_idx ON main_speciessummary
+    USING GIN (UPPER(species_name::text) gin_trgm_ops);
+-- the summary of a species is recomputed from its records
+CREATE INDEX main_record_species_summary_idx ON main_record (species_name, name_id) WHERE species_name IS NOT NULL;
+
+-- the id is the first 64 bits of the md5 of the species name and name id: it doesn't change between refreshes.
+INSERT INTO main_speciessummary
+SELECT ('x' || substr(md5(species_name || '|' || name_id::text), 1, 16))::bit(64)::bigint,
+       species_name,
+       name_id,
+       count(*),
+       count(DISTINCT dataset_id),
+       min(datetime),
+       max(datetime),
+       ST_SetSRID(ST_Extent(geometry)::geometry, 4326)
+FROM main_record
+WHERE species_name IS NOT NULL
+GROUP BY species_name, name_id;
+
+-- the species changed since the last refresh
+CREATE TABLE main_speciessummarychange (
+    id bigserial PRIMARY KEY,
+    species_name varchar(500) NOT NULL,
+    name_id integer NOT NULL
+);
+CREATE INDEX main_speciessummarychange_species_idx ON main_speciessummarychange (species_name, name_id);
+
+CREATE FUNCTION main_speciessummary_log_change() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        {log_inserted}
+    ELSIF TG_OP = 'DELETE' THEN
+        {log_deleted}
+    ELSE
+        {log_updated}
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE FUNCTION main_speciessummary_clear() RETURNS trigger AS $$
+BEGIN
+    DELETE FROM main_speciessummarychange;
+    DELETE FROM main_speciessummary;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- transition tables: one insert of the changed species per statement
+CREATE TRIGGER main_record_species_summary_insert
+    AFTER INSERT ON main_record REFERENCING NEW TABLE AS new_records
+    FOR EACH STATEMENT EXECUTE PROCEDURE main_speciessummary_log_change();
+
+CREATE TRIGGER main_record_species_summary_update
+    AFTER UPDATE ON main_record REFERENCING OLD TABLE AS old_records NEW TABLE AS new_records
+    FOR EACH STATEMENT EXECUTE PROCEDURE main_speciessummary_log_change();
+
+CREATE TRIGGER main_record_species_summary_delete
+    AFTER DELETE ON main_record REFERENCING OLD TABLE AS old_records
+    FOR EACH STATEMENT EXECUTE PROCEDURE main_speciessummary_log_change();
+
+CREATE TRIGGER main_record_species_summary_truncate
+    AFTER TRUNCATE ON main_record
+    FOR EACH STATEMENT EXECUTE PROCEDURE main_speciessummary_clear();
+"""
+
+DROP_SUMMARY = """
+DROP TRIGGER IF EXISTS main_record_species_summary_truncate ON main_record;
+DROP TRIGGER IF EXISTS main_record_species_summary_delete ON main_record;
+DROP TRIGGER IF EXISTS main_record_species_summary_update ON main_record;
+DROP TRIGGER IF EXISTS main_record_species_summary_insert ON main_record;
+DROP FUNCTION IF EXISTS main_speciessummary_clear();
+DROP FUNCTION IF EXISTS main_speciessummary_log_change();
+DROP TABLE IF EXISTS main_speciessummarychange;
+DROP INDEX IF EXISTS main_record_species_summary_idx;
+DROP TABLE IF EXISTS main_speciessummary;
+"""
+
+
+class Migration(migrations.Migration):
+    """
+    The species summary table, maintained incrementally (see main.models.SpeciesSummary).
+    The triggers use transition tables (PostgreSQL 10).
+    """
+
+    dependencies = [
+        ('main', '0024_data_cast_functions'),
+    ]
+
+    operations = [
+        TrigramExtension(),
+        migrations.RunSQL(
+            sql=CREATE_SUMMARY.format(
+                log_inserted=LOG_CHANGES_SQL.format(keys=INSERTED_KEYS),
+                log_deleted=LOG_CHANGES_SQL.format(keys=DELETED_KEYS),
+                log_updated=LOG_CHANGES_SQL.format(keys=UPDATED_KEYS)
+            ),
+            reverse_sql=DROP_SUMMARY
+        ),
+        migrations.CreateModel(
+            name='SpeciesSummary',
+            fields=[
+                ('id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('species_name', models.CharField(max_length=500)),
+                ('name_id', models.IntegerField()),
+                ('record_count', models.IntegerField()),
+                ('dataset_count', models.IntegerField()),
+                ('first_observed', models.DateTimeField(null=True)),
+                ('last_observed', models.DateTimeField(null=True)),
+                ('extent', django.contrib.gis.db.models.fields.GeometryField(null=True, srid=4326)),
+            ],
+            options={
+                'db_table': 'main_speciessummary',
+                'ordering': ['species_name', 'name_id'],
+                'managed': False,
+            },
+        ),
+    ]
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    """
+    Indexes for the species re-matching (main.api.species_matching): the records with an unknown species by species
+    name and the records by name id.
+    """
+
+    dependencies = [
+        ('main', '0025_species_summary'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            sql='CREATE INDEX main_record_unresolved_species_idx ON main_record (species_name) WHERE name_id = -1',
+            reverse_sql='DROP INDEX IF EXISTS main_record_unresolved_species_idx',
+        ),
+        migrations.RunSQL(
+            sql='CREATE INDEX main_record_name_id_idx ON main_record (name_id) WHERE name_id <> -1',
+            reverse_sql='DROP INDEX IF EXISTS main_record_name_id_idx',
+        ),
+    ]
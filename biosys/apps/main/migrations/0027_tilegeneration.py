@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0026_record_species_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TileGeneration',
+            fields=[
+                ('project_id', models.IntegerField(primary_key=True, serialize=False)),
+                ('generation', models.BigIntegerField(default=0)),
+            ],
+        ),
+    ]
@@ -1,5 +1,7 @@
 from __future__ import absolute_import, unicode_literals, print_function, division
 
+import hashlib
+import json
 import logging
 from os import path
 
@@ -12,14 +14,20 @@ from django.contrib.gis.db import models
 from django.contrib.gis.db.models import Extent
 from django.contrib.postgres.fields import JSONField
 from django.core.exceptions import ValidationError
+from django.db import connection, transaction
+from django.db.models import F
+from django.utils import six
 from django.utils.encoding import python_2_unicode_compatible
 from django.utils.text import Truncator
 from django.db.models.query_utils import Q
 from timezone_field import TimeZoneField
 
+from main import utils_metrics
 from main.constants import DATUM_CHOICES, MODEL_SRID
 from main.utils_auth import is_admin
 from main.utils_data_package import GenericSchema, ObservationSchema, SpeciesObservationSchema
+from main.utils_db import quote_literal
+from main.utils_geo import merge_extents
 
 logger = logging.getLogger(__name__)
 
@@ -217,6 +225,16 @@ class Project(models.Model):
         return self.name
 
 
+class TileGeneration(models.Model):
+    """
+    The tile generation of a project (see main.utils_geo.get_tile_generation), in the database so that all the
+    processes see the same one. Not a foreign key: the generation of a deleted project is still incremented and the
+    project ids are not reused.
+    """
+    project_id = models.IntegerField(primary_key=True)
+    generation = models.BigIntegerField(default=0)
+
+
 @python_2_unicode_compatible
 class Site(models.Model):
     project = models.ForeignKey('Project', null=False, blank=False,
@@ -315,6 +333,11 @@ class Dataset(models.Model):
         (TYPE_OBSERVATION, TYPE_OBSERVATION.capitalize()),
         (TYPE_SPECIES_OBSERVATION, 'Species observation')
     ]
+    PRIMARY_KEY_INDEX_PREFIX = 'main_record_pk_'
+    # the upserts of a dataset hold the advisory lock (UPSERT_LOCK_ID, dataset id), see RecordCreator.
+    UPSERT_LOCK_ID = 7305402
+    # the builds of the primary key index of a dataset hold the advisory lock (INDEX_LOCK_ID, dataset id).
+    INDEX_LOCK_ID = 7305403
     project = models.ForeignKey('Project', null=False, blank=False, related_name='projects',
                                 related_query_name='project', on_delete=models.CASCADE)
     name = models.CharField(max_length=200, null=False, blank=False)
@@ -328,10 +351,22 @@ class Dataset(models.Model):
     data_package = JSONField()
     description = models.TextField(null=True, blank=True,
                                    verbose_name="Description", help_text="")
+    # Cached bounding box [xmin, ymin, xmax, ymax] of the records geometry. See the extent property.
+    cached_extent = JSONField(null=True, blank=True, editable=False)
+    extent_stale = models.BooleanField(default=True, editable=False)
+    # incremented when the cached extent is made stale: a refresh only clears the stale flag if it didn't change.
+    extent_version = models.IntegerField(default=0, editable=False)
 
     def __str__(self):
         return '{}'.format(self.name)
 
+    def save(self, *args, **kwargs):
+        super(Dataset, self).save(*args, **kwargs)
+        # the primary key index is built (or dropped) in the background, once the schema is committed.
+        # import here to avoid cyclic import problem
+        from main.api.indexes import request_primary_key_index
+        transaction.on_commit(lambda: request_primary_key_index(self))
+
     @property
     def record_model(self):
         """
@@ -351,7 +386,65 @@ class Dataset(models.Model):
 
     @property
     def extent(self):
-        return self.record_queryset.aggregate(Extent('geometry'))['geometry__extent']
+        """
+        The bounding box of the records geometry.
+        The value is cached in the dataset. A stale value is recomputed (full scan of the records) according to the
+        DATASET_EXTENT_REFRESH setting, by default in the background: the previous value is returned meanwhile.
+        """
+        if self.extent_stale:
+            # import here to avoid cyclic import problem
+            from main.api.extents import request_extent_refresh
+            request_extent_refresh(self)
+        return tuple(self.cached_extent) if self.cached_extent else None
+
+    def refresh_extent(self):
+        """
+        Recompute the cached extent. If the extent was made stale again during the computation (records added, moved
+        or deleted), the result may miss these changes: it is not saved and the extent stays stale.
+        :return: True if the extent was saved
+        """
+        version = Dataset.objects.filter(pk=self.pk).values_list('extent_version', flat=True).first()
+        if version is None:
+            return False
+        extent = self.record_queryset.aggregate(Extent('geometry'))['geometry__extent']
+        extent = list(extent) if extent else None
+        # the row is locked by the update: a concurrent change of the version is waited for and seen here.
+        if not Dataset.objects.filter(pk=self.pk, extent_version=version) \
+                .update(cached_extent=extent, extent_stale=False):
+            return False
+        self.cached_extent = extent
+        self.extent_stale = False
+        self.extent_version = version
+        return True
+
+    def expand_extent(self, extent):
+        """
+        Expand the cached extent with the given bounding box. Used when records are added.
+        If the cached extent is stale it will be recomputed (see extent): the version is incremented so that a refresh
+        running now, which may not see the added records, doesn't clear the stale flag.
+        :param extent: (xmin, ymin, xmax, ymax)
+        """
+        if not extent:
+            return
+        with transaction.atomic():
+            current = Dataset.objects.select_for_update().filter(pk=self.pk) \
+                .values('cached_extent', 'extent_stale').first()
+            if current is None:
+                return
+            if current['extent_stale']:
+                Dataset.objects.filter(pk=self.pk).update(extent_version=F('extent_version') + 1)
+                return
+            self.cached_extent = merge_extents(current['cached_extent'], extent)
+            self.extent_stale = False
+            Dataset.objects.filter(pk=self.pk).update(cached_extent=self.cached_extent)
+
+    def mark_extent_stale(self):
+        """
+        To be called when records geometry are removed or changed (deletes, site moves).
+        The extent will be recomputed lazily.
+        """
+        self.extent_stale = True
+        Dataset.objects.filter(pk=self.pk).update(extent_stale=True, extent_version=F('extent_version') + 1)
 
     @property
     def schema_class(self):
@@ -368,6 +461,7 @@ class Dataset(models.Model):
 
     @property
     def schema(self):
+        utils_metrics.increment('schema')
         return self.schema_class(self.schema_data)
 
     @property
@@ -419,8 +513,8 @@ class Dataset(models.Model):
         if fk_resource_names:
             initial_queryset = Dataset.objects.filter(project=self.project)
             resource_name_query = Q(name__in=fk_resource_names) | \
-                                  Q(code__in=fk_resource_names) | \
-                                  Q(data_package__resources__0__name__in=fk_resource_names)
+                Q(code__in=fk_resource_names) | \
+                Q(data_package__resources__0__name__in=fk_resource_names)
             # TODO: we support only one FK
             return initial_queryset.filter(resource_name_query).first()
         else:
@@ -434,6 +528,99 @@ class Dataset(models.Model):
         """
         return bool(self.schema_data.get('primaryKey'))
 
+    @property
+    def primary_key_fields(self):
+        """
+        :return: the list of the field names of the declared primaryKey (a string or a list in the schema)
+        """
+        primary_key = self.schema_data.get('primaryKey') or []
+        return [primary_key] if isinstance(primary_key, six.string_types) else list(primary_key)
+
+    @property
+    def primary_key_index_name(self):
+        fields_hash = hashlib.md5(json.dumps(self.primary_key_fields).encode('utf-8')).hexdigest()[:8]
+        return '{}{}_{}'.format(self.PRIMARY_KEY_INDEX_PREFIX, self.pk, fields_hash)
+
+    @classmethod
+    def _primary_key_index_names(cls, pk):
+        prefix = '{}{}_'.format(cls.PRIMARY_KEY_INDEX_PREFIX, pk)
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT indexname FROM pg_indexes WHERE tablename = 'main_record' AND indexname LIKE %s",
+                           [cls.PRIMARY_KEY_INDEX_PREFIX + '%'])
+            return [name for name, in cursor.fetchall() if name.startswith(prefix)]
+
+    @staticmethod
+    def _is_valid_index(name):
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT i.indisvalid FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid '
+                           'WHERE c.relname = %s', [name])
+            row = cursor.fetchone()
+        return row is not None and row[0]
+
+    @property
+    def primary_key_index_outdated(self):
+        """
+        :return: True if create_primary_key_index has something to do: the index of the primary key is missing or
+        invalid, or there are indexes of a previous primary key.
+        """
+        names = self._primary_key_index_names(self.pk)
+        if not self.has_primary_key:
+            return bool(names)
+        name = self.primary_key_index_name
+        return names != [name] or not self._is_valid_index(name)
+
+    def create_primary_key_index(self):
+        """
+        Create (if needed) a partial expression index on the primary key fields of the records of this dataset.
+        Used to match the uploaded rows with the existing records (upsert). The indexes of a previous primaryKey of
+        the dataset are dropped.
+        The index is built concurrently so the writes of records are not blocked, but it can take a while on a big
+        table: it is built in the background when the dataset is saved (see main.api.indexes). Can't be called in a
+        transaction.
+        Only one build runs at a time for a dataset (advisory lock), so an invalid index found here was left by a
+        failed build, not one in progress: it is rebuilt.
+        :return: False if another build of the dataset is running
+        """
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT pg_try_advisory_lock(%s, %s)', [self.INDEX_LOCK_ID, self.pk])
+            if not cursor.fetchone()[0]:
+                return False
+            try:
+                name = self.primary_key_index_name if self.has_primary_key else None
+                valid = name is not None and self._is_valid_index(name)
+                for existing in self._primary_key_index_names(self.pk):
+                    if existing != name or not valid:
+                        cursor.execute('DROP INDEX CONCURRENTLY IF EXISTS {}'.format(existing))
+                if name is not None and not valid:
+                    expressions = ', '.join('(data ->> {})'.format(quote_literal(f)) for f in self.primary_key_fields)
+                    cursor.execute('CREATE INDEX CONCURRENTLY {name} ON main_record ({expressions}) '
+                                   'WHERE dataset_id = {pk}'.format(name=name, expressions=expressions,
+                                                                    pk=int(self.pk)))
+            finally:
+                cursor.execute('SELECT pg_advisory_unlock(%s, %s)', [self.INDEX_LOCK_ID, self.pk])
+        return True
+
+    def drop_primary_key_indexes(self):
+        """
+        Drop the primary key indexes of this dataset (see create_primary_key_index), once a running build is done.
+        In a transaction they are dropped after the commit (DROP INDEX CONCURRENTLY).
+        """
+        pk = self.pk
+
+        def drop():
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT pg_advisory_lock(%s, %s)', [Dataset.INDEX_LOCK_ID, pk])
+                try:
+                    for name in Dataset._primary_key_index_names(pk):
+                        cursor.execute('DROP INDEX CONCURRENTLY IF EXISTS {}'.format(name))
+                finally:
+                    cursor.execute('SELECT pg_advisory_unlock(%s, %s)', [Dataset.INDEX_LOCK_ID, pk])
+
+        if connection.in_atomic_block:
+            transaction.on_commit(drop)
+        else:
+            drop()
+
     @staticmethod
     def validate_data_package(data_package, dataset_type, project=None):
         """
@@ -576,6 +763,14 @@ class Dataset(models.Model):
         user = request.user
         return is_admin(user) or self.is_data_engineer(user)
 
+    @staticmethod
+    def has_schema_impact_permission(request):
+        return True
+
+    def has_object_schema_impact_permission(self, request):
+        # it can apply the schema
+        return self.has_object_update_permission(request)
+
     @staticmethod
     def has_destroy_permission(request):
         return True
@@ -1026,3 +1221,303 @@ class DatasetMedia(models.Model):
 
     def has_object_destroy_permission(self, request):
         return is_admin(request.user) or self.is_data_engineer(request.user)
+
+
+def get_export_path(instance, filename):
+    """
+    The function used in ExportJob file field to build the path of the generated file.
+    :param instance:
+    :param filename:
+    :return: string
+    """
+    try:
+        return 'exports/project_{project}/dataset_{dataset}/{filename}'.format(
+            project=instance.dataset.project_id,
+            dataset=instance.dataset_id,
+            filename=filename
+        )
+    except Exception:
+        logger.exception('Error while building the export file name')
+        return 'exports/unknown/{}'.format(filename)
+
+
+@python_2_unicode_compatible
+class ExportJob(models.Model):
+    """
+    An export of the records of a dataset generated in the background (see main.api.export_jobs).
+    The generated file is kept in the default storage and reused as long as the dataset records don't change. Every
+    user has its own jobs but an identical export shares the file of the first one. The file is deleted with the
+    last job sharing it, a job being deleted once the user's export of the same records is done again.
+    """
+    STATUS_PENDING = 'pending'
+    STATUS_RUNNING = 'running'
+    STATUS_DONE = 'done'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_PENDING, STATUS_PENDING.capitalize()),
+        (STATUS_RUNNING, STATUS_RUNNING.capitalize()),
+        (STATUS_DONE, STATUS_DONE.capitalize()),
+        (STATUS_FAILED, STATUS_FAILED.capitalize()),
+    ]
+    FORMAT_XLSX = 'xlsx'
+    FORMAT_CSV = 'csv'
+    FORMAT_PARQUET = 'parquet'
+    FORMAT_CHOICES = [
+        (FORMAT_XLSX, 'Excel'),
+        (FORMAT_CSV, 'CSV'),
+        (FORMAT_PARQUET, 'Parquet'),
+    ]
+    dataset = models.ForeignKey(Dataset, null=False, blank=False, on_delete=models.CASCADE)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, null=True, blank=True, on_delete=models.SET_NULL)
+    format = models.CharField(max_length=20, choices=FORMAT_CHOICES, default=FORMAT_XLSX)
+    # the records filters (same as the records end-point query parameters)
+    filters = JSONField(null=True, blank=True)
+    # hash of the dataset, format, filters and records version. See main.api.export_jobs.get_export_cache_key
+    cache_key = models.CharField(max_length=64, db_index=True)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=STATUS_PENDING)
+    file = models.FileField(upload_to=get_export_path, null=True, blank=True)
+    error = models.TextField(null=True, blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    started = models.DateTimeField(null=True, blank=True)
+    completed = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['-created']
+
+    def __str__(self):
+        return '{}: {} ({})'.format(self.dataset, self.format, self.status)
+
+    @property
+    def is_done(self):
+        return self.status == ExportJob.STATUS_DONE and bool(self.file)
+
+    # API permissions
+    @staticmethod
+    def has_read_permission(request):
+        return True
+
+    def has_object_read_permission(self, request):
+        return True
+
+    @staticmethod
+    def has_metadata_permission(request):
+        return True
+
+    def has_object_metadata_permission(self, request):
+        return True
+
+    @staticmethod
+    def has_create_permission(request):
+        """
+        Records are readable by any authenticated user, so is their export.
+        :param request:
+        :return:
+        """
+        return True
+
+    @staticmethod
+    def has_update_permission(request):
+        """
+        Update not allowed
+        :param request:
+        :return:
+        """
+        return False
+
+    @staticmethod
+    def has_destroy_permission(request):
+        return True
+
+    def has_object_destroy_permission(self, request):
+        return is_admin(request.user) or self.user == request.user
+
+
+class PendingFileDeletion(models.Model):
+    """
+    A file of the default storage to delete. The bulk deletes (see main.api.deletions) don't load the media objects:
+    their files are queued here and deleted in the background by the sweeper.
+    """
+    name = models.CharField(max_length=1024)
+    attempts = models.IntegerField(default=0)
+    error = models.TextField(null=True, blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['id']
+
+
+@python_2_unicode_compatible
+class DeletionJob(models.Model):
+    """
+    A large delete of records, sites, a dataset or a project run in the background (see main.api.deletions).
+    The delete is done in batches, each batch in its own transaction: a cancelled job stops after the current batch and
+    what has been deleted stays deleted.
+    """
+    TARGET_RECORDS = 'records'
+    TARGET_SITES = 'sites'
+    TARGET_DATASET = 'dataset'
+    TARGET_PROJECT = 'project'
+    TARGET_CHOICES = [
+        (TARGET_RECORDS, 'Records'),
+        (TARGET_SITES, 'Sites'),
+        (TARGET_DATASET, 'Dataset'),
+        (TARGET_PROJECT, 'Project'),
+    ]
+    STATUS_PENDING = 'pending'
+    STATUS_RUNNING = 'running'
+    STATUS_DONE = 'done'
+    STATUS_FAILED = 'failed'
+    STATUS_CANCELLED = 'cancelled'
+    STATUS_CHOICES = [
+        (STATUS_PENDING, STATUS_PENDING.capitalize()),
+        (STATUS_RUNNING, STATUS_RUNNING.capitalize()),
+        (STATUS_DONE, STATUS_DONE.capitalize()),
+        (STATUS_FAILED, STATUS_FAILED.capitalize()),
+        (STATUS_CANCELLED, STATUS_CANCELLED.capitalize()),
+    ]
+    target = models.CharField(max_length=20, choices=TARGET_CHOICES)
+    # the dataset for the records and dataset targets, the project for the sites and project targets.
+    # Not a foreign key: the job outlives the deleted object.
+    object_id = models.IntegerField()
+    # the ids of the records or sites to delete. None means all of them.
+    ids = JSONField(null=True, blank=True)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, null=True, blank=True, on_delete=models.SET_NULL)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=STATUS_PENDING)
+    # number of records to delete and deleted so far
+    total = models.IntegerField(null=True, blank=True)
+    deleted = models.IntegerField(default=0)
+    error = models.TextField(null=True, blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    started = models.DateTimeField(null=True, blank=True)
+    completed = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['-created']
+
+    def __str__(self):
+        return '{} {}: {}'.format(self.target, self.object_id, self.status)
+
+    @property
+    def is_finished(self):
+        return self.status in [DeletionJob.STATUS_DONE, DeletionJob.STATUS_FAILED, DeletionJob.STATUS_CANCELLED]
+
+    # API permissions
+    @staticmethod
+    def has_read_permission(request):
+        return True
+
+    def has_object_read_permission(self, request):
+        """
+        A job is visible to its user and the admins only.
+        :param request:
+        :return:
+        """
+        return is_admin(request.user) or self.user == request.user
+
+    @staticmethod
+    def has_metadata_permission(request):
+        return True
+
+    def has_object_metadata_permission(self, request):
+        return True
+
+    @staticmethod
+    def has_write_permission(request):
+        """
+        The jobs are created by the delete end-points.
+        :param request:
+        :return:
+        """
+        return False
+
+    @staticmethod
+    def has_cancel_permission(request):
+        return True
+
+    def has_object_cancel_permission(self, request):
+        return is_admin(request.user) or self.user == request.user
+
+
+class SpeciesSummary(models.Model):
+    """
+    One row per (species_name, name_id) of the records: number of records and datasets, first and last observation
+    and the extent of the records geometry.
+    A table maintained incrementally (see the migration 0025_species_summary), read only. Statement triggers on the
+    records log the changed species in main_speciessummarychange and refresh recomputes the summary of these species
+    only.
+    """
+    REFRESH_LOCK_ID = 7305401
+    # the first 64 bits of the md5 of the species name and name id: the id of a species doesn't change between
+    # refreshes.
+    SUMMARY_SQL = """
+        INSERT INTO main_speciessummary
+        SELECT ('x' || substr(md5(r.species_name || '|' || r.name_id::text), 1, 16))::bit(64)::bigint,
+               r.species_name,
+               r.name_id,
+               count(*),
+               count(DISTINCT r.dataset_id),
+               min(r.datetime),
+               max(r.datetime),
+               ST_SetSRID(ST_Extent(r.geometry)::geometry, {srid})
+        FROM main_record r {join}
+        WHERE r.species_name IS NOT NULL
+        GROUP BY r.species_name, r.name_id
+    """
+    SPECIES_SQL = 'unnest(%s::varchar[], %s::integer[]) AS k (species_name, name_id)'
+
+    id = models.BigIntegerField(primary_key=True)
+    species_name = models.CharField(max_length=500)
+    name_id = models.IntegerField()
+    record_count = models.IntegerField()
+    dataset_count = models.IntegerField()
+    first_observed = models.DateTimeField(null=True)
+    last_observed = models.DateTimeField(null=True)
+    extent = models.GeometryField(srid=MODEL_SRID, null=True)
+
+    class Meta:
+        managed = False
+        db_table = 'main_speciessummary'
+        ordering = ['species_name', 'name_id']
+
+    @property
+    def bbox(self):
+        return list(self.extent.extent) if self.extent else None
+
+    @classmethod
+    def is_stale(cls):
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT EXISTS (SELECT 1 FROM main_speciessummarychange)')
+            return cursor.fetchone()[0]
+
+    @classmethod
+    def refresh(cls, force=False):
+        """
+        Recompute the summary of the species changed since the last refresh, or of all the species if force.
+        The summary can still be read during the refresh. Only one refresh runs at a time (advisory lock): if another
+        refresh is running nothing is done.
+        :return: True if the summary was refreshed
+        """
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute('SELECT pg_try_advisory_xact_lock(%s)', [cls.REFRESH_LOCK_ID])
+            if not cursor.fetchone()[0]:
+                return False
+            # A change locked by a transaction still writing records of the species is skipped: it stays logged for
+            # the next refresh. The others were committed before the statements below, which include their records.
+            cursor.execute('DELETE FROM main_speciessummarychange WHERE id IN ('
+                           'SELECT id FROM main_speciessummarychange FOR UPDATE SKIP LOCKED) '
+                           'RETURNING species_name, name_id')
+            species = set(cursor.fetchall())
+            if force:
+                cursor.execute('DELETE FROM main_speciessummary')
+                cursor.execute(cls.SUMMARY_SQL.format(srid=MODEL_SRID, join=''))
+            elif species:
+                params = [list(values) for values in zip(*species)]
+                cursor.execute('DELETE FROM main_speciessummary s USING {species} '
+                               'WHERE s.species_name = k.species_name AND s.name_id = k.name_id'.format(
+                                   species=cls.SPECIES_SQL), params)
+                join = 'JOIN {species} ON r.species_name = k.species_name AND r.name_id = k.name_id'.format(
+                    species=cls.SPECIES_SQL)
+                cursor.execute(cls.SUMMARY_SQL.format(srid=MODEL_SRID, join=join), params)
+            else:
+                return False
+        return True
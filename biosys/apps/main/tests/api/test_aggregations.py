@@ -0,0 +1,62 @@
+from django.urls import reverse
+from rest_framework import status
+
+from main.models import Dataset
+from main.tests.api import helpers
+
+
+class TestRecordsAggregation(helpers.BaseUserTestCase):
+
+    def _more_setup(self):
+        self.dataset = self._create_dataset_and_records_from_rows([
+            ['Species Name', 'When', 'Latitude', 'Longitude', 'Count'],
+            ['Canis lupus', '2018-01-22', -32, 115.75, 2],
+            ['Koala', '2018-01-10', -35.0, 118, 4],
+            ['Koala', '2018-02-12', -33.333, 111.111, 10],
+            ['Koala', '2018-02-13', -36.5, 120.5, 6],
+        ])
+        self.assertEqual(self.dataset.type, Dataset.TYPE_SPECIES_OBSERVATION)
+        self.url = reverse('api:record-aggregate')
+
+    def _aggregate(self, params, url=None, expected_status=status.HTTP_200_OK):
+        params = dict({'dataset__id': self.dataset.pk}, **params)
+        resp = self.readonly_client.get(url or self.url, params)
+        self.assertEqual(resp.status_code, expected_status)
+        return resp.json()
+
+    def test_count_by_species(self):
+        groups = self._aggregate({'group_by': 'species_name'})
+        self.assertEqual(groups, [
+            {'species_name': 'Canis lupus', 'count': 1},
+            {'species_name': 'Koala', 'count': 3},
+        ])
+
+    def test_count_by_species_and_month_with_metrics(self):
+        groups = self._aggregate({
+            'group_by': 'species_name,datetime__month',
+            'sum': 'Count',
+            'max': 'Count'
+        })
+        self.assertEqual(groups, [
+            {'species_name': 'Canis lupus', 'datetime__month': '2018-01-01', 'count': 1, 'sum.Count': 2.0,
+             'max.Count': 2.0},
+            {'species_name': 'Koala', 'datetime__month': '2018-01-01', 'count': 1, 'sum.Count': 4.0,
+             'max.Count': 4.0},
+            {'species_name': 'Koala', 'datetime__month': '2018-02-01', 'count': 2, 'sum.Count': 16.0,
+             'max.Count': 10.0},
+        ])
+
+    def test_no_group_and_filters(self):
+        groups = self._aggregate({'search': 'Koala', 'sum': 'Count', 'min': 'Count'})
+        self.assertEqual(groups, [{'count': 3, 'sum.Count': 20.0, 'min.Count': 4.0}])
+
+    def test_group_by_data_field_on_dataset_records(self):
+        url = reverse('api:dataset-records-aggregate', kwargs={'pk': self.dataset.pk})
+        groups = self._aggregate({'group_by': 'data.Species Name', 'data.Count__gte': 4}, url=url)
+        self.assertEqual(groups, [{'data.Species Name': 'Koala', 'count': 3}])
+
+    def test_invalid_params(self):
+        self._aggregate({'group_by': 'unknown'}, expected_status=status.HTTP_400_BAD_REQUEST)
+        self._aggregate({'group_by': 'datetime__week'}, expected_status=status.HTTP_400_BAD_REQUEST)
+        self._aggregate({'sum': 'Species Name'}, expected_status=status.HTTP_400_BAD_REQUEST)
+        self._aggregate({'sum': 'Unknown'}, expected_status=status.HTTP_400_BAD_REQUEST)
@@ -0,0 +1,63 @@
+from django.urls import reverse
+from rest_framework import status
+
+from main.tests.api import helpers
+
+
+class TestRecordsCuration(helpers.BaseUserTestCase):
+
+    def _more_setup(self):
+        self.dataset = self._create_dataset_and_records_from_rows([
+            ['What', 'When', 'Latitude', 'Longitude', 'Count'],
+            ['Canis lupus', '2018-01-22', -32.0, 115.75, 2],
+            ['Chubby bat', '2017-05-18', -34.4, 116.78, 10],
+            ['Vulpes vulpes', '2016-01-01', -33.1, 117.1, 20],
+        ])
+        self.url = reverse('api:dataset-records', kwargs={'pk': self.dataset.pk})
+
+    def test_set_flags_with_filters(self):
+        resp = self.custodian_1_client.patch(self.url + '?data.Count__gte=10', {'ids': 'all', 'validated': True},
+                                             format='json')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.json(), {'updated': 2, 'reprocessed': 0})
+        self.assertEqual(self.dataset.record_queryset.filter(validated=True).count(), 2)
+
+        ids = list(self.dataset.record_queryset.values_list('id', flat=True)[:1])
+        resp = self.custodian_1_client.patch(self.url, {'ids': ids, 'locked': True}, format='json')
+        self.assertEqual(resp.json()['updated'], 1)
+        self.assertEqual(list(self.dataset.record_queryset.filter(locked=True).values_list('id', flat=True)), ids)
+
+    def test_patch_data(self):
+        record = self.dataset.record_queryset.get(data__What='Canis lupus')
+        geometry = record.geometry
+        resp = self.custodian_1_client.patch(self.url, {'ids': [record.pk], 'data': {'Count': '5'}}, format='json')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.json(), {'updated': 1, 'reprocessed': 0})
+        record.refresh_from_db()
+        # cast to a number, the other fields unchanged
+        self.assertEqual(record.data['Count'], 5)
+        self.assertEqual(record.data['What'], 'Canis lupus')
+        self.assertEqual(record.geometry, geometry)
+
+    def test_patch_source_of_derived_fields(self):
+        record = self.dataset.record_queryset.get(data__What='Canis lupus')
+        resp = self.custodian_1_client.patch(self.url, {'ids': [record.pk], 'data': {'Latitude': -31.0}},
+                                             format='json')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.json(), {'updated': 1, 'reprocessed': 1})
+        record.refresh_from_db()
+        self.assertEqual(record.geometry.y, -31.0)
+
+    def test_invalid_requests(self):
+        ids = list(self.dataset.record_queryset.values_list('id', flat=True))
+        for payload in [
+            {'ids': ids},
+            {'ids': 'some', 'validated': True},
+            {'ids': ids, 'data': {'Unknown': 1}},
+            {'ids': ids, 'data': {'Count': 'many'}},
+        ]:
+            resp = self.custodian_1_client.patch(self.url, payload, format='json')
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.readonly_client.patch(self.url, {'ids': ids, 'validated': True}, format='json')
+        self.assertEqual(resp.status_code, status.HTTP_403_FORBIDDEN)
+        self.assertEqual(self.dataset.record_queryset.filter(validated=True).count(), 0)
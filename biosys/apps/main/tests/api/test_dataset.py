@@ -1,4 +1,7 @@
+from django.core.management import call_command
 from django.core.urlresolvers import reverse
+from django.test import override_settings
+from django.utils import six
 from rest_framework import status
 
 from main.models import Dataset
@@ -640,7 +643,7 @@ class TestRecordsView(helpers.BaseUserTestCase):
             )
 
     def test_not_allowed_methods(self):
-        not_allowed = ['post', 'put', 'patch']
+        not_allowed = ['post', 'put']
         for method in not_allowed:
             func = getattr(self.client, method)
             if callable(func):
@@ -816,3 +819,90 @@ class TestDatasetRecordsSearchAndOrdering(helpers.BaseUserTestCase):
 
         record_rows = [record['source_info']['row'] for record in json_response]
         self.assertEqual(record_rows, list(reversed(sorted_rows)))
+
+
+@override_settings(DATASET_EXTENT_REFRESH='sync')
+class TestDatasetExtent(helpers.BaseUserTestCase):
+
+    def _more_setup(self):
+        self.dataset = self._create_dataset_and_records_from_rows([
+            ['What', 'When', 'Latitude', 'Longitude'],
+            ['Canis lupus', '2018-02-14', -32.0, 115.75],
+            ['Chubby bat', '2017-05-18', -34.0, 116.0],
+        ])
+        self.url = reverse('api:dataset-detail', kwargs={'pk': self.dataset.pk})
+
+    def _get_extent(self):
+        resp = self.readonly_client.get(self.url)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertNotIn('cached_extent', resp.json())
+        return resp.json()['extent']
+
+    def test_extent_cached(self):
+        self.assertEqual(self._get_extent(), [115.75, -34.0, 116.0, -32.0])
+        self.dataset.refresh_from_db()
+        self.assertFalse(self.dataset.extent_stale)
+        # no aggregate query once cached
+        with self.assertNumQueries(0):
+            self.assertEqual(self.dataset.extent, (115.75, -34.0, 116.0, -32.0))
+
+    def test_extent_expanded_on_upload(self):
+        self._get_extent()
+        resp = self._upload_records_from_rows([
+            ['What', 'When', 'Latitude', 'Longitude'],
+            ['Canis lupus', '2018-02-14', -30.0, 117.0],
+        ], self.dataset.pk)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.dataset.refresh_from_db()
+        self.assertFalse(self.dataset.extent_stale)
+        self.assertEqual(self._get_extent(), [115.75, -34.0, 117.0, -30.0])
+
+    def test_extent_recomputed_after_delete(self):
+        self._get_extent()
+        record = self.dataset.record_queryset.filter(data__What='Chubby bat').first()
+        url = reverse('api:dataset-records', kwargs={'pk': self.dataset.pk})
+        resp = self.custodian_1_client.delete(url, data=[record.pk], format='json')
+        self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+        self.dataset.refresh_from_db()
+        self.assertTrue(self.dataset.extent_stale)
+        self.assertEqual(self._get_extent(), [115.75, -32.0, 115.75, -32.0])
+
+    @override_settings(DATASET_EXTENT_REFRESH='worker')
+    def test_stale_extent_not_recomputed_on_read(self):
+        self.assertEqual(self._get_extent(), [115.75, -34.0, 116.0, -32.0])
+        self.dataset.record_queryset.filter(data__What='Chubby bat').delete()
+        self.dataset.mark_extent_stale()
+        # the previous extent until the refresh
+        self.assertEqual(self._get_extent(), [115.75, -34.0, 116.0, -32.0])
+        call_command('refresh_extents', stdout=six.StringIO())
+        self.assertEqual(self._get_extent(), [115.75, -32.0, 115.75, -32.0])
+
+    def test_stale_again_during_refresh(self):
+        self.dataset.mark_extent_stale()
+        record_queryset = Dataset.record_queryset
+
+        class ConcurrentQuerySet(object):
+            def __init__(self, queryset):
+                self.queryset = queryset
+
+            def aggregate(self, *args, **kwargs):
+                result = self.queryset.aggregate(*args, **kwargs)
+                # a record deleted while the extent is computed
+                Dataset.objects.get(pk=self.queryset.first().dataset_id).mark_extent_stale()
+                return result
+
+        Dataset.record_queryset = property(lambda dataset: ConcurrentQuerySet(record_queryset.fget(dataset)))
+        try:
+            self.assertFalse(self.dataset.refresh_extent())
+        finally:
+            Dataset.record_queryset = record_queryset
+        self.assertTrue(Dataset.objects.get(pk=self.dataset.pk).extent_stale)
+        self.assertTrue(self.dataset.refresh_extent())
+        self.assertFalse(Dataset.objects.get(pk=self.dataset.pk).extent_stale)
+
+    def test_expand_stale_extent(self):
+        self.dataset.mark_extent_stale()
+        version = Dataset.objects.get(pk=self.dataset.pk).extent_version
+        # a refresh running now may not see the new records
+        self.dataset.expand_extent((100.0, -40.0, 101.0, -39.0))
+        self.assertEqual(Dataset.objects.get(pk=self.dataset.pk).extent_version, version + 1)
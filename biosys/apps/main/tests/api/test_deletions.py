@@ -0,0 +1,131 @@
+from django.core.files.storage import default_storage
+from django.test import override_settings
+from django.urls import reverse
+from rest_framework import status
+
+from main.api.deletions import sweep_pending_files, run_pending_deletion_jobs
+from main.models import Dataset, DeletionJob, Media, PendingFileDeletion, Project, Record, Site
+from main.tests import factories
+from main.tests.api import helpers
+
+
+@override_settings(DELETION_JOB_RUNNER='sync', BULK_DELETE_BATCH_SIZE=2)
+class TestBulkDelete(helpers.BaseUserTestCase):
+
+    def _more_setup(self):
+        self.rows = [
+            ['What', 'When', 'Latitude', 'Longitude'],
+            ['Canis lupus', '2018-02-14', -32.0, 115.75],
+            ['Chubby bat', '2017-05-18', -34.4, 116.78],
+            ['Vulpes vulpes', '2016-01-01', -33.1, 117.1],
+        ]
+        self.dataset = self._create_dataset_and_records_from_rows(self.rows)
+        self.site = factories.SiteFactory(project=self.project_1)
+        self.dataset.record_queryset.update(site=self.site)
+        self.media = factories.MediaFactory(record=self.dataset.record_queryset.first())
+
+    def test_delete_all_records(self):
+        file_name = self.media.file.name
+        self.assertTrue(default_storage.exists(file_name))
+        url = reverse('api:dataset-records', kwargs={'pk': self.dataset.pk})
+        resp = self.custodian_1_client.delete(url, data='all', format='json')
+        self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(self.dataset.record_queryset.count(), 0)
+        self.assertFalse(Media.objects.filter(pk=self.media.pk).exists())
+        # the file is deleted by the sweeper
+        self.assertFalse(default_storage.exists(file_name))
+        self.assertEqual(PendingFileDeletion.objects.count(), 0)
+        self.assertTrue(Dataset.objects.get(pk=self.dataset.pk).extent_stale)
+
+    def test_delete_record_ids(self):
+        ids = list(self.dataset.record_queryset.order_by('id').values_list('id', flat=True))
+        url = reverse('api:dataset-records', kwargs={'pk': self.dataset.pk})
+        resp = self.custodian_1_client.delete(url, data=ids[1:], format='json')
+        self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(list(self.dataset.record_queryset.values_list('id', flat=True)), ids[:1])
+
+    def test_delete_sites_keeps_records(self):
+        url = reverse('api:project-sites', kwargs={'pk': self.project_1.pk})
+        resp = self.custodian_1_client.delete(url, data='all', format='json')
+        self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertFalse(Site.objects.filter(pk=self.site.pk).exists())
+        self.assertEqual(self.dataset.record_queryset.count(), len(self.rows) - 1)
+        self.assertEqual(self.dataset.record_queryset.filter(site__isnull=False).count(), 0)
+
+    def test_delete_site(self):
+        url = reverse('api:site-detail', kwargs={'pk': self.site.pk})
+        resp = self.custodian_1_client.delete(url)
+        self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(self.dataset.record_queryset.filter(site__isnull=False).count(), 0)
+
+    def test_delete_dataset(self):
+        url = reverse('api:dataset-detail', kwargs={'pk': self.dataset.pk})
+        resp = self.data_engineer_1_client.delete(url)
+        self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertFalse(Dataset.objects.filter(pk=self.dataset.pk).exists())
+        self.assertEqual(Record.objects.filter(dataset_id=self.dataset.pk).count(), 0)
+
+    def test_delete_project(self):
+        url = reverse('api:project-detail', kwargs={'pk': self.project_1.pk})
+        resp = self.admin_client.delete(url)
+        self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertFalse(Project.objects.filter(pk=self.project_1.pk).exists())
+        self.assertFalse(Dataset.objects.filter(pk=self.dataset.pk).exists())
+        self.assertFalse(Site.objects.filter(pk=self.site.pk).exists())
+
+    @override_settings(BULK_DELETE_JOB_THRESHOLD=1)
+    def test_large_delete_runs_in_a_job(self):
+        url = reverse('api:dataset-records', kwargs={'pk': self.dataset.pk})
+        resp = self.custodian_1_client.delete(url, data='all', format='json')
+        self.assertEqual(resp.status_code, status.HTTP_202_ACCEPTED)
+        job = DeletionJob.objects.get(pk=resp.json()['id'])
+        self.assertEqual(job.target, DeletionJob.TARGET_RECORDS)
+        self.assertEqual(job.total, len(self.rows) - 1)
+        # the sync runner
+        self.assertEqual(job.status, DeletionJob.STATUS_DONE)
+        self.assertEqual(job.deleted, len(self.rows) - 1)
+        self.assertEqual(self.dataset.record_queryset.count(), 0)
+
+        resp = self.custodian_1_client.get(reverse('api:deletion-job-detail', kwargs={'pk': job.pk}))
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.json()['status'], DeletionJob.STATUS_DONE)
+
+    @override_settings(BULK_DELETE_JOB_THRESHOLD=1)
+    def test_jobs_visible_to_their_user(self):
+        url = reverse('api:dataset-records', kwargs={'pk': self.dataset.pk})
+        resp = self.custodian_1_client.delete(url, data='all', format='json')
+        self.assertEqual(resp.status_code, status.HTTP_202_ACCEPTED)
+        job_id = resp.json()['id']
+        detail_url = reverse('api:deletion-job-detail', kwargs={'pk': job_id})
+        list_url = reverse('api:deletion-job-list')
+        for client in [self.custodian_1_client, self.admin_client]:
+            self.assertEqual(client.get(detail_url).status_code, status.HTTP_200_OK)
+            self.assertEqual([j['id'] for j in client.get(list_url).json()], [job_id])
+        self.assertEqual(self.readonly_client.get(detail_url).status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(self.readonly_client.get(list_url).json(), [])
+
+    @override_settings(BULK_DELETE_JOB_THRESHOLD=1, DELETION_JOB_RUNNER='worker')
+    def test_cancel_job(self):
+        url = reverse('api:dataset-detail', kwargs={'pk': self.dataset.pk})
+        resp = self.data_engineer_1_client.delete(url)
+        self.assertEqual(resp.status_code, status.HTTP_202_ACCEPTED)
+        job_id = resp.json()['id']
+        self.assertEqual(resp.json()['status'], DeletionJob.STATUS_PENDING)
+
+        cancel_url = reverse('api:deletion-job-cancel', kwargs={'pk': job_id})
+        # only the job user or an admin
+        self.assertEqual(self.readonly_client.post(cancel_url).status_code, status.HTTP_404_NOT_FOUND)
+        resp = self.data_engineer_1_client.post(cancel_url)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.json()['status'], DeletionJob.STATUS_CANCELLED)
+        self.assertEqual(self.data_engineer_1_client.post(cancel_url).status_code, status.HTTP_409_CONFLICT)
+
+        self.assertEqual(run_pending_deletion_jobs(), 0)
+        self.assertTrue(Dataset.objects.filter(pk=self.dataset.pk).exists())
+
+    def test_sweep_keeps_failed_files(self):
+        PendingFileDeletion.objects.create(name='../outside/of/the/storage')
+        self.assertEqual(sweep_pending_files(), 0)
+        pending = PendingFileDeletion.objects.get()
+        self.assertEqual(pending.attempts, 5)
+        self.assertIsNotNone(pending.error)
@@ -0,0 +1,134 @@
+from django.core.files.storage import default_storage
+from django.test import override_settings
+from django.urls import reverse
+from django.utils import six
+from openpyxl import load_workbook
+from rest_framework import status
+
+from main.models import ExportJob, PendingFileDeletion
+from main.tests.api import helpers
+
+
+@override_settings(EXPORT_JOB_RUNNER='sync', DELETION_JOB_RUNNER='sync',
+                   EXPORTER_CLASS='main.api.exporters.DefaultExporter')
+class TestExportJobs(helpers.BaseUserTestCase):
+
+    def _more_setup(self):
+        self.rows = [
+            ['What', 'When', 'Latitude', 'Longitude'],
+            ['Canis lupus', '2018-02-14', -32.0, 115.75],
+            ['Chubby bat', '2017-05-18', -34.4, 116.78]
+        ]
+        self.dataset = self._create_dataset_and_records_from_rows(self.rows)
+        self.url = reverse('api:export-job-list')
+
+    def _request_export(self, format_='xlsx', filters=None):
+        payload = {
+            'dataset': self.dataset.pk,
+            'format': format_,
+        }
+        if filters is not None:
+            payload['filters'] = filters
+        return self.readonly_client.post(self.url, data=payload, format='json')
+
+    def _download(self, job_id):
+        url = reverse('api:export-job-download', kwargs={'pk': job_id})
+        resp = self.readonly_client.get(url)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        return b''.join(resp.streaming_content)
+
+    def test_xlsx_export(self):
+        resp = self._request_export()
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        job = resp.json()
+        self.assertEqual(job['status'], ExportJob.STATUS_DONE)
+        self.assertIsNotNone(job['download_url'])
+        wb = load_workbook(six.BytesIO(self._download(job['id'])), read_only=True)
+        rows = list(wb[self.dataset.name].rows)
+        self.assertEqual(len(rows), len(self.rows))
+
+    def test_csv_export_with_filters(self):
+        resp = self._request_export('csv', filters={'search': 'Chubby'})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        content = self._download(resp.json()['id']).decode('utf-8')
+        lines = content.strip().splitlines()
+        self.assertEqual(len(lines), 2)
+        self.assertIn('Chubby bat', lines[1])
+
+    def test_export_reused_until_records_change(self):
+        job_id = self._request_export().json()['id']
+        # same export: same job
+        self.assertEqual(self._request_export().json()['id'], job_id)
+        self.assertEqual(ExportJob.objects.count(), 1)
+        # different filters: new job
+        self.assertNotEqual(self._request_export(filters={'search': 'Chubby'}).json()['id'], job_id)
+        # the records changed: new job
+        record = self.dataset.record_queryset.first()
+        record.validated = True
+        record.save()
+        self.assertNotEqual(self._request_export().json()['id'], job_id)
+
+    def test_records_export_served_from_job(self):
+        job_id = self._request_export().json()['id']
+        job = ExportJob.objects.get(pk=job_id)
+        resp = self.readonly_client.get(reverse('api:record-list'), {
+            'dataset__id': self.dataset.pk,
+            'output': 'xlsx'
+        })
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertIn(job.file.name.split('/')[-1], resp.get('content-disposition'))
+
+    def test_own_jobs_only(self):
+        job_id = self._request_export().json()['id']
+        url = reverse('api:export-job-detail', kwargs={'pk': job_id})
+        self.assertEqual(self.readonly_client.get(url).status_code, status.HTTP_200_OK)
+        # another user doesn't see the job and gets its own for the same export
+        self.assertEqual(self.custodian_1_client.get(url).status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(self.custodian_1_client.get(self.url).json(), [])
+        payload = {'dataset': self.dataset.pk, 'format': 'xlsx'}
+        resp = self.custodian_1_client.post(self.url, data=payload, format='json')
+        self.assertNotEqual(resp.json()['id'], job_id)
+        # the admin sees all the jobs
+        self.assertEqual(self.admin_client.get(url).status_code, status.HTTP_200_OK)
+        self.assertEqual(len(self.admin_client.get(self.url).json()), 2)
+
+    def test_file_shared_between_users(self):
+        job = ExportJob.objects.get(pk=self._request_export().json()['id'])
+        payload = {'dataset': self.dataset.pk, 'format': 'xlsx'}
+        resp = self.custodian_1_client.post(self.url, data=payload, format='json')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        other_job = ExportJob.objects.get(pk=resp.json()['id'])
+        self.assertNotEqual(other_job.pk, job.pk)
+        self.assertEqual(other_job.status, ExportJob.STATUS_DONE)
+        self.assertEqual(other_job.file.name, job.file.name)
+        # the file is kept as long as a job shares it
+        resp = self.readonly_client.delete(reverse('api:export-job-detail', kwargs={'pk': job.pk}))
+        self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertTrue(default_storage.exists(other_job.file.name))
+        resp = self.custodian_1_client.delete(reverse('api:export-job-detail', kwargs={'pk': other_job.pk}))
+        self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertFalse(default_storage.exists(other_job.file.name))
+
+    def test_superseded_jobs_deleted(self):
+        job = ExportJob.objects.get(pk=self._request_export().json()['id'])
+        other_job = ExportJob.objects.get(pk=self._request_export(filters={'search': 'Chubby'}).json()['id'])
+        record = self.dataset.record_queryset.first()
+        record.validated = True
+        record.save()
+        new_job_id = self._request_export().json()['id']
+        # the export of the previous records is deleted with its file, not the export with other filters
+        self.assertEqual(set(ExportJob.objects.values_list('pk', flat=True)), {new_job_id, other_job.pk})
+        self.assertFalse(default_storage.exists(job.file.name))
+        self.assertTrue(default_storage.exists(other_job.file.name))
+        self.assertEqual(PendingFileDeletion.objects.count(), 0)
+
+    def test_invalid_filters(self):
+        resp = self._request_export(filters={'bbox': '1,2,3'})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self._request_export(filters='bbox')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(ExportJob.objects.count(), 0)
+
+    def test_anonymous(self):
+        resp = self.anonymous_client.post(self.url, data={'dataset': self.dataset.pk}, format='json')
+        self.assertIn(resp.status_code, [status.HTTP_401_UNAUTHORIZED, status.HTTP_403_FORBIDDEN])
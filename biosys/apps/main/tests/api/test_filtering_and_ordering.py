@@ -4,7 +4,9 @@ from django.urls import reverse
 from django.contrib.gis.geos import Polygon, Point, MultiPolygon
 from rest_framework import status
 
+from main.api.filters import RecordFilterSet
 from main.models import Record, Dataset
+from main.tests import factories
 from main.tests.api import helpers
 
 
@@ -463,6 +465,103 @@ class TestJsonSearchAndOrdering(helpers.BaseUserTestCase):
         records = resp.json()
         self.assertEqual(len(records), expected_number)
 
+    def test_json_filters_are_not_distinct(self):
+        """
+        The data filters are on the record row itself: no DISTINCT that would defeat the GIN index.
+        """
+        filter_set = RecordFilterSet(data={
+            'dataset__id': 1,
+            'data__contains': json.dumps({'Species Name': 'Koala'}),
+            'data__has_key': 'When'
+        }, queryset=Record.objects.all())
+        self.assertTrue(filter_set.is_valid())
+        self.assertFalse(filter_set.qs.query.distinct)
+
+
+class TestDataFieldFilters(helpers.BaseUserTestCase):
+    """
+    The typed filters on the records data: data.<field>__<lookup>=value
+    """
+
+    def _more_setup(self):
+        fields = [
+            {'name': 'What', 'type': 'string'},
+            {'name': 'Count', 'type': 'integer'},
+            {'name': 'Depth', 'type': 'number'},
+            {'name': 'When', 'type': 'date'},
+            {'name': 'Seen', 'type': 'boolean'},
+        ]
+        self.dataset = factories.DatasetFactory(
+            project=self.project_1,
+            type=Dataset.TYPE_GENERIC,
+            data_package=helpers.create_data_package_from_fields(fields))
+        rows = [
+            {'What': 'Koala', 'Count': 1, 'Depth': 0.5, 'When': '2018-01-15', 'Seen': 'yes'},
+            {'What': 'Wombat', 'Count': 12, 'Depth': 2.5, 'When': '20/03/2018', 'Seen': 'no'},
+            {'What': 'Emu', 'Count': 6, 'Depth': 10, 'When': '2017-12-01', 'Seen': 'true'},
+            # a value that is not a number (schema errors can be stored as warnings)
+            {'What': 'Dingo', 'Count': 'many', 'Depth': '', 'When': '', 'Seen': ''},
+        ]
+        for data in rows:
+            Record.objects.create(dataset=self.dataset, data=data)
+        self.url = reverse('api:record-list')
+
+    def _filter(self, params, expected_status=status.HTTP_200_OK):
+        params = dict({'dataset__id': self.dataset.pk}, **params)
+        resp = self.readonly_client.get(self.url, params)
+        self.assertEqual(resp.status_code, expected_status)
+        return sorted(r['data']['What'] for r in resp.json()) if expected_status == status.HTTP_200_OK else resp
+
+    def test_numeric_lookups(self):
+        self.assertEqual(self._filter({'data.Count__gt': 5}), ['Emu', 'Wombat'])
+        # numeric and not lexical comparison
+        self.assertEqual(self._filter({'data.Count__lte': 6}), ['Emu', 'Koala'])
+        self.assertEqual(self._filter({'data.Depth__gte': 2, 'data.Depth__lte': 10}), ['Emu', 'Wombat'])
+        self.assertEqual(self._filter({'data.Count': 12}), ['Wombat'])
+        self.assertEqual(self._filter({'data.Count__in': '1,6'}), ['Emu', 'Koala'])
+        self.assertEqual(self._filter({'data.Count__isnull': 'true'}), ['Dingo'])
+        self.assertEqual(self._filter({'data.Depth__isnull': 'false'}), ['Emu', 'Koala', 'Wombat'])
+
+    def test_date_lookups(self):
+        self.assertEqual(self._filter({'data.When__gte': '2018-01-01'}), ['Koala', 'Wombat'])
+        # day first, like the upload
+        self.assertEqual(self._filter({'data.When__lt': '01/03/2018'}), ['Emu', 'Koala'])
+
+    def test_date_formats(self):
+        # the formats accepted by the upload
+        values = ['20-03-2018', '2018/03/20', '20 Mar 2018', 'March 20, 2018', '20180320', '20.03.2018',
+                  '03/20/2018', '2018-03-20 10:30']
+        for index, value in enumerate(values):
+            Record.objects.create(dataset=self.dataset, data={'What': 'Date {}'.format(index), 'When': value})
+        # not a date
+        invalid = ['31/02/2018', '20 Foo 2018', '2018-13-01']
+        for value in invalid:
+            Record.objects.create(dataset=self.dataset, data={'What': value, 'When': value})
+        expected = sorted(['Wombat'] + ['Date {}'.format(index) for index in range(len(values))])
+        self.assertEqual(self._filter({'data.When': '20/03/2018'}), expected)
+        self.assertEqual(self._filter({'data.When__isnull': 'true'}), sorted(invalid + ['Dingo']))
+
+    def test_boolean_and_text_lookups(self):
+        self.assertEqual(self._filter({'data.Seen': 'true'}), ['Emu', 'Koala'])
+        self.assertEqual(self._filter({'data.What__in': 'Emu,Koala'}), ['Emu', 'Koala'])
+
+    def test_dataset_records_end_point(self):
+        url = reverse('api:dataset-records', kwargs={'pk': self.dataset.pk})
+        resp = self.readonly_client.get(url, {'data.Count__gt': 5})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(resp.json()), 2)
+
+    def test_invalid_filters(self):
+        # unknown field
+        self._filter({'data.Unknown__gt': 5}, status.HTTP_400_BAD_REQUEST)
+        # invalid value for the type
+        self._filter({'data.Count__gt': 'five'}, status.HTTP_400_BAD_REQUEST)
+        # lookup not supported for the type
+        self._filter({'data.Seen__gt': 'true'}, status.HTTP_400_BAD_REQUEST)
+        # no dataset
+        resp = self.readonly_client.get(self.url, {'data.Count__gt': 5})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
 
 class TestSpatialFiltering(helpers.BaseUserTestCase):
     """
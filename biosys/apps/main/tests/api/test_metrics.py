@@ -0,0 +1,91 @@
+from collections import Counter
+
+from django.db import connection
+from django.http import StreamingHttpResponse
+from django.test import RequestFactory, override_settings
+from django.urls import reverse
+from rest_framework import status
+
+from main import utils_metrics
+from main.middleware import RequestMetricsMiddleware
+from main.models import Program
+from main.tests.api import helpers
+
+
+@override_settings(REQUEST_METRICS=True, REQUEST_METRICS_SLOW_SECONDS=None, REQUEST_METRICS_SLOW_QUERIES=None)
+class TestRequestMetrics(helpers.BaseUserTestCase):
+
+    def _more_setup(self):
+        utils_metrics.reset_registry()
+        self.dataset = self._create_dataset_and_records_from_rows([
+            ['What', 'When', 'Latitude', 'Longitude'],
+            ['Canis lupus', '2018-02-14', -32.0, 115.75],
+            ['Chubby bat', '2017-05-18', -34.4, 116.78]
+        ])
+
+    def test_server_timing(self):
+        url = reverse('api:record-list')
+        resp = self.readonly_client.get(url, {'dataset__id': self.dataset.pk})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        timing = resp['Server-Timing']
+        for metric in ['sql;dur=', 'schema;desc=', 'species;dur=', 'serialization;dur=', 'total;dur=']:
+            self.assertIn(metric, timing)
+        self.assertNotIn('sql;dur=0.0;desc="0 queries"', timing)
+
+    def test_prometheus_endpoint(self):
+        self.readonly_client.get(reverse('api:record-list'), {'dataset__id': self.dataset.pk})
+        url = reverse('api:metrics')
+        resp = self.readonly_client.get(url)
+        self.assertEqual(resp.status_code, status.HTTP_403_FORBIDDEN)
+        resp = self.admin_client.get(url)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        content = resp.content.decode('utf-8')
+        self.assertIn('# TYPE biosys_requests_total counter', content)
+        self.assertIn('biosys_request_queries_total{view="api:record-list"}', content)
+
+    def test_queries_counted_when_the_log_is_full(self):
+        # the queries log is capped
+        connection.queries_log.extend([{}] * connection.queries_limit)
+        resp = self.readonly_client.get(reverse('api:record-list'), {'dataset__id': self.dataset.pk})
+        self.assertNotIn('sql;dur=0.0;desc="0 queries"', resp['Server-Timing'])
+
+    def test_streaming_response_queries(self):
+        def content():
+            for _ in range(3):
+                Program.objects.count()
+                yield b'chunk'
+
+        middleware = RequestMetricsMiddleware(lambda request: StreamingHttpResponse(content()))
+        response = middleware(RequestFactory().get('/'))
+        self.assertEqual(b''.join(response.streaming_content), b'chunk' * 3)
+        self.assertIn('biosys_request_queries_total{view="unknown"} 3', utils_metrics.render_prometheus())
+
+    @override_settings(REQUEST_METRICS_SLOW_QUERIES=0)
+    def test_slow_request_logged(self):
+        with self.assertLogs('main.middleware', level='WARNING') as logs:
+            self.readonly_client.get(reverse('api:record-list'), {'dataset__id': self.dataset.pk})
+        self.assertIn('Slow request GET', logs.output[0])
+
+
+class TestMetricsUtils(helpers.BaseUserTestCase):
+
+    def test_top_repeated_queries(self):
+        record_sql = "SELECT * FROM \"main_record\" WHERE \"name\" = 'a' AND id IN (1, 2, 3)"
+        queries = Counter({
+            'SELECT * FROM "main_site" WHERE "main_site"."id" = 1': 1,
+            'SELECT * FROM "main_site" WHERE "main_site"."id" = 2': 1,
+            record_sql: 1,
+            'SELECT * FROM "main_dataset" WHERE "main_dataset"."id" = %s': 3,
+        })
+        repeated = utils_metrics.top_repeated_queries(queries)
+        self.assertEqual(repeated, [(3, 'SELECT * FROM "main_dataset" WHERE "main_dataset"."id" = %s'),
+                                    (2, 'SELECT * FROM "main_site" WHERE "main_site"."id" = ?')])
+        self.assertEqual(utils_metrics.normalize_sql(record_sql),
+                         'SELECT * FROM "main_record" WHERE "name" = ? AND id IN (...)')
+
+    def test_no_metrics_outside_request(self):
+        self.assertIsNone(utils_metrics.current_metrics())
+        # no-op
+        utils_metrics.increment('schema')
+        with utils_metrics.timer('species'):
+            pass
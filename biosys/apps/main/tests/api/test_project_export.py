@@ -0,0 +1,108 @@
+import csv
+import json
+import zipfile
+
+from django.test import TransactionTestCase, override_settings
+from django.urls import reverse
+from django.utils import six
+from rest_framework import status
+
+from main.api.exporters import ProjectDataPackageExporter
+from main.models import Dataset, Record
+from main.tests import factories
+from main.tests.api import helpers
+
+
+# the tests run in a transaction that the export threads (other db connections) can't see.
+@override_settings(PROJECT_EXPORT_WORKERS=1, EXPORTER_CLASS='main.api.exporters.DefaultExporter')
+class TestProjectExport(helpers.BaseUserTestCase):
+
+    def _more_setup(self):
+        self.rows = [
+            ['What', 'When', 'Latitude', 'Longitude'],
+            ['Canis lupus', '2018-02-14', -32.0, 115.75],
+            ['Chubby bat', '2017-05-18', -34.4, 116.78]
+        ]
+        self.dataset = self._create_dataset_and_records_from_rows(self.rows)
+        self.site = factories.SiteFactory.create(project=self.project_1)
+        self.url = reverse('api:project-export', kwargs={'pk': self.project_1.pk})
+
+    def _get_zip(self, client=None):
+        client = client or self.readonly_client
+        resp = client.get(self.url)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get('content-type'), 'application/zip')
+        return zipfile.ZipFile(six.BytesIO(b''.join(resp.streaming_content)))
+
+    def test_data_package(self):
+        zip_ = self._get_zip()
+        self.assertIsNone(zip_.testzip())
+        descriptor = json.loads(zip_.read('datapackage.json').decode('utf-8'))
+        resources = descriptor['resources']
+        self.assertEqual(len(resources), 2)
+        dataset_resource, sites_resource = resources
+        self.assertEqual(dataset_resource['title'], self.dataset.name)
+        self.assertEqual(dataset_resource['schema'], self.dataset.schema_data)
+        self.assertEqual(sites_resource['name'], 'sites')
+        # every resource has its csv
+        for resource in resources:
+            self.assertIn(resource['path'], zip_.namelist())
+
+        content = zip_.read(dataset_resource['path']).decode('utf-8')
+        rows = list(csv.reader(six.StringIO(content)))
+        self.assertEqual(len(rows), len(self.rows))
+        self.assertEqual(rows[0], self.rows[0])
+
+        content = zip_.read(sites_resource['path']).decode('utf-8')
+        rows = list(csv.reader(six.StringIO(content)))
+        self.assertEqual(len(rows), 2)
+        self.assertEqual(rows[1][1], self.site.code)
+
+    def test_empty_project(self):
+        url = reverse('api:project-export', kwargs={'pk': self.project_2.pk})
+        resp = self.readonly_client.get(url)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        zip_ = zipfile.ZipFile(six.BytesIO(b''.join(resp.streaming_content)))
+        descriptor = json.loads(zip_.read('datapackage.json').decode('utf-8'))
+        self.assertEqual([r['name'] for r in descriptor['resources']], ['sites'])
+
+    def test_anonymous(self):
+        resp = self.anonymous_client.get(self.url)
+        self.assertIn(resp.status_code, [status.HTTP_401_UNAUTHORIZED, status.HTTP_403_FORBIDDEN])
+
+
+class TestProjectExportWorkers(TransactionTestCase):
+    """
+    The export of the datasets in parallel threads. The data must be committed to be seen by the threads connections.
+    """
+
+    def setUp(self):
+        self.project = factories.ProjectFactory.create()
+        fields = [
+            {'name': 'What', 'type': 'string'},
+            {'name': 'Count', 'type': 'integer'}
+        ]
+        self.datasets = []
+        for index in range(3):
+            dataset = factories.DatasetFactory.create(
+                project=self.project,
+                name='Dataset {}'.format(index),
+                type=Dataset.TYPE_GENERIC,
+                data_package=helpers.create_data_package_from_fields(fields)
+            )
+            for count in range(index + 1):
+                Record.objects.create(dataset=dataset, data={'What': dataset.name, 'Count': count})
+            self.datasets.append(dataset)
+
+    def test_parallel_export(self):
+        exporter = ProjectDataPackageExporter(self.project, workers=2, prefetch=1)
+        entries = [(name, b''.join(chunks).decode('utf-8')) for name, chunks in exporter.entries()]
+        names = [name for name, content in entries]
+        self.assertEqual(names[0], 'datapackage.json')
+        # the datasets in order, then the sites
+        self.assertEqual(len(names), len(self.datasets) + 2)
+        for dataset, (name, content) in zip(self.datasets, entries[1:]):
+            rows = list(csv.reader(six.StringIO(content)))
+            self.assertEqual(rows[0], ['What', 'Count'])
+            self.assertEqual(rows[1:], [[dataset.name, str(count)] for count in range(len(rows) - 1)])
+            self.assertEqual(len(rows) - 1, dataset.record_queryset.count())
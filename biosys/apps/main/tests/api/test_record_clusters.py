@@ -0,0 +1,68 @@
+from django.urls import reverse
+from rest_framework import status
+
+from main.tests.api import helpers
+
+
+class TestRecordClusters(helpers.BaseUserTestCase):
+
+    def _more_setup(self):
+        self.dataset = self._create_dataset_and_records_from_rows([
+            ['What', 'When', 'Latitude', 'Longitude'],
+            ['Canis lupus', '2018-02-14', -32.0, 115.75],
+            ['Canis lupus', '2018-02-14', -32.01, 115.76],
+            ['Chubby bat', '2017-05-18', -32.02, 115.74],
+            ['Chubby bat', '2017-05-18', -20.0, 120.0],
+        ])
+        self.url = reverse('api:record-clusters')
+
+    def test_grid(self):
+        client = self.readonly_client
+        resp = client.get(self.url, {'dataset__id': self.dataset.pk, 'grid': 1})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        clusters = sorted(resp.json(), key=lambda c: c['count'])
+        self.assertEqual(len(clusters), 2)
+        self.assertEqual([c['count'] for c in clusters], [1, 3])
+        self.assertEqual(clusters[0]['centroid']['type'], 'Point')
+        self.assertEqual(clusters[0]['centroid']['coordinates'], [120.0, -20.0])
+
+        # big grid: one cluster
+        resp = client.get(self.url, {'dataset__id': self.dataset.pk, 'grid': 180})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        clusters = resp.json()
+        self.assertEqual(len(clusters), 1)
+        self.assertEqual(clusters[0]['count'], 4)
+
+    def test_bbox_and_filters(self):
+        client = self.readonly_client
+        resp = client.get(self.url, {'dataset__id': self.dataset.pk, 'bbox': '115,-33,116,-31'})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        clusters = resp.json()
+        self.assertEqual(sum([c['count'] for c in clusters]), 3)
+
+        resp = client.get(self.url, {'dataset__id': self.dataset.pk, 'grid': 180, 'search': 'Chubby'})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        clusters = resp.json()
+        self.assertEqual(len(clusters), 1)
+        self.assertEqual(clusters[0]['count'], 2)
+
+    def test_group_by_dataset(self):
+        client = self.readonly_client
+        resp = client.get(self.url, {'grid': 180, 'group_by': 'dataset'})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        clusters = resp.json()
+        self.assertEqual(len(clusters), 1)
+        self.assertEqual(clusters[0]['dataset'], self.dataset.pk)
+
+    def test_kmeans(self):
+        client = self.readonly_client
+        resp = client.get(self.url, {'dataset__id': self.dataset.pk, 'k': 2})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        clusters = sorted(resp.json(), key=lambda c: c['count'])
+        self.assertEqual([c['count'] for c in clusters], [1, 3])
+
+    def test_bad_parameters(self):
+        client = self.readonly_client
+        for params in [{'bbox': '1,2,3'}, {'grid': 'x'}, {'grid': -1}, {'k': 0}, {'group_by': 'site'}]:
+            resp = client.get(self.url, params)
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST, msg=params)
@@ -1,4 +1,5 @@
 import re
+import unittest
 from os import path
 
 from django.test import override_settings
@@ -8,6 +9,7 @@ from django.shortcuts import reverse
 from django.utils import six
 from rest_framework import status
 
+from main.api.exporters import parquet_available
 from main.tests.api import helpers
 # TODO: remove when python3
 if six.PY2:
@@ -236,3 +238,32 @@ class TestCSVFormat(helpers.BaseUserTestCase):
             self.assertEqual(actual_row, expected_row_string)
 
 
+@unittest.skipUnless(parquet_available(), 'pyarrow not installed')
+class TestParquetFormat(helpers.BaseUserTestCase):
+
+    @override_settings(EXPORTER_CLASS='main.api.exporters.DefaultExporter')
+    def test_happy_path(self):
+        import pyarrow.parquet as pq
+
+        rows = [
+            ['What', 'When', 'Latitude', 'Longitude', 'Count'],
+            ['a big bird in Cottesloe', '2018-01-24', -32.0, 115.75, 2],
+            ['a chubby bat somewhere', '2017-12-24', -33.6, 116.678, 'many'],
+        ]
+        dataset = self._create_dataset_and_records_from_rows(rows)
+        url = reverse('api:record-list')
+        resp = self.custodian_1_client.get(url, {
+            'dataset__id': dataset.pk,
+            'output': 'parquet'
+        })
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertTrue(resp.get('content-disposition').endswith('.parquet'))
+        table = pq.read_table(six.BytesIO(b''.join(resp.streaming_content)))
+        self.assertEqual(table.num_rows, 2)
+        for column in ['What', 'When', 'Latitude', 'Longitude', 'Count', 'id', 'geometry', 'datetime',
+                       'species_name', 'name_id']:
+            self.assertIn(column, table.column_names)
+        data = table.to_pydict()
+        self.assertEqual(data['What'], [rows[1][0], rows[2][0]])
+        self.assertEqual(data['Latitude'], [-32.0, -33.6])
+        self.assertIsNotNone(data['geometry'][0])
@@ -3,9 +3,11 @@ from os import path
 
 from django.contrib.gis.geos import Point
 from django.core.urlresolvers import reverse
+from django.test import override_settings
 from django.utils import timezone
 from rest_framework import status
 
+from main.api.indexes import request_primary_key_index
 from main.models import Dataset, Site
 from main.tests import factories
 from main.tests.api import helpers
@@ -93,6 +95,63 @@ class TestGenericRecord(helpers.BaseUserTestCase):
             self.assertEqual(self.project_1.record_count, len(csv_data) - 1)
             self.assertEqual(self.ds.record_count, len(csv_data) - 1)
 
+    def test_upload_profile(self):
+        csv_data = [
+            ['Column A', 'Column B'],
+            ['A1', 'B1'],
+            ['A2', ''],
+            ['A3', 'B3']
+        ]
+        file_ = helpers.rows_to_csv_file(csv_data)
+        client = self.custodian_1_client
+        with open(file_) as fp:
+            data = {
+                'file': fp,
+                'profile': True
+            }
+            resp = client.post(self.url, data=data, format='multipart')
+        # row 3 has an error
+        self.assertEqual(status.HTTP_400_BAD_REQUEST, resp.status_code)
+        data = resp.json()
+        self.assertEqual([r['row'] for r in data['rows']], [2, 3, 4])
+        profile = data['profile']
+        self.assertEqual(profile['rows'], 3)
+        for stage in ['file', 'read', 'validation', 'site', 'save']:
+            self.assertIn(stage, profile['stages'])
+        # two records saved
+        self.assertEqual(profile['stages']['save']['calls'], 2)
+        self.assertGreaterEqual(profile['stages']['save']['queries'], 2)
+        self.assertGreaterEqual(profile['queries'], 2)
+        self.assertEqual(sorted(r['row'] for r in profile['slowestRows']), [2, 3, 4])
+
+        # without profile: a list of rows
+        with open(file_) as fp:
+            resp = client.post(self.url, data={'file': fp}, format='multipart')
+        self.assertIsInstance(resp.json(), list)
+
+    @override_settings(UPLOAD_VALIDATION_WORKERS=2, UPLOAD_VALIDATION_CHUNK_SIZE=2)
+    def test_upload_parallel_validation(self):
+        csv_data = [
+            ['Column A', 'Column B'],
+            ['A1', 'B1'],
+            ['A2', 'B2'],
+            ['A3', ''],
+            ['A4', 'B4'],
+            ['A5', 'B5'],
+        ]
+        file_ = helpers.rows_to_csv_file(csv_data)
+        client = self.custodian_1_client
+        with open(file_) as fp:
+            resp = client.post(self.url, data={'file': fp, 'strict': True}, format='multipart')
+        self.assertEqual(status.HTTP_400_BAD_REQUEST, resp.status_code)
+        rows = resp.json()
+        # results in the rows order
+        self.assertEqual([r['row'] for r in rows], [2, 3, 4, 5, 6])
+        self.assertEqual([bool(r['errors']) for r in rows], [False, False, True, False, False])
+        records = self.ds.record_queryset.order_by('pk')
+        self.assertEqual([r.data['Column A'] for r in records], ['A1', 'A2', 'A4', 'A5'])
+        self.assertEqual([r.source_info['row'] for r in records], [2, 3, 5, 6])
+
     def test_upload_xlsx_happy_path(self):
         csv_data = [
             ['Column A', 'Column B'],
@@ -336,6 +395,132 @@ class TestGenericRecord(helpers.BaseUserTestCase):
         self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
 
 
+class TestUpsert(helpers.BaseUserTestCase):
+    def _more_setup(self):
+        fields = [
+            {
+                "name": "ID",
+                "type": "integer",
+                "constraints": helpers.REQUIRED_CONSTRAINTS
+            },
+            {
+                "name": "Value",
+                "type": "string",
+            }
+        ]
+        schema = helpers.create_schema_from_fields(fields)
+        schema['primaryKey'] = 'ID'
+        self.ds = factories.DatasetFactory(
+            project=self.project_1,
+            type=Dataset.TYPE_GENERIC,
+            data_package=helpers.create_data_package_from_schema(schema))
+        self.url = reverse('api:dataset-upload', kwargs={'pk': self.ds.pk})
+
+    def _upload(self, rows, **options):
+        file_ = helpers.rows_to_csv_file(rows)
+        with open(file_) as fp:
+            data = dict({'file': fp, 'upsert': True}, **options)
+            return self.custodian_1_client.post(self.url, data=data, format='multipart')
+
+    def test_upsert(self):
+        resp = self._upload([
+            ['ID', 'Value'],
+            [1, 'one'],
+            [2, 'two'],
+        ])
+        self.assertEqual(status.HTTP_200_OK, resp.status_code)
+        self.assertEqual([r['action'] for r in resp.json()], ['created', 'created'])
+        ids = dict((r.data['ID'], r.id) for r in self.ds.record_queryset.all())
+
+        resp = self._upload([
+            ['ID', 'Value'],
+            [1, 'one'],
+            [2, 'TWO'],
+            [3, 'three'],
+        ])
+        self.assertEqual(status.HTTP_200_OK, resp.status_code)
+        self.assertEqual([r['action'] for r in resp.json()], ['unchanged', 'updated', 'created'])
+        records = dict((r.data['ID'], r) for r in self.ds.record_queryset.all())
+        self.assertEqual(len(records), 3)
+        # same ids
+        self.assertEqual(records[1].id, ids[1])
+        self.assertEqual(records[2].id, ids[2])
+        self.assertEqual(records[2].data['Value'], 'TWO')
+
+    def test_index_not_built_in_upload(self):
+        # the index of the primary key is built in the background when the dataset is saved, not in the upload
+        self.assertTrue(self.ds.primary_key_index_outdated)
+        resp = self._upload([['ID', 'Value'], [1, 'one']])
+        self.assertEqual(status.HTTP_200_OK, resp.status_code)
+        self.assertTrue(self.ds.primary_key_index_outdated)
+        with override_settings(PRIMARY_KEY_INDEX_BUILD='worker'):
+            request_primary_key_index(self.ds)
+        self.assertTrue(self.ds.primary_key_index_outdated)
+
+    def test_duplicate_key_in_file(self):
+        resp = self._upload([
+            ['ID', 'Value'],
+            [1, 'one'],
+            [1, 'one again'],
+        ])
+        self.assertEqual(status.HTTP_400_BAD_REQUEST, resp.status_code)
+        self.assertEqual(self.ds.record_queryset.count(), 1)
+
+    def test_upsert_requires_primary_key(self):
+        self.ds.data_package['resources'][0]['schema'].pop('primaryKey')
+        self.ds.save()
+        resp = self._upload([['ID', 'Value'], [1, 'one']])
+        self.assertEqual(status.HTTP_400_BAD_REQUEST, resp.status_code)
+        resp = self._upload([['ID', 'Value'], [1, 'one']], delete_previous=True)
+        self.assertEqual(status.HTTP_400_BAD_REQUEST, resp.status_code)
+
+    def test_upsert_projected_datum(self):
+        # the geometries are in the project datum: they are transformed on update
+        self.project_1.datum = 28350
+        self.project_1.save()
+        fields = [
+            {
+                "name": "ID",
+                "type": "integer",
+                "constraints": helpers.REQUIRED_CONSTRAINTS
+            },
+            {
+                "name": "Easting",
+                "type": "number",
+                "biosys": {
+                    "type": 'easting'
+                }
+            },
+            {
+                "name": "Northing",
+                "type": "number",
+                "biosys": {
+                    "type": 'northing'
+                }
+            }
+        ]
+        schema = helpers.create_schema_from_fields(fields)
+        schema['primaryKey'] = 'ID'
+        self.ds = factories.DatasetFactory(
+            project=self.project_1,
+            type=Dataset.TYPE_OBSERVATION,
+            data_package=helpers.create_data_package_from_schema(schema))
+        self.url = reverse('api:dataset-upload', kwargs={'pk': self.ds.pk})
+        resp = self._upload([['ID', 'Easting', 'Northing'], [1, 405542.537, 6459127.469]])
+        self.assertEqual(status.HTTP_200_OK, resp.status_code)
+        created = self.ds.record_queryset.first()
+
+        resp = self._upload([['ID', 'Easting', 'Northing'], [1, 405542.537, 6469127.469]])
+        self.assertEqual(status.HTTP_200_OK, resp.status_code)
+        self.assertEqual([r['action'] for r in resp.json()], ['updated'])
+        record = self.ds.record_queryset.get(pk=created.pk)
+        self.assertEqual(record.geometry.srid, 4326)
+        # same longitude, 10km north
+        self.assertAlmostEqual(record.geometry.x, created.geometry.x, places=2)
+        self.assertGreater(record.geometry.y, created.geometry.y + 0.08)
+        self.assertLess(record.geometry.y, created.geometry.y + 0.1)
+
+
 class TestObservation(helpers.BaseUserTestCase):
     all_fields_nothing_required = [
         {
@@ -428,6 +613,85 @@ class TestObservation(helpers.BaseUserTestCase):
         self.assertIsNotNone(self.site)
         self.assertEqual(self.site.code, 'COT')
 
+    def test_dry_run(self):
+        csv_data = [
+            ['What', 'Site', 'Latitude', 'Longitude'],
+            ['Site geometry', self.site.code, '', ''],
+            ['New site', 'NEW', -32.0, 115.0],
+            ['Unknown site', 'NOPE', '', ''],
+            ['Unknown site again', 'NOPE', '', ''],
+        ]
+        file_ = helpers.rows_to_csv_file(csv_data)
+        site_count = Site.objects.count()
+        with open(file_) as fp:
+            data = {
+                'file': fp,
+                'strict': True,
+                'create_site': True,
+                'delete_previous': True,
+                'dry_run': True
+            }
+            resp = self.client.post(self.url, data=data, format='multipart')
+        self.assertEqual(status.HTTP_400_BAD_REQUEST, resp.status_code)
+        summary = resp.json()
+        self.assertEqual(summary['rows'], 4)
+        self.assertEqual(summary['validRows'], 2)
+        self.assertEqual(summary['invalidRows'], 2)
+        # errors grouped by column and message
+        site_errors = [e for e in summary['errors'] if e['message'] == 'The site NOPE does not exist']
+        self.assertTrue(site_errors)
+        self.assertEqual(site_errors[0]['count'], 2)
+        self.assertEqual(site_errors[0]['rows'], [4, 5])
+        warnings = [w for w in summary['warnings'] if w['column'] == 'Site']
+        self.assertEqual(len(warnings), 1)
+        self.assertEqual(warnings[0]['rows'], [3])
+        # nothing written
+        self.assertEqual(self.dataset.record_queryset.count(), 0)
+        self.assertEqual(Site.objects.count(), site_count)
+
+    @override_settings(UPLOAD_VALIDATION_WORKERS=2, UPLOAD_VALIDATION_CHUNK_SIZE=2)
+    def test_site_geometry_parallel_validation(self):
+        # the workers get the project sites from the upload
+        csv_data = [
+            ['What', 'Site'],
+            ['One', self.site.code],
+            ['Two', self.site.code],
+            ['Three', self.site.code],
+            ['Unknown', 'NOPE'],
+        ]
+        file_ = helpers.rows_to_csv_file(csv_data)
+        with open(file_) as fp:
+            resp = self.client.post(self.url, data={'file': fp, 'strict': True}, format='multipart')
+        self.assertEqual(status.HTTP_400_BAD_REQUEST, resp.status_code)
+        self.assertEqual([bool(r['errors']) for r in resp.json()], [False, False, False, True])
+        records = self.dataset.record_queryset.all()
+        self.assertEqual(len(records), 3)
+        for record in records:
+            self.assertEqual(record.geometry, self.site.geometry)
+
+    @override_settings(UPLOAD_VALIDATION_WORKERS=2, UPLOAD_VALIDATION_CHUNK_SIZE=2)
+    def test_create_site_parallel_validation(self):
+        # the second chunk uses the geometry of a site created by the first chunk
+        csv_data = [
+            ['What', 'Site', 'Latitude', 'Longitude'],
+            ['New site', 'NEW', -32.0, 115.0],
+            ['Site geometry', self.site.code, '', ''],
+            ['New site geometry', 'NEW', '', ''],
+            ['New site geometry again', 'NEW', '', ''],
+        ]
+        file_ = helpers.rows_to_csv_file(csv_data)
+        with open(file_) as fp:
+            data = {
+                'file': fp,
+                'strict': True,
+                'create_site': True
+            }
+            resp = self.client.post(self.url, data=data, format='multipart')
+        self.assertEqual(status.HTTP_200_OK, resp.status_code)
+        site = Site.objects.filter(project=self.project, code='NEW').first()
+        self.assertIsNotNone(site)
+        self.assertEqual(self.dataset.record_queryset.filter(site=site).count(), 3)
+
     def test_site_no_date(self):
         csv_data = [
             ['What', 'Site'],
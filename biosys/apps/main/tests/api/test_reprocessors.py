@@ -0,0 +1,69 @@
+import datetime
+
+import pytz
+from django.contrib.gis.geos import Point
+
+from main.api.reprocessors import RecordReprocessor
+from main.models import Dataset
+from main.tests.api import helpers
+
+
+class TestRecordReprocessor(helpers.BaseUserTestCase):
+
+    def _more_setup(self):
+        self.dataset = self._create_dataset_and_records_from_rows([
+            ['What', 'When', 'Latitude', 'Longitude'],
+            ['Canis lupus', '2018-01-22', -32.0, 115.75],
+            ['Chubby bat', '2017-05-18', -34.4, 116.78],
+            ['Vulpes vulpes', '2016-01-01', -33.1, 117.1],
+        ])
+        self.assertEqual(self.dataset.type, Dataset.TYPE_OBSERVATION)
+
+    def test_timezone_change(self):
+        sydney = pytz.timezone('Australia/Sydney')
+        self.project_1.timezone = sydney
+        self.project_1.save()
+        self.dataset.refresh_from_db()
+        old = sydney.localize(datetime.datetime(2000, 1, 1))
+        self.dataset.record_queryset.update(last_modified=old)
+
+        result = RecordReprocessor(self.dataset, batch_size=2).run()
+        self.assertEqual(result['processed'], 3)
+        self.assertEqual(result['updated'], 3)
+        self.assertEqual(result['error_count'], 0)
+        record = self.dataset.record_queryset.get(data__What='Canis lupus')
+        self.assertEqual(record.datetime, sydney.localize(datetime.datetime(2018, 1, 22)))
+        # the export cache key uses last_modified
+        self.assertGreater(record.last_modified, old)
+        # nothing changed since
+        self.assertEqual(RecordReprocessor(self.dataset).run()['updated'], 0)
+
+    def test_invalid_records_are_reported(self):
+        record = self.dataset.record_queryset.get(data__What='Chubby bat')
+        record.data['Latitude'] = 'not a number'
+        record.save()
+        geometry = record.geometry
+        result = RecordReprocessor(self.dataset).run()
+        self.assertEqual(result['updated'], 0)
+        self.assertEqual(result['error_count'], 1)
+        self.assertEqual(result['errors'][0]['id'], record.pk)
+        self.assertTrue(result['errors'][0]['errors'])
+        # not updated
+        record.refresh_from_db()
+        self.assertEqual(record.geometry, geometry)
+
+    def test_values_not_derived_are_kept(self):
+        dataset = self._create_dataset_and_records_from_rows([
+            ['What', 'Count'],
+            ['Canis lupus', 2],
+        ])
+        self.assertEqual(dataset.type, Dataset.TYPE_GENERIC)
+        when = pytz.utc.localize(datetime.datetime(2018, 1, 22))
+        # set by the client: a generic dataset derives no datetime or geometry
+        dataset.record_queryset.update(datetime=when, geometry=Point(115.75, -32.0))
+        result = RecordReprocessor(dataset).run()
+        self.assertEqual(result['error_count'], 0)
+        self.assertEqual(result['updated'], 0)
+        record = dataset.record_queryset.first()
+        self.assertEqual(record.datetime, when)
+        self.assertEqual((record.geometry.x, record.geometry.y), (115.75, -32.0))
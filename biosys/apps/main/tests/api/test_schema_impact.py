@@ -0,0 +1,149 @@
+import copy
+
+from django.contrib.gis.geos import Point
+from django.test import override_settings
+from django.urls import reverse
+from rest_framework import status
+
+from main.api.schema_impact import SchemaImpactChecker
+from main.models import Dataset, Record
+from main.tests import factories
+from main.tests.api import helpers
+
+
+class TestSchemaImpact(helpers.BaseUserTestCase):
+
+    def _more_setup(self):
+        self.dataset = self._create_dataset_and_records_from_rows([
+            ['What', 'When', 'Latitude', 'Longitude'],
+            ['Canis lupus', '2018-01-22', -32.0, 115.75],
+            ['Chubby bat', '2017-05-18', -34.4, 116.78],
+            ['Vulpes vulpes', '2016-01-01', -33.1, 117.1],
+        ])
+        self.url = reverse('api:dataset-schema-impact', kwargs={'pk': self.dataset.pk})
+
+    def _data_package(self, field_name=None, **field_changes):
+        data_package = copy.deepcopy(self.dataset.data_package)
+        fields = data_package['resources'][0]['schema']['fields']
+        if field_name is None:
+            fields.append({'name': 'Comments', 'type': 'string'})
+        else:
+            field = [f for f in fields if f['name'] == field_name][0]
+            field.update(field_changes)
+        return data_package
+
+    def test_safe_change_applied(self):
+        data_package = self._data_package()
+        resp = self.data_engineer_1_client.post(self.url, {'data_package': data_package}, format='json')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.json()['rows'], 3)
+        self.assertTrue(resp.json()['safe'])
+        self.assertFalse(resp.json()['applied'])
+        self.assertNotEqual(Dataset.objects.get(pk=self.dataset.pk).data_package, data_package)
+
+        resp = self.data_engineer_1_client.post(self.url, {'data_package': data_package, 'apply': True}, format='json')
+        self.assertTrue(resp.json()['applied'])
+        self.assertEqual(Dataset.objects.get(pk=self.dataset.pk).data_package, data_package)
+
+    def test_unsafe_change(self):
+        data_package = self._data_package('Latitude', constraints={'maximum': -33})
+        resp = self.data_engineer_1_client.post(self.url, {'data_package': data_package, 'apply': True}, format='json')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        summary = resp.json()
+        self.assertFalse(summary['safe'])
+        self.assertFalse(summary['applied'])
+        self.assertEqual(summary['invalidRows'], 1)
+        record = self.dataset.record_queryset.get(data__What='Canis lupus')
+        self.assertIn('Latitude', [error['column'] for error in summary['errors']])
+        self.assertEqual(summary['errors'][0]['rows'], [record.pk])
+
+        # the dataset update is refused too
+        url = reverse('api:dataset-detail', kwargs={'pk': self.dataset.pk})
+        payload = self.data_engineer_1_client.get(url).json()
+        payload['data_package'] = data_package
+        resp = self.data_engineer_1_client.put(url, payload, format='json')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('data_package', resp.json())
+
+    @override_settings(DATASET_SCHEMA_CHECK_MAX_RECORDS=2)
+    def test_big_dataset_update_refused(self):
+        # too many records to be checked in the dataset update: the schema-impact end-point must be used
+        data_package = self._data_package()
+        url = reverse('api:dataset-detail', kwargs={'pk': self.dataset.pk})
+        payload = self.data_engineer_1_client.get(url).json()
+        payload['data_package'] = data_package
+        resp = self.data_engineer_1_client.put(url, payload, format='json')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('schema-impact', resp.json()['data_package'][0])
+
+        resp = self.data_engineer_1_client.post(self.url, {'data_package': data_package, 'apply': True}, format='json')
+        self.assertTrue(resp.json()['applied'])
+
+    def test_permissions_and_invalid_schema(self):
+        data_package = self._data_package()
+        resp = self.readonly_client.post(self.url, {'data_package': data_package}, format='json')
+        self.assertEqual(resp.status_code, status.HTTP_403_FORBIDDEN)
+        resp = self.data_engineer_1_client.post(self.url, {'data_package': {}}, format='json')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class TestSchemaImpactLookups(helpers.BaseUserTestCase):
+    """
+    The sites and the species are looked up like in the upload.
+    """
+
+    def _add_comments_field(self, dataset):
+        data_package = copy.deepcopy(dataset.data_package)
+        data_package['resources'][0]['schema']['fields'].append({'name': 'Comments', 'type': 'string'})
+        return data_package
+
+    def _site_code_dataset(self):
+        # same code, no geometry, in another project
+        factories.SiteFactory(project=self.project_2, code='S1', geometry=None)
+        factories.SiteFactory(project=self.project_1, code='S1', geometry=Point(115.75, -32.0))
+        fields = [
+            {'name': 'When', 'type': 'date', 'format': 'any', 'constraints': helpers.REQUIRED_CONSTRAINTS,
+             'biosys': {'type': 'observationDate'}},
+            {'name': 'Site Code', 'type': 'string', 'constraints': helpers.REQUIRED_CONSTRAINTS,
+             'biosys': {'type': 'siteCode'}},
+        ]
+        dataset = factories.DatasetFactory(
+            project=self.project_1,
+            type=Dataset.TYPE_OBSERVATION,
+            data_package=helpers.create_data_package_from_fields(fields))
+        for day in range(1, 4):
+            Record.objects.create(dataset=dataset, data={'When': '2018-01-0{}'.format(day), 'Site Code': 'S1'})
+        return dataset
+
+    def test_site_of_the_project(self):
+        dataset = self._site_code_dataset()
+        summary = SchemaImpactChecker(dataset, self._add_comments_field(dataset), workers=1).run()
+        self.assertEqual(summary.valid_rows, 3)
+
+    def test_site_of_the_project_in_workers(self):
+        dataset = self._site_code_dataset()
+        summary = SchemaImpactChecker(dataset, self._add_comments_field(dataset), workers=2, chunk_size=1).run()
+        self.assertEqual(summary.valid_rows, 3)
+
+    def test_species_name_id(self):
+        fields = [
+            {'name': 'When', 'type': 'date', 'format': 'any', 'constraints': helpers.REQUIRED_CONSTRAINTS,
+             'biosys': {'type': 'observationDate'}},
+            {'name': 'Latitude', 'type': 'number', 'biosys': {'type': 'latitude'}},
+            {'name': 'Longitude', 'type': 'number', 'biosys': {'type': 'longitude'}},
+            {'name': 'Name Id', 'type': 'integer', 'constraints': helpers.REQUIRED_CONSTRAINTS,
+             'biosys': {'type': 'speciesNameId'}},
+        ]
+        dataset = factories.DatasetFactory(
+            project=self.project_1,
+            type=Dataset.TYPE_SPECIES_OBSERVATION,
+            data_package=helpers.create_data_package_from_fields(fields))
+        for name_id in [25454, 999999]:
+            Record.objects.create(dataset=dataset, data={
+                'When': '2018-01-01', 'Latitude': -32.0, 'Longitude': 115.75, 'Name Id': name_id
+            })
+        checker = SchemaImpactChecker(dataset, self._add_comments_field(dataset), workers=1,
+                                      species_facade_class=helpers.LightSpeciesFacade)
+        summary = checker.run()
+        # the unknown name id
+        self.assertEqual(summary.valid_rows, 1)
@@ -0,0 +1,76 @@
+from django.contrib.gis.geos import Point
+from django.urls import reverse
+from rest_framework import status
+
+from main.tests import factories
+from main.tests.api import helpers
+
+
+class TestRecordSpatialFilters(helpers.BaseUserTestCase):
+
+    def _more_setup(self):
+        self.dataset = self._create_dataset_and_records_from_rows([
+            ['What', 'When', 'Latitude', 'Longitude'],
+            ['Canis lupus', '2018-02-14', -32.0, 115.75],
+            ['Chubby bat', '2017-05-18', -32.01, 115.76],
+            ['Chubby bat', '2017-05-18', -20.0, 120.0],
+        ])
+        self.url = reverse('api:record-list')
+
+    def _get(self, params):
+        params['dataset__id'] = self.dataset.pk
+        return self.readonly_client.get(self.url, params)
+
+    def test_bbox(self):
+        resp = self._get({'bbox': '115,-33,116,-31'})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(resp.json()), 2)
+
+        resp = self._get({'bbox': '0,0,1,1'})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(resp.json()), 0)
+
+    def test_dwithin(self):
+        # the 2 records near Perth are ~1.4km apart
+        resp = self._get({'dwithin': '115.75,-32.0,100'})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(resp.json()), 1)
+
+        resp = self._get({'dwithin': '115.75,-32.0,5000'})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(resp.json()), 2)
+
+    def test_nearest(self):
+        resp = self._get({'nearest': '120.1,-20.1', 'limit': 2})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        results = resp.json()['results']
+        self.assertEqual(len(results), 2)
+        self.assertEqual(results[0]['geometry']['coordinates'], [120.0, -20.0])
+
+    def test_nearest_with_ordering(self):
+        # the ordering param would replace the distance ordering
+        resp = self._get({'nearest': '120.1,-20.1', 'ordering': 'What', 'limit': 2})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_bad_values(self):
+        for params in [{'bbox': '1,2,3'}, {'bbox': '3,2,1,0'}, {'dwithin': '115,-32'}, {'nearest': 'a,b'}]:
+            resp = self._get(params)
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST, msg=params)
+
+
+class TestSiteSpatialFilters(helpers.BaseUserTestCase):
+
+    def _more_setup(self):
+        self.site_1 = factories.SiteFactory.create(project=self.project_1, geometry=Point(115.75, -32.0))
+        self.site_2 = factories.SiteFactory.create(project=self.project_1, geometry=Point(120.0, -20.0))
+
+    def test_sites_bbox(self):
+        resp = self.readonly_client.get(reverse('api:site-list'), {'bbox': '115,-33,116,-31'})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual([s['id'] for s in resp.json()], [self.site_1.pk])
+
+    def test_project_sites_dwithin(self):
+        url = reverse('api:project-sites', kwargs={'pk': self.project_1.pk})
+        resp = self.readonly_client.get(url, {'dwithin': '120.0,-20.0,10'})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual([s['id'] for s in resp.json()], [self.site_2.pk])
@@ -0,0 +1,53 @@
+import datetime
+
+from django.utils import timezone
+
+from main.api.species_matching import rematch_species
+from main.tests.api import helpers
+from main.utils_species import SpeciesFacade
+
+
+class UpdatedSpeciesFacade(SpeciesFacade):
+    def name_id_by_species_name(self):
+        return {
+            'Canis lupus lupus': 25454,  # renamed
+            'Koala': 1234,  # new species
+        }
+
+
+class TestRematchSpecies(helpers.BaseUserTestCase):
+
+    def _more_setup(self):
+        self.dataset = self._create_dataset_and_records_from_rows([
+            ['Species Name', 'When', 'Latitude', 'Longitude'],
+            ['Canis lupus', '2018-01-22', -32, 115.75],
+            ['Koala', '2018-01-10', -35.0, 118],
+            ['Koala', '2018-02-12', -33.0, 111],
+            ['Unknown species', '2018-02-13', -36.5, 120.5],
+        ])
+
+    def _species(self):
+        return sorted(self.dataset.record_queryset.values_list('species_name', 'name_id'))
+
+    def test_rematch(self):
+        self.assertEqual(self._species(), [
+            ('Canis lupus', 25454),
+            ('Koala', -1),
+            ('Koala', -1),
+            ('Unknown species', -1),
+        ])
+        old = timezone.make_aware(datetime.datetime(2000, 1, 1))
+        self.dataset.record_queryset.update(last_modified=old)
+        result = rematch_species(species_facade_class=UpdatedSpeciesFacade, batch_size=1)
+        self.assertEqual(result, {'resolved': 2, 'renamed': 1})
+        self.assertEqual(self._species(), [
+            ('Canis lupus lupus', 25454),
+            ('Koala', 1234),
+            ('Koala', 1234),
+            ('Unknown species', -1),
+        ])
+        # the updated records are modified (export cache)
+        self.assertEqual(self.dataset.record_queryset.filter(last_modified=old).count(), 1)
+        # nothing left to do
+        result = rematch_species(species_facade_class=UpdatedSpeciesFacade)
+        self.assertEqual(result, {'resolved': 0, 'renamed': 0})
@@ -0,0 +1,96 @@
+from django.db import connection
+from django.test import override_settings
+from django.urls import reverse
+from rest_framework import status
+from rest_framework.test import APIClient
+
+from main.models import SpeciesSummary
+from main.tests.api import helpers
+
+
+@override_settings(SPECIES_SUMMARY_REFRESH='sync')
+class TestSpeciesSummary(helpers.BaseUserTestCase):
+
+    def _more_setup(self):
+        self.dataset = self._create_dataset_and_records_from_rows([
+            ['Species Name', 'When', 'Latitude', 'Longitude'],
+            ['Canis lupus', '2018-01-22', -32, 115.75],
+            ['Koala', '2018-01-10', -35.0, 118],
+            ['Koala', '2018-02-12', -33.0, 111],
+            ['Koala', '2018-02-13', -36.5, 120.5],
+        ])
+
+    def test_species_list_from_summary(self):
+        resp = APIClient().get(reverse('api:species'))
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.json(), ['Canis lupus', 'Koala'])
+        self.assertFalse(SpeciesSummary.is_stale())
+
+        resp = APIClient().get(reverse('api:species'), {'search': 'koa'})
+        self.assertEqual(resp.json(), ['Koala'])
+
+    def test_species_detail(self):
+        url = reverse('api:species-detail', kwargs={'species_name': 'Koala'})
+        resp = self.readonly_client.get(url)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        summaries = resp.json()
+        self.assertEqual(len(summaries), 1)
+        summary = summaries[0]
+        self.assertEqual(summary['species_name'], 'Koala')
+        self.assertEqual(summary['record_count'], 3)
+        self.assertEqual(summary['dataset_count'], 1)
+        self.assertEqual(summary['bbox'], [111.0, -36.5, 120.5, -33.0])
+        self.assertIsNotNone(summary['first_observed'])
+
+        url = reverse('api:species-detail', kwargs={'species_name': 'Unknown'})
+        self.assertEqual(self.readonly_client.get(url).status_code, status.HTTP_404_NOT_FOUND)
+
+        # authenticated only
+        url = reverse('api:species-detail', kwargs={'species_name': 'Koala'})
+        self.assertIn(APIClient().get(url).status_code, [status.HTTP_401_UNAUTHORIZED, status.HTTP_403_FORBIDDEN])
+
+    def test_id_stable_across_refreshes(self):
+        self.readonly_client.get(reverse('api:species'))
+        koala_id = SpeciesSummary.objects.get(species_name='Koala').id
+        # a species before Koala disappears: its row number would change
+        self.dataset.record_queryset.filter(species_name='Canis lupus').delete()
+        self.readonly_client.get(reverse('api:species'))
+        self.assertEqual(SpeciesSummary.objects.get(species_name='Koala').id, koala_id)
+
+    def test_refreshed_after_records_change(self):
+        self.assertEqual(self.readonly_client.get(reverse('api:species')).json(), ['Canis lupus', 'Koala'])
+        self.dataset.record_queryset.filter(species_name='Canis lupus').delete()
+        self.assertTrue(SpeciesSummary.is_stale())
+        self.assertEqual(self.readonly_client.get(reverse('api:species')).json(), ['Koala'])
+
+    def test_changed_species_only(self):
+        self.assertTrue(SpeciesSummary.refresh())
+        canis_lupus = SpeciesSummary.objects.get(species_name='Canis lupus')
+        # the fields of the summary didn't change
+        self.dataset.record_queryset.update(validated=True)
+        self.assertFalse(SpeciesSummary.is_stale())
+
+        record = self.dataset.record_queryset.filter(species_name='Koala').order_by('id').first()
+        record.species_name = 'Phascolarctos cinereus'
+        record.save()
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT DISTINCT species_name FROM main_speciessummarychange ORDER BY species_name')
+            self.assertEqual([row[0] for row in cursor.fetchall()], ['Koala', 'Phascolarctos cinereus'])
+        self.assertTrue(SpeciesSummary.refresh())
+        self.assertFalse(SpeciesSummary.is_stale())
+        self.assertEqual(SpeciesSummary.objects.get(species_name='Koala').record_count, 2)
+        self.assertEqual(SpeciesSummary.objects.get(species_name='Phascolarctos cinereus').record_count, 1)
+        self.assertEqual(SpeciesSummary.objects.get(species_name='Canis lupus').bbox, canis_lupus.bbox)
+
+    def test_force_refresh(self):
+        self.assertTrue(SpeciesSummary.refresh())
+        self.assertTrue(SpeciesSummary.refresh(force=True))
+        self.assertEqual(SpeciesSummary.objects.count(), 2)
+
+    @override_settings(SPECIES_SUMMARY_REFRESH='worker')
+    def test_worker_refresh(self):
+        # not refreshed by the request
+        self.assertEqual(self.readonly_client.get(reverse('api:species')).json(), [])
+        self.assertTrue(SpeciesSummary.refresh())
+        self.assertFalse(SpeciesSummary.refresh())
+        self.assertEqual(self.readonly_client.get(reverse('api:species')).json(), ['Canis lupus', 'Koala'])
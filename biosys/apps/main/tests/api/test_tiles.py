@@ -0,0 +1,125 @@
+from django.core.cache import cache
+from django.urls import reverse
+from rest_framework import status
+
+from main.tests.api import helpers
+from main.utils_geo import tile_bounds, is_valid_tile, WEB_MERCATOR_MAX, get_tile_generation, invalidate_tiles
+
+
+class TestTileUtils(helpers.BaseUserTestCase):
+
+    def test_tile_bounds(self):
+        world = (-WEB_MERCATOR_MAX, -WEB_MERCATOR_MAX, WEB_MERCATOR_MAX, WEB_MERCATOR_MAX)
+        self.assertEqual(tile_bounds(0, 0, 0), world)
+        xmin, ymin, xmax, ymax = tile_bounds(1, 1, 0)
+        self.assertEqual((xmin, ymin), (0, 0))
+        self.assertEqual((xmax, ymax), (WEB_MERCATOR_MAX, WEB_MERCATOR_MAX))
+
+    def test_is_valid_tile(self):
+        self.assertTrue(is_valid_tile(0, 0, 0))
+        self.assertTrue(is_valid_tile(2, 3, 3))
+        self.assertFalse(is_valid_tile(2, 4, 0))
+        self.assertFalse(is_valid_tile(1, 0, 2))
+        self.assertFalse(is_valid_tile(-1, 0, 0))
+
+    def test_tile_generation(self):
+        project_id = self.project_1.pk
+        generation = get_tile_generation(project_id)
+        invalidate_tiles(project_id)
+        # not in the cache: shared by all the processes
+        cache.clear()
+        self.assertEqual(get_tile_generation(project_id), generation + 1)
+        invalidate_tiles(project_id)
+        self.assertEqual(get_tile_generation(project_id), generation + 2)
+        self.assertEqual(get_tile_generation(self.project_2.pk), 0)
+
+
+class TestDatasetTiles(helpers.BaseUserTestCase):
+
+    def _more_setup(self):
+        cache.clear()
+        self.dataset = self._create_dataset_and_records_from_rows([
+            ['What', 'When', 'Latitude', 'Longitude'],
+            ['Canis lupus', '2018-02-14', -32.0, 115.75],
+            ['Chubby bat', '2017-05-18', -34.4, 116.78]
+        ])
+
+    def _url(self, z, x, y, dataset=None):
+        dataset = dataset or self.dataset
+        return reverse('api:dataset-tiles', kwargs={'pk': dataset.pk, 'z': z, 'x': x, 'y': y})
+
+    def test_world_tile(self):
+        client = self.readonly_client
+        resp = client.get(self._url(0, 0, 0))
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp['Content-Type'], 'application/vnd.mapbox-vector-tile')
+        self.assertTrue(len(resp.content) > 0)
+
+    def test_empty_tile(self):
+        # north west quadrant. Our records are in Australia (south east).
+        client = self.readonly_client
+        resp = client.get(self._url(1, 0, 0))
+        self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+
+    def test_filters_apply(self):
+        client = self.readonly_client
+        resp = client.get(self._url(0, 0, 0), {'id': -1})
+        self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+
+    def test_invalid_tile(self):
+        client = self.readonly_client
+        resp = client.get(self._url(1, 2, 0))
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_anonymous(self):
+        client = self.anonymous_client
+        resp = client.get(self._url(0, 0, 0))
+        self.assertIn(resp.status_code, [status.HTTP_401_UNAUTHORIZED, status.HTTP_403_FORBIDDEN])
+
+
+class TestProjectTiles(helpers.BaseUserTestCase):
+
+    def _more_setup(self):
+        cache.clear()
+        self.dataset = self._create_dataset_and_records_from_rows([
+            ['What', 'When', 'Latitude', 'Longitude'],
+            ['Canis lupus', '2018-02-14', -32.0, 115.75],
+        ])
+
+    def test_world_tile(self):
+        client = self.readonly_client
+        url = reverse('api:project-tiles', kwargs={'pk': self.project_1.pk, 'z': 0, 'x': 0, 'y': 0})
+        resp = client.get(url)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertTrue(len(resp.content) > 0)
+
+        # other project is empty
+        url = reverse('api:project-tiles', kwargs={'pk': self.project_2.pk, 'z': 0, 'x': 0, 'y': 0})
+        resp = client.get(url)
+        self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+
+    def test_new_site(self):
+        client = self.admin_client
+        url = reverse('api:project-tiles', kwargs={'pk': self.project_2.pk, 'z': 0, 'x': 0, 'y': 0})
+        self.assertEqual(client.get(url).status_code, status.HTTP_204_NO_CONTENT)
+        site = {
+            'code': 'NEW1',
+            'geometry': {'type': 'Point', 'coordinates': [115.75, -32.0]}
+        }
+        resp = client.post(reverse('api:project-sites', kwargs={'pk': self.project_2.pk}), [site], format='json')
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        # the cached empty tile is not served anymore
+        resp = client.get(url)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertTrue(len(resp.content) > 0)
+
+        url = reverse('api:project-tiles', kwargs={'pk': self.project_1.pk, 'z': 1, 'x': 0, 'y': 0})
+        self.assertEqual(client.get(url).status_code, status.HTTP_204_NO_CONTENT)
+        site = {
+            'code': 'NEW2',
+            'project': self.project_1.pk,
+            'geometry': {'type': 'Point', 'coordinates': [-100.0, 40.0]}
+        }
+        resp = client.post(reverse('api:site-list'), site, format='json')
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(client.get(url).status_code, status.HTTP_200_OK)
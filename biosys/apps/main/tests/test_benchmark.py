@@ -0,0 +1,59 @@
+import json
+import os
+import tempfile
+
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection
+from django.test import TestCase
+from django.utils import six
+
+from main.models import Program, Record
+from main.utils_benchmark import Benchmark, compare_to_baseline
+
+
+class TestBenchmark(TestCase):
+
+    def test_run(self):
+        results = Benchmark(rows=5).run()
+        for stage in ['generic.upload', 'observation.validate', 'species_observation.export_xlsx', 'statistics']:
+            self.assertIn(stage, results)
+            self.assertIn('seconds', results[stage])
+            self.assertIn('queries', results[stage])
+            self.assertIn('peak_memory_kb', results[stage])
+        self.assertEqual(results['generic.upload']['rows'], 5)
+        # everything is cleaned up
+        self.assertEqual(Program.objects.count(), 0)
+        self.assertEqual(Record.objects.count(), 0)
+
+    def test_queries_of_a_stage(self):
+        # the queries log is full (its length is capped)
+        connection.queries_log.extend([{}] * connection.queries_limit)
+        benchmark = Benchmark()
+        benchmark.measure('count', lambda: Program.objects.count())
+        self.assertEqual(benchmark.results['count']['queries'], 1)
+
+    def test_compare_to_baseline(self):
+        baseline = {'upload': {'seconds': 1.0, 'queries': 10}}
+        self.assertEqual(compare_to_baseline({'upload': {'seconds': 1.1, 'queries': 10}}, baseline), [])
+        regressions = compare_to_baseline({'upload': {'seconds': 1.5, 'queries': 12}}, baseline)
+        self.assertEqual(len(regressions), 2)
+        # unknown stages are ignored
+        self.assertEqual(compare_to_baseline({'export': {'seconds': 10, 'queries': 100}}, baseline), [])
+
+    def test_command_baseline(self):
+        path = os.path.join(tempfile.mkdtemp(), 'baseline.json')
+        call_command('benchmark', rows=2, types='generic', save_baseline=path, stdout=six.StringIO())
+        with open(path) as f:
+            baseline = json.load(f)
+        self.assertIn('generic.upload', baseline)
+        # impossible baseline
+        for stage in baseline.values():
+            stage['queries'] = 0
+        with open(path, 'w') as f:
+            json.dump(baseline, f)
+        with self.assertRaises(CommandError):
+            call_command('benchmark', rows=2, types='generic', baseline=path, stdout=six.StringIO(),
+                         stderr=six.StringIO())
+        call_command('benchmark', rows=2, types='generic', baseline=path, no_fail=True, stdout=six.StringIO(),
+                     stderr=six.StringIO())
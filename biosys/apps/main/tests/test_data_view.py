@@ -0,0 +1,70 @@
+import json
+
+from django.urls import reverse
+from rest_framework import status
+
+from main.tests.api import helpers
+
+
+class TestJSONDataTableView(helpers.BaseUserTestCase):
+
+    def _more_setup(self):
+        self.rows = [
+            ['What', 'When', 'Latitude', 'Longitude'],
+            ['Canis lupus', '2018-02-14', -32.0, 115.75],
+            ['Chubby bat', '2017-05-18', -34.4, 116.78],
+            ['Canis lupus', '2016-01-01', -33.1, 117.1],
+            ['Vulpes vulpes', '2015-03-20', -31.5, 116.1],
+            ['Canis lupus', '2014-07-07', -30.2, 118.3],
+        ]
+        self.dataset = self._create_dataset_and_records_from_rows(self.rows)
+        self.url = reverse('publish:data_json', kwargs={'pk': self.dataset.pk})
+
+    def _get(self, params=None):
+        resp = self.readonly_client.get(self.url, params or {})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        return json.loads(b''.join(resp.streaming_content).decode('utf-8'))
+
+    def _table_params(self, start=0, length=-1, search='', column=None, direction='asc'):
+        params = {'draw': 3, 'start': start, 'length': length, 'search[value]': search}
+        if column is not None:
+            params.update({'order[0][column]': 0, 'order[0][dir]': direction, 'columns[0][name]': column})
+        return params
+
+    def test_all_records(self):
+        content = self._get()
+        self.assertEqual(list(content.keys()), ['data'])
+        ids = [row['id'] for row in content['data']]
+        self.assertEqual(ids, sorted(self.dataset.record_queryset.values_list('id', flat=True)))
+        self.assertEqual(content['data'][0]['What'], 'Canis lupus')
+
+    def test_server_side_page(self):
+        content = self._get(self._table_params(start=1, length=2))
+        self.assertEqual(content['draw'], 3)
+        self.assertEqual(content['recordsTotal'], 5)
+        self.assertEqual(content['recordsFiltered'], 5)
+        ids = sorted(self.dataset.record_queryset.values_list('id', flat=True))
+        self.assertEqual([row['id'] for row in content['data']], ids[1:3])
+
+    def test_server_side_search(self):
+        content = self._get(self._table_params(search='vulpes'))
+        self.assertEqual(content['recordsTotal'], 5)
+        self.assertEqual(content['recordsFiltered'], 1)
+        self.assertEqual([row['What'] for row in content['data']], ['Vulpes vulpes'])
+
+    def test_server_side_order(self):
+        content = self._get(self._table_params(column='What', direction='desc'))
+        self.assertEqual([row['What'] for row in content['data']],
+                         ['Vulpes vulpes', 'Chubby bat', 'Canis lupus', 'Canis lupus', 'Canis lupus'])
+
+    def test_equal_values_paged_by_id(self):
+        # the 3 'Canis lupus' are the first page of 2 and the first row of the next one, by id
+        canis_ids = sorted(self.dataset.record_queryset.filter(data__What='Canis lupus').values_list('id', flat=True))
+        first_page = self._get(self._table_params(start=0, length=2, column='What'))
+        second_page = self._get(self._table_params(start=2, length=2, column='What'))
+        ids = [row['id'] for row in first_page['data'] + second_page['data']]
+        self.assertEqual(ids[:3], canis_ids)
+
+    def test_login_required(self):
+        resp = self.anonymous_client.get(self.url)
+        self.assertIn(resp.status_code, [status.HTTP_302_FOUND, status.HTTP_403_FORBIDDEN])
@@ -0,0 +1,106 @@
+import copy
+import datetime
+from decimal import Decimal
+
+from django.test import TestCase
+
+from main.api.exporters import build_cell_converter
+from main.utils_data_package import SchemaField
+
+
+def schema_field_cast(descriptor, value):
+    """
+    The cast of the exporters before the cell converters: SchemaField.cast or the value as is.
+    """
+    try:
+        return SchemaField(copy.deepcopy(descriptor)).cast(value)
+    except Exception:
+        return value
+
+
+class TestCellConverter(TestCase):
+
+    def test_integer(self):
+        convert = build_cell_converter({'name': 'count', 'type': 'integer'})
+        self.assertEqual(convert('12'), 12)
+        self.assertEqual(convert(' 12 '), 12)
+        self.assertEqual(convert(12), 12)
+        self.assertIsNone(convert(''))
+        # fallback to the raw value
+        self.assertEqual(convert('twelve'), 'twelve')
+        self.assertEqual(convert(12.5), 12.5)
+
+    def test_number(self):
+        convert = build_cell_converter({'name': 'lat', 'type': 'number'})
+        self.assertEqual(convert('-32.5'), Decimal('-32.5'))
+        # the decimals are kept
+        self.assertEqual(str(convert('1.10')), '1.10')
+        self.assertEqual(convert(-32), Decimal(-32))
+        self.assertEqual(convert('abc'), 'abc')
+        convert = build_cell_converter({'name': 'lat', 'type': 'number', 'decimalChar': ','})
+        self.assertEqual(float(convert('-32,5')), -32.5)
+
+    def test_boolean(self):
+        convert = build_cell_converter({'name': 'flag', 'type': 'boolean'})
+        for value in ['yes', 'Y', 'true', True]:
+            self.assertIs(convert(value), True, msg=value)
+        for value in ['no', 'N', 'false', 'FALSE', False]:
+            self.assertIs(convert(value), False, msg=value)
+        # not boolean values for the schema
+        for value in ['maybe', 'TRUE', '1', '0']:
+            self.assertEqual(convert(value), value)
+        convert = build_cell_converter({'name': 'flag', 'type': 'boolean', 'trueValues': ['oui']})
+        self.assertTrue(convert('oui'))
+
+    def test_date(self):
+        convert = build_cell_converter({'name': 'when', 'type': 'date'})
+        self.assertEqual(convert('2018-02-14'), datetime.date(2018, 2, 14))
+        self.assertEqual(convert('14/02/2018'), '14/02/2018')
+        convert = build_cell_converter({'name': 'when', 'type': 'date', 'format': '%d/%m/%Y'})
+        self.assertEqual(convert('14/02/2018'), datetime.date(2018, 2, 14))
+        convert = build_cell_converter({'name': 'when', 'type': 'date', 'format': 'any'})
+        # day first
+        self.assertEqual(convert('01/02/2018'), datetime.date(2018, 2, 1))
+
+    def test_strict(self):
+        convert = build_cell_converter({'name': 'count', 'type': 'integer'}, strict=True)
+        self.assertIsNone(convert('twelve'))
+        self.assertEqual(convert('12'), 12)
+
+    def test_string(self):
+        convert = build_cell_converter({'name': 'what'})
+        self.assertEqual(convert(' a bird '), 'a bird')
+        self.assertEqual(convert(12), 12)
+
+    def test_time_and_year(self):
+        convert = build_cell_converter({'name': 'at', 'type': 'time'})
+        self.assertEqual(convert('10:30:00'), datetime.time(10, 30))
+        convert = build_cell_converter({'name': 'season', 'type': 'year'})
+        self.assertEqual(convert('2018'), 2018)
+        self.assertEqual(convert('18'), '18')
+
+    def test_same_as_schema_field_cast(self):
+        descriptors = [
+            {'name': 'what', 'type': 'string'},
+            {'name': 'count', 'type': 'integer'},
+            {'name': 'lat', 'type': 'number'},
+            {'name': 'lat', 'type': 'number', 'decimalChar': ','},
+            {'name': 'flag', 'type': 'boolean'},
+            # the dates of a dataset schema always have a format (see GenericSchema)
+            {'name': 'when', 'type': 'date', 'format': 'default'},
+            {'name': 'when', 'type': 'date', 'format': '%d/%m/%Y'},
+            {'name': 'when', 'type': 'date', 'format': 'any'},
+            {'name': 'when', 'type': 'datetime', 'format': 'default'},
+            {'name': 'when', 'type': 'datetime', 'format': 'any'},
+            {'name': 'at', 'type': 'time'},
+            {'name': 'season', 'type': 'year'},
+        ]
+        values = ['', ' ', None, 'abc', '12', ' 12 ', 12, 12.0, 12.5, '1.10', '-32,5', True, False, 'true', 'TRUE', '1',
+                  '0', 'yes', 'No', '2018-02-14', '14/02/2018', '2018-02-14T10:30:00Z', '10:30:00', '2018']
+        for descriptor in descriptors:
+            convert = build_cell_converter(descriptor)
+            for value in values:
+                expected = schema_field_cast(descriptor, value)
+                actual = convert(value)
+                self.assertEqual(actual, expected, msg='{} {!r}'.format(descriptor, value))
+                self.assertEqual(type(actual), type(expected), msg='{} {!r}'.format(descriptor, value))
@@ -0,0 +1,99 @@
+import json
+import os
+import tempfile
+
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import TestCase
+from django.utils import six
+
+from main.management.commands.import_records import split_csv
+from main.models import Dataset
+from main.tests import factories
+from main.tests.api import helpers
+
+
+class TestImportRecords(TestCase):
+
+    def setUp(self):
+        self.project = factories.ProjectFactory.create()
+        fields = [
+            {
+                'name': 'Column A',
+                'type': 'string',
+                'constraints': helpers.NOT_REQUIRED_CONSTRAINTS
+            },
+            {
+                'name': 'Column B',
+                'type': 'integer',
+                'constraints': helpers.REQUIRED_CONSTRAINTS
+            }
+        ]
+        self.dataset = factories.DatasetFactory(
+            project=self.project,
+            type=Dataset.TYPE_GENERIC,
+            data_package=helpers.create_data_package_from_fields(fields)
+        )
+        self.rows = [
+            ['Column A', 'Column B'],
+            ['A1', '1'],
+            ['A2', '2'],
+            ['A3', ''],  # error: required
+            ['A4', '4'],
+            ['A5', '5'],
+        ]
+
+    def _import(self, file_, **options):
+        out = six.StringIO()
+        call_command('import_records', self.dataset.pk, file_, stdout=out, **options)
+        return out.getvalue()
+
+    def test_csv_chunks_and_batches(self):
+        file_ = helpers.rows_to_csv_file(self.rows)
+        errors_file = os.path.join(tempfile.mkdtemp(), 'errors.json')
+        output = self._import(file_, batch_size=2, chunk_size=2, errors_file=errors_file)
+        self.assertIn('Done: 4 records imported, 1 rows with errors', output)
+        records = self.dataset.record_queryset.order_by('pk')
+        self.assertEqual([r.data['Column A'] for r in records], ['A1', 'A2', 'A4', 'A5'])
+        # numbers are cast and the row matches the file
+        self.assertEqual(records[2].data['Column B'], 4)
+        self.assertEqual(records[2].source_info, {'file_name': os.path.basename(file_), 'row': 5})
+        with open(errors_file) as f:
+            errors = [json.loads(line) for line in f]
+        self.assertEqual([e['row'] for e in errors], [4])
+
+    def test_resume_with_offset_and_limit(self):
+        file_ = helpers.rows_to_csv_file(self.rows)
+        self._import(file_, offset=3, limit=1)
+        records = self.dataset.record_queryset.all()
+        self.assertEqual([r.data['Column A'] for r in records], ['A4'])
+        self.assertEqual(records[0].source_info['row'], 5)
+
+    def test_xlsx(self):
+        file_ = helpers.rows_to_xlsx_file(self.rows)
+        output = self._import(file_, profile=True)
+        self.assertIn('Done: 4 records imported', output)
+        self.assertIn('"stages"', output)
+        self.assertEqual(self.dataset.record_queryset.first().source_info['file_name'], os.path.basename(file_))
+
+    def test_split_csv(self):
+        file_ = helpers.rows_to_csv_file(self.rows)
+        total, chunks = split_csv(file_, tempfile.mkdtemp(), 1, 3, 2)
+        self.assertEqual(total, 5)
+        self.assertEqual([(start, stop) for start, stop, _ in chunks], [(1, 3), (3, 4)])
+        # every chunk file has the header and its rows only
+        with open(chunks[1][2]) as f:
+            self.assertEqual(f.read().splitlines(), ['Column A,Column B', 'A4,4'])
+
+    def test_create_site_one_worker(self):
+        file_ = helpers.rows_to_csv_file(self.rows)
+        output = self._import(file_, create_site=True, workers=2)
+        self.assertIn('with 1 worker(s)', output)
+        self.assertIn('Done: 4 records imported', output)
+
+    def test_errors(self):
+        file_ = helpers.rows_to_csv_file(self.rows)
+        with self.assertRaises(CommandError):
+            self._import(file_, offset=1, delete_previous=True)
+        with self.assertRaises(CommandError):
+            self._import('/tmp/does-not-exist.csv')
@@ -0,0 +1,287 @@
+from __future__ import absolute_import, unicode_literals, print_function, division
+
+import datetime
+import json
+import random
+import resource
+import timeit
+from collections import OrderedDict
+
+from django.contrib.auth import get_user_model
+from django.db import connection, reset_queries
+from django.test.utils import CaptureQueriesContext
+from django.utils import six
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from main.api.exporters import DefaultExporter
+from main.api.uploaders import RecordCreator
+from main.api.validators import get_record_validator_for_dataset
+from main.api.views import RecordViewSet, StatisticsView
+from main.models import Program, Project, Dataset
+
+try:
+    import tracemalloc
+except ImportError:
+    # python 2
+    tracemalloc = None
+
+SPECIES_NAMES = ['Canis lupus', 'Canis dingo', 'Chubby bat', 'Vulpes vulpes', 'Macropus fuliginosus',
+                 'Dromaius novaehollandiae', 'Tiliqua rugosa', 'Pogona minor']
+
+DATASET_TYPES = [Dataset.TYPE_GENERIC, Dataset.TYPE_OBSERVATION, Dataset.TYPE_SPECIES_OBSERVATION]
+
+
+class SyntheticSpeciesFacade(object):
+    """
+    A species facade that doesn't call any web service.
+    """
+
+    def name_id_by_species_name(self):
+        return dict((name, index + 1) for index, name in enumerate(SPECIES_NAMES))
+
+
+def build_schema(dataset_type, extra_columns=0):
+    fields = [
+        {'name': 'What', 'type': 'string', 'constraints': {'required': True}},
+        {'name': 'Count', 'type': 'integer'},
+        {'name': 'Flag', 'type': 'boolean'},
+        {'name': 'Notes', 'type': 'string'},
+    ]
+    for index in range(extra_columns):
+        fields.append({'name': 'Extra {}'.format(index + 1), 'type': 'number' if index % 2 else 'string'})
+    if dataset_type in [Dataset.TYPE_OBSERVATION, Dataset.TYPE_SPECIES_OBSERVATION]:
+        fields += [
+            {'name': 'When', 'type': 'date', 'format': 'any', 'constraints': {'required': True},
+             'biosys': {'type': 'observationDate'}},
+            {'name': 'Latitude', 'type': 'number', 'constraints': {'required': True, 'minimum': -90, 'maximum': 90},
+             'biosys': {'type': 'latitude'}},
+            {'name': 'Longitude', 'type': 'number',
+             'constraints': {'required': True, 'minimum': -180, 'maximum': 180},
+             'biosys': {'type': 'longitude'}},
+        ]
+    if dataset_type == Dataset.TYPE_SPECIES_OBSERVATION:
+        fields.append({'name': 'Species Name', 'type': 'string', 'constraints': {'required': True},
+                       'biosys': {'type': 'speciesName'}})
+    return {'fields': fields}
+
+
+def build_data_package(name, schema):
+    return {
+        'name': name,
+        'resources': [
+            {
+                'name': name,
+                'format': 'CSV',
+                'title': name,
+                'bytes': 0,
+                'mediatype': 'text/csv',
+                'path': name + '.csv',
+                'schema': schema
+            }
+        ],
+        'title': name
+    }
+
+
+def generate_rows(schema, count, seed=0):
+    """
+    Generate synthetic rows as they would come from an uploaded file (string values).
+    """
+    rand = random.Random(seed)
+    start_date = datetime.date(2000, 1, 1)
+    for index in range(count):
+        row = {}
+        for field in schema['fields']:
+            name, type_ = field['name'], field['type']
+            if name == 'Species Name':
+                value = rand.choice(SPECIES_NAMES)
+            elif name == 'Latitude':
+                value = '{:.5f}'.format(rand.uniform(-35, -15))
+            elif name == 'Longitude':
+                value = '{:.5f}'.format(rand.uniform(113, 129))
+            elif type_ == 'integer':
+                value = str(rand.randint(0, 100))
+            elif type_ == 'number':
+                value = '{:.3f}'.format(rand.uniform(0, 1000))
+            elif type_ == 'boolean':
+                value = rand.choice(['yes', 'no'])
+            elif type_ == 'date':
+                value = (start_date + datetime.timedelta(days=rand.randint(0, 6000))).strftime('%d/%m/%Y')
+            else:
+                value = '{} {}'.format(name, rand.randint(0, count))
+            row[name] = value
+        yield row
+
+
+class Benchmark(object):
+    """
+    Measure the ingest, validation, query and export paths on synthetic datasets.
+    Every stage reports its duration, rows/sec, number of SQL queries and peak memory.
+    tracemalloc slows down the allocations, so the memory is measured in a second run of the stages (on new data)
+    and the durations are not affected.
+    All the created data (program, project, datasets, records, user) are deleted at the end unless keep=True.
+    """
+
+    def __init__(self, rows=1000, dataset_types=None, extra_columns=0, keep=False, seed=0, log=None):
+        self.rows = rows
+        self.dataset_types = dataset_types or DATASET_TYPES
+        self.extra_columns = extra_columns
+        self.keep = keep
+        self.seed = seed
+        self.log = log or (lambda message: None)
+        self.results = OrderedDict()
+        self.request_factory = APIRequestFactory()
+        self.program = None
+        self.user = None
+        self.trace_memory = False
+
+    def measure(self, name, func, rows=None):
+        """
+        Run func and record its metrics under name: its duration and queries, or its peak memory in the memory run.
+        :return: the func result
+        """
+        if self.trace_memory:
+            self.log('{} (memory)...'.format(name))
+            tracemalloc.start()
+            try:
+                result = func()
+                peak = tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+            self.results.setdefault(name, OrderedDict())['peak_memory_kb'] = peak // 1024
+            return result
+
+        self.log('{}...'.format(name))
+        rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # connection.queries_log keeps at most 9000 queries: counted from an empty log for every stage
+        reset_queries()
+        with CaptureQueriesContext(connection) as queries:
+            start = timeit.default_timer()
+            result = func()
+            seconds = timeit.default_timer() - start
+        stage = OrderedDict()
+        stage['seconds'] = round(seconds, 4)
+        if rows:
+            stage['rows'] = rows
+            stage['rows_per_sec'] = round(rows / seconds, 1) if seconds else None
+        stage['queries'] = len(queries)
+        if tracemalloc is None:
+            # process wide high water mark: only shows an increase
+            stage['peak_memory_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before
+        self.results[name] = stage
+        return result
+
+    def setup(self):
+        suffix = datetime.datetime.now().strftime('%Y%m%d%H%M%S%f')
+        self.user = get_user_model().objects.create_user(username='benchmark-' + suffix, password=None)
+        self.program = Program.objects.create(name='Benchmark ' + suffix)
+        self.project = Project.objects.create(name='Benchmark ' + suffix, program=self.program)
+
+    def teardown(self):
+        if self.program is not None:
+            self.program.delete()
+        if self.user is not None:
+            self.user.delete()
+
+    def _get(self, view, params=None):
+        request = self.request_factory.get('/', params or {})
+        force_authenticate(request, user=self.user)
+        response = view(request)
+        response.render()
+        if response.status_code != 200:
+            raise Exception('Error {}: {}'.format(response.status_code, response.content))
+        return response
+
+    def run_dataset(self, dataset_type):
+        schema = build_schema(dataset_type, self.extra_columns)
+        dataset = Dataset.objects.create(
+            project=self.project,
+            name='Benchmark {}'.format(dataset_type),
+            type=dataset_type,
+            data_package=build_data_package(dataset_type.replace('_', '-'), schema)
+        )
+        rows = list(generate_rows(schema, self.rows, seed=self.seed))
+
+        def validate():
+            validator = get_record_validator_for_dataset(dataset)
+            return [validator.validate(row) for row in rows]
+
+        self.measure('{}.validate'.format(dataset_type), validate, rows=len(rows))
+
+        def upload():
+            creator = RecordCreator(dataset, iter(rows), commit=True, create_site=False,
+                                    species_facade_class=SyntheticSpeciesFacade)
+            errors = [result.errors for record, result in creator if result.has_errors]
+            if errors:
+                raise Exception('Upload errors: {}'.format(errors[:5]))
+
+        self.measure('{}.upload'.format(dataset_type), upload, rows=len(rows))
+
+        list_view = RecordViewSet.as_view({'get': 'list'})
+        self.measure('{}.list'.format(dataset_type), lambda: self._get(list_view, {
+            'dataset__id': dataset.pk,
+        }), rows=len(rows))
+        self.measure('{}.list_search_ordering'.format(dataset_type), lambda: self._get(list_view, {
+            'dataset__id': dataset.pk,
+            'search': 'What 1',
+            'ordering': '-Count',
+            'limit': 100
+        }))
+
+        def export_csv():
+            DefaultExporter(dataset, dataset.record_queryset.order_by('id')).to_csv(six.StringIO())
+
+        def export_xlsx():
+            output = six.BytesIO()
+            DefaultExporter(dataset, dataset.record_queryset.order_by('id')).to_workbook().save(output)
+
+        self.measure('{}.export_csv'.format(dataset_type), export_csv, rows=len(rows))
+        self.measure('{}.export_xlsx'.format(dataset_type), export_xlsx, rows=len(rows))
+
+    def run(self):
+        self.trace_memory = False
+        self._run_stages()
+        if tracemalloc is not None:
+            self.trace_memory = True
+            try:
+                self._run_stages()
+            finally:
+                self.trace_memory = False
+        return self.results
+
+    def _run_stages(self):
+        self.setup()
+        try:
+            for dataset_type in self.dataset_types:
+                self.run_dataset(dataset_type)
+            self.measure('statistics', lambda: self._get(StatisticsView.as_view()))
+        finally:
+            if not self.keep:
+                self.teardown()
+
+
+def compare_to_baseline(results, baseline, tolerance=0.2):
+    """
+    A stage is a regression if it's slower than the baseline by more than tolerance (ratio) or if it runs more queries.
+    :return: a list of (stage name, message)
+    """
+    regressions = []
+    for name, stage in results.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        if base.get('seconds') and stage['seconds'] > base['seconds'] * (1 + tolerance):
+            regressions.append((name, 'time {}s > baseline {}s'.format(stage['seconds'], base['seconds'])))
+        if base.get('queries') is not None and stage['queries'] > base['queries']:
+            regressions.append((name, 'queries {} > baseline {}'.format(stage['queries'], base['queries'])))
+    return regressions
+
+
+def load_baseline(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_results(results, path):
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2)
@@ -674,8 +674,8 @@ class ObservationSchema(GenericSchema):
     def cast_srid(self, record, default_srid=MODEL_SRID):
         return self.geometry_parser.cast_srid(record, default_srid=default_srid)
 
-    def cast_geometry(self, record, default_srid=MODEL_SRID):
-        return self.geometry_parser.cast_geometry(record, default_srid=default_srid)
+    def cast_geometry(self, record, default_srid=MODEL_SRID, site_getter=None):
+        return self.geometry_parser.cast_geometry(record, default_srid=default_srid, site_getter=site_getter)
 
 
 class SpeciesObservationSchema(ObservationSchema):
@@ -1003,12 +1003,13 @@ class GeometryParser(object):
             result = default_srid
         return result
 
-    def cast_geometry(self, record, default_srid=MODEL_SRID):
+    def cast_geometry(self, record, default_srid=MODEL_SRID, site_getter=None):
         """
         Precedences rules:
         easting/northing > lat/long > site geometry
         :param record: a column -> value dictionary
         :param default_srid:
+        :param site_getter: an optional function site_code -> Site or None used instead of a query (e.g. a cache)
         :return: Will throw an exception if anything went wrong
         """
         x, y = (None, None)  # x = longitude or easting, y = latitude or northing.
@@ -1027,7 +1028,10 @@ class GeometryParser(object):
             # extract geometry from site
             from main.models import Site  # import here to avoid cyclic import problem
             site_code = self.get_site_code(record)
-            site = Site.objects.filter(code=site_code).first()
+            if site_getter is not None:
+                site = site_getter(site_code)
+            else:
+                site = Site.objects.filter(code=site_code).first()
             if site_code and site is None:
                 raise Exception('The site {} does not exist'.format(site_code))
             geometry = site.geometry if site is not None else None
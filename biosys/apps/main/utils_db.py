@@ -0,0 +1,62 @@
+from __future__ import absolute_import, unicode_literals, print_function, division
+
+from django.contrib.gis.db.models import GeometryField
+from django.db import connection
+
+
+def quote_literal(value):
+    """
+    Quote a string as a SQL literal. Only for the statements that can't have parameters (DDL).
+    """
+    return "'{}'".format(value.replace("'", "''"))
+
+
+def bulk_update(objs, fields, where=None, batch_size=1000):
+    """
+    Update many rows with one UPDATE ... FROM (VALUES ...) statement per batch.
+    Django 1.11 has no bulk_update and a save() per object is one query per object.
+    :param objs: model instances with a pk. The auto_now fields are set like in a save().
+    :param fields: the names of the fields to update
+    :param where: an optional extra SQL condition. The table is aliased 't' and the new values 'v',
+    e.g 't."data" IS DISTINCT FROM v."data"' to update only the rows that changed.
+    The geometries can be in any srid: they are transformed to the column srid by the UPDATE (one ST_Transform per
+    row in the database instead of a transform per object in python).
+    :return: the list of the pk of the updated rows
+    """
+    if not objs:
+        return []
+    meta = type(objs[0])._meta
+    pk_field = meta.pk
+    update_fields = [meta.get_field(name) for name in fields]
+    columns = [pk_field] + update_fields
+    # the VALUES are not typed: cast every value to its column type
+    casts = [pk_field.rel_db_type(connection)] + [
+        'geometry' if isinstance(f, GeometryField) else f.db_type(connection) for f in update_fields]
+    row_sql = '(' + ', '.join('%s::{}'.format(cast) for cast in casts) + ')'
+    sets = []
+    for field in update_fields:
+        column = connection.ops.quote_name(field.column)
+        if isinstance(field, GeometryField):
+            sets.append('{0} = ST_Transform(v.{0}, {1})'.format(column, int(field.srid)))
+        else:
+            sets.append('{0} = v.{0}'.format(column))
+    sql = 'UPDATE {table} AS t SET {sets} FROM (VALUES {{values}}) AS v ({columns}) ' \
+          'WHERE t.{pk} = v.{pk}{where} RETURNING t.{pk}'.format(
+            table=connection.ops.quote_name(meta.db_table),
+            sets=', '.join(sets),
+            columns=', '.join(connection.ops.quote_name(f.column) for f in columns),
+            pk=connection.ops.quote_name(pk_field.column),
+            where=' AND ({})'.format(where) if where else '')
+    updated = []
+    with connection.cursor() as cursor:
+        for start in range(0, len(objs), batch_size):
+            batch = objs[start:start + batch_size]
+            params = []
+            for obj in batch:
+                params.append(pk_field.get_db_prep_save(obj.pk, connection))
+                for field in update_fields:
+                    value = field.pre_save(obj, False)
+                    params.append(field.get_db_prep_save(value, connection))
+            cursor.execute(sql.format(values=', '.join([row_sql] * len(batch))), params)
+            updated += [row[0] for row in cursor.fetchall()]
+    return updated
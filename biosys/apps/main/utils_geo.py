@@ -0,0 +1,203 @@
+from __future__ import absolute_import, unicode_literals, print_function, division
+
+from django.contrib.gis.geos import Point, Polygon
+from django.db import connection, transaction, IntegrityError
+from django.db.models import F
+
+from main.constants import MODEL_SRID
+
+WEB_MERCATOR_SRID = 3857
+# half the width of the web mercator world in meters
+WEB_MERCATOR_MAX = 20037508.342789244
+MAX_TILE_ZOOM = 24
+# see https://postgis.net/docs/ST_AsMVTGeom.html
+MVT_EXTENT = 4096
+MVT_BUFFER = 64
+
+
+def is_valid_tile(z, x, y):
+    z, x, y = int(z), int(x), int(y)
+    if z < 0 or z > MAX_TILE_ZOOM:
+        return False
+    max_index = 2 ** z
+    return 0 <= x < max_index and 0 <= y < max_index
+
+
+def tile_bounds(z, x, y):
+    """
+    Compute the bounds of a XYZ (google/osm scheme) tile.
+    :return: (xmin, ymin, xmax, ymax) in web mercator (3857)
+    """
+    tile_size = 2 * WEB_MERCATOR_MAX / (2 ** int(z))
+    xmin = -WEB_MERCATOR_MAX + int(x) * tile_size
+    ymax = WEB_MERCATOR_MAX - int(y) * tile_size
+    return xmin, ymax - tile_size, xmin + tile_size, ymax
+
+
+def tile_envelope(z, x, y, srid=MODEL_SRID):
+    """
+    :return: the tile bounds as a polygon in the given srid
+    """
+    envelope = Polygon.from_bbox(tile_bounds(z, x, y))
+    envelope.srid = WEB_MERCATOR_SRID
+    if srid != WEB_MERCATOR_SRID:
+        envelope.transform(srid)
+    return envelope
+
+
+def queryset_to_mvt(queryset, layer_name, z, x, y, properties=('id',), geometry_field='geometry'):
+    """
+    Encode the geometries of a queryset as a Mapbox vector tile layer with PostGIS ST_AsMVT.
+    Only the rows intersecting the tile bounding box are selected (&& operator, GiST index).
+    :param queryset: any queryset of a model with a geometry field. All the filters are kept.
+    :param layer_name: the name of the layer in the tile
+    :param properties: the columns (db column name) to add as feature attributes
+    :param geometry_field:
+    :return: the tile as bytes (empty bytes if no feature)
+    """
+    queryset = queryset.filter(**{
+        geometry_field + '__bboverlaps': tile_envelope(z, x, y)
+    }).order_by()
+    inner_sql, inner_params = queryset.values(geometry_field, *properties).query.sql_with_params()
+    columns = ', '.join('t."{}"'.format(p) for p in properties)
+    sql = """
+        SELECT ST_AsMVT(tile, %s, {extent}, 'geom') FROM (
+            SELECT ST_AsMVTGeom(
+                ST_Transform(t."{geometry}", {mercator}),
+                ST_MakeEnvelope(%s, %s, %s, %s, {mercator}),
+                {extent}, {buffer}, true
+            ) AS geom, {columns}
+            FROM ({inner}) AS t
+        ) AS tile WHERE tile.geom IS NOT NULL
+    """.format(
+        extent=MVT_EXTENT,
+        buffer=MVT_BUFFER,
+        mercator=WEB_MERCATOR_SRID,
+        geometry=geometry_field,
+        columns=columns,
+        inner=inner_sql
+    )
+    params = [layer_name] + list(tile_bounds(z, x, y)) + list(inner_params)
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        row = cursor.fetchone()
+    return bytes(row[0]) if row and row[0] else b''
+
+
+def get_tile_generation(project_id):
+    """
+    The tile generation of a project is a counter used in the tile cache keys.
+    It is incremented every time a change not tracked by the records last_modified happens (site created, moved or
+    deleted, bulk update of records geometry). It is never decremented or reset, so a generation number is never
+    reused.
+    """
+    # import here to avoid cyclic import problem
+    from main.models import TileGeneration
+    generation = TileGeneration.objects.filter(project_id=project_id).values_list('generation', flat=True).first()
+    return generation or 0
+
+
+def invalidate_tiles(project_id):
+    """
+    Increment the tile generation of the project. In a transaction, the new generation is seen by the tile requests
+    when the changes are committed.
+    """
+    # import here to avoid cyclic import problem
+    from main.models import TileGeneration
+    increment = {'generation': F('generation') + 1}
+    if TileGeneration.objects.filter(project_id=project_id).update(**increment):
+        return
+    try:
+        with transaction.atomic():
+            TileGeneration.objects.create(project_id=project_id, generation=1)
+    except IntegrityError:
+        # created concurrently
+        TileGeneration.objects.filter(project_id=project_id).update(**increment)
+
+
+def parse_bbox(value):
+    """
+    Parse a bounding box string 'minx,miny,maxx,maxy' (WGS84).
+    :return: a Polygon. Will throw a ValueError if the bbox is invalid.
+    """
+    try:
+        coords = [float(c) for c in value.split(',')]
+    except (AttributeError, TypeError, ValueError):
+        coords = []
+    if len(coords) != 4:
+        raise ValueError("The bbox must be 'minx,miny,maxx,maxy'. Got: '{}'".format(value))
+    minx, miny, maxx, maxy = coords
+    if minx > maxx or miny > maxy:
+        raise ValueError("The bbox min values must be lower than the max values. Got: '{}'".format(value))
+    bbox = Polygon.from_bbox(coords)
+    bbox.srid = MODEL_SRID
+    return bbox
+
+
+def merge_extents(*extents):
+    """
+    :param extents: (xmin, ymin, xmax, ymax) tuples or lists. None values are ignored.
+    :return: the bounding box of all the extents as a list [xmin, ymin, xmax, ymax] or None
+    """
+    extents = [e for e in extents if e]
+    if not extents:
+        return None
+    return [
+        min(e[0] for e in extents),
+        min(e[1] for e in extents),
+        max(e[2] for e in extents),
+        max(e[3] for e in extents)
+    ]
+
+
+def cluster_queryset(queryset, grid_size=None, k=None, group_by=None, geometry_field='geometry'):
+    """
+    Aggregate the geometries of a queryset in clusters. All the work is done in the database.
+    Two methods:
+    - grid (default): the geometries are snapped to a grid of size grid_size (degrees) with ST_SnapToGrid
+    - k-means: if k is given, the geometries are partitioned in k clusters with ST_ClusterKMeans
+    :param queryset: any queryset of a model with a geometry field. All the filters are kept.
+    :param grid_size: the grid cell size in degrees.
+    :param k: the number of clusters for the k-means method. Takes precedence over the grid_size
+    :param group_by: an optional column name (e.g 'species_name'). The clusters are computed for each group.
+    :return: a list of dict {'count': int, 'centroid': Point, group_by: value}
+    """
+    queryset = queryset.filter(**{geometry_field + '__isnull': False}).order_by()
+    columns = [geometry_field] + ([group_by] if group_by else [])
+    inner_sql, inner_params = queryset.values(*columns).query.sql_with_params()
+    group_select = ', t."{}"'.format(group_by) if group_by else ''
+    if k:
+        partition = 'PARTITION BY t."{}"'.format(group_by) if group_by else ''
+        sql = """
+            SELECT ST_X(ST_Centroid(ST_Collect(t."{geometry}"))), ST_Y(ST_Centroid(ST_Collect(t."{geometry}"))),
+                   COUNT(*){group_select}
+            FROM (
+                SELECT t.*, ST_ClusterKMeans(t."{geometry}", %s) OVER ({partition}) AS cluster_id
+                FROM ({inner}) AS t
+            ) AS t
+            GROUP BY t.cluster_id{group_select}
+        """.format(geometry=geometry_field, group_select=group_select, partition=partition, inner=inner_sql)
+        params = list(inner_params)
+        # the k parameter is before the inner query parameters
+        params.insert(0, int(k))
+    else:
+        sql = """
+            SELECT ST_X(ST_Centroid(ST_Collect(t."{geometry}"))), ST_Y(ST_Centroid(ST_Collect(t."{geometry}"))),
+                   COUNT(*){group_select}
+            FROM ({inner}) AS t
+            GROUP BY ST_SnapToGrid(ST_Centroid(t."{geometry}"), %s){group_select}
+        """.format(geometry=geometry_field, group_select=group_select, inner=inner_sql)
+        params = list(inner_params) + [float(grid_size)]
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        rows = cursor.fetchall()
+    result = []
+    for row in rows:
+        cluster = {
+            'count': row[2],
+            'centroid': Point(row[0], row[1], srid=MODEL_SRID)
+        }
+        if group_by:
+            cluster[group_by] = row[3]
+        result.append(cluster)
+    return result
@@ -1,6 +1,6 @@
 from __future__ import absolute_import, unicode_literals, print_function, division
 
-from django.http import HttpResponse
+from django.http import HttpResponse, FileResponse
 
 
 class CSVFileResponse(HttpResponse):
@@ -37,3 +37,10 @@ class WorkbookResponse(ExcelFileResponse):
         wb.save(self)
 
 
+class StoredFileResponse(FileResponse):
+    """
+    Stream a file as an attachment (e.g a file from the default storage)
+    """
+    def __init__(self, file_, file_name, content_type=None):
+        super(StoredFileResponse, self).__init__(file_, content_type=content_type or 'application/octet-stream')
+        self['Content-Disposition'] = 'attachment; filename=' + file_name
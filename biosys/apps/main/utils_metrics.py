@@ -0,0 +1,221 @@
+from __future__ import absolute_import, unicode_literals, print_function, division
+
+import re
+import threading
+import timeit
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+
+from django.db.backends.utils import CursorWrapper
+
+# per request metrics, see main.middleware.RequestMetricsMiddleware
+_local = threading.local()
+
+# process wide counters exposed in the prometheus format
+_registry_lock = threading.Lock()
+_registry = OrderedDict()
+
+METRICS_HELP = OrderedDict([
+    ('biosys_requests_total', ('counter', 'Number of requests.')),
+    ('biosys_request_duration_seconds_total', ('counter', 'Total time spent in the requests.')),
+    ('biosys_request_queries_total', ('counter', 'Number of SQL queries run by the requests.')),
+    ('biosys_request_sql_seconds_total', ('counter', 'Total SQL time of the requests.')),
+    ('biosys_request_schema_builds_total', ('counter', 'Number of dataset schemas built by the requests.')),
+    ('biosys_request_species_calls_total', ('counter', 'Number of species facade calls made by the requests.')),
+    ('biosys_request_serialization_seconds_total', ('counter', 'Total serialization time of the requests.')),
+    ('biosys_slow_requests_total', ('counter', 'Number of requests over the slow request thresholds.')),
+])
+
+
+class RequestMetrics(object):
+    """
+    The counters and timers of one request and the number of runs of every SQL query.
+    """
+    # distinct SQL queries counted, for the slow requests log
+    MAX_DISTINCT_QUERIES = 1000
+
+    def __init__(self):
+        self.counts = Counter()
+        self.timings = Counter()
+        self.queries = Counter()
+
+    def increment(self, name, value=1):
+        self.counts[name] += value
+
+    def add_time(self, name, seconds):
+        self.timings[name] += seconds
+
+    def add_query(self, sql, seconds):
+        self.increment('queries')
+        self.add_time('sql', seconds)
+        if sql in self.queries or len(self.queries) < self.MAX_DISTINCT_QUERIES:
+            self.queries[sql] += 1
+
+
+def start_request_metrics(metrics=None):
+    """
+    :param metrics: the RequestMetrics of a request to resume (e.g. while its streamed response is generated)
+    """
+    _local.metrics = metrics or RequestMetrics()
+    return _local.metrics
+
+
+def stop_request_metrics():
+    metrics = getattr(_local, 'metrics', None)
+    _local.metrics = None
+    return metrics
+
+
+def current_metrics():
+    """
+    :return: the RequestMetrics of the current request or None if the metrics are not enabled (or outside a request)
+    """
+    return getattr(_local, 'metrics', None)
+
+
+def increment(name, value=1):
+    metrics = current_metrics()
+    if metrics is not None:
+        metrics.increment(name, value)
+
+
+@contextmanager
+def timer(name, count=True):
+    """
+    Add the time spent in the block to the current request metrics. Nested timers of the same name are only
+    counted once.
+    :param count: also increment the counter of the same name.
+    """
+    metrics = current_metrics()
+    running = getattr(_local, 'running_timers', None)
+    if running is None:
+        running = _local.running_timers = set()
+    if metrics is None or name in running:
+        yield
+        return
+    running.add(name)
+    start = timeit.default_timer()
+    try:
+        yield
+    finally:
+        running.discard(name)
+        metrics.add_time(name, timeit.default_timer() - start)
+        if count:
+            metrics.increment(name)
+
+
+class QueryCountingCursorWrapper(CursorWrapper):
+    """
+    Add the queries run with the cursor to the current request metrics. Unlike the queries log
+    (connection.queries_log, capped at 9000 queries and only filled with a debug cursor), every query is counted.
+    """
+
+    def execute(self, sql, params=None):
+        start = timeit.default_timer()
+        try:
+            return self.cursor.execute(sql, params)
+        finally:
+            _add_query(sql, timeit.default_timer() - start)
+
+    def executemany(self, sql, param_list):
+        start = timeit.default_timer()
+        try:
+            return self.cursor.executemany(sql, param_list)
+        finally:
+            _add_query(sql, timeit.default_timer() - start)
+
+
+def _add_query(sql, seconds):
+    metrics = current_metrics()
+    if metrics is not None:
+        metrics.add_query(sql, seconds)
+
+
+def install_query_counter(connection):
+    """
+    Wrap the cursors of a database connection with a QueryCountingCursorWrapper (once per connection object).
+    Django 1.11 has no connection.execute_wrapper: the cursor factories of the connection are wrapped instead.
+    """
+    if getattr(connection, '_query_counter_installed', False):
+        return
+    make_cursor = connection.make_cursor
+    make_debug_cursor = connection.make_debug_cursor
+    connection.make_cursor = lambda cursor: QueryCountingCursorWrapper(make_cursor(cursor), connection)
+    connection.make_debug_cursor = lambda cursor: QueryCountingCursorWrapper(make_debug_cursor(cursor), connection)
+    connection._query_counter_installed = True
+
+
+_QUOTED_RE = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_RE = re.compile(r'\b\d+(?:\.\d+)?\b')
+_IN_LIST_RE = re.compile(r'\((?:\s*\?\s*,)+\s*\?\s*\)')
+
+
+def normalize_sql(sql):
+    """
+    Replace the literals of a query by '?' so the same query with different parameters can be grouped.
+    """
+    sql = _QUOTED_RE.sub('?', sql)
+    sql = _NUMBER_RE.sub('?', sql)
+    return _IN_LIST_RE.sub('(...)', sql)
+
+
+def top_repeated_queries(queries, limit=5):
+    """
+    :param queries: the number of runs by SQL query (see RequestMetrics.queries)
+    :return: a list of (count, normalized sql) of the queries run more than once, most repeated first.
+    """
+    counter = Counter()
+    for sql, count in queries.items():
+        counter[normalize_sql(sql or '')] += count
+    return [(count, sql) for sql, count in counter.most_common(limit) if count > 1]
+
+
+def _inc(name, labels, value=1):
+    key = (name, tuple(sorted(labels.items())))
+    with _registry_lock:
+        _registry[key] = _registry.get(key, 0) + value
+
+
+def record_request(view, method, status, duration, metrics, slow=False):
+    """
+    Add a request to the process wide counters.
+    """
+    labels = {'view': view}
+    _inc('biosys_requests_total', dict(labels, method=method, status=str(status)))
+    _inc('biosys_request_duration_seconds_total', labels, duration)
+    _inc('biosys_request_queries_total', labels, metrics.counts['queries'])
+    _inc('biosys_request_sql_seconds_total', labels, metrics.timings['sql'])
+    _inc('biosys_request_schema_builds_total', labels, metrics.counts['schema'])
+    _inc('biosys_request_species_calls_total', labels, metrics.counts['species'])
+    _inc('biosys_request_serialization_seconds_total', labels, metrics.timings['serialization'])
+    if slow:
+        _inc('biosys_slow_requests_total', labels)
+
+
+def reset_registry():
+    with _registry_lock:
+        _registry.clear()
+
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def render_prometheus():
+    """
+    The counters in the prometheus text exposition format.
+    Note: the counters are per process. With several workers every worker reports its own counters.
+    """
+    with _registry_lock:
+        items = list(_registry.items())
+    lines = []
+    for name, (type_, help_) in METRICS_HELP.items():
+        samples = [(labels, value) for (metric, labels), value in items if metric == name]
+        if not samples:
+            continue
+        lines.append('# HELP {} {}'.format(name, help_))
+        lines.append('# TYPE {} {}'.format(name, type_))
+        for labels, value in samples:
+            label_str = ','.join('{}="{}"'.format(k, _escape_label(v)) for k, v in labels)
+            lines.append('{}{{{}}} {}'.format(name, label_str, round(value, 6)))
+    return '\n'.join(lines) + '\n'
@@ -50,7 +50,9 @@ import logging
 import requests
 from confy import env
 
+from django.conf import settings
 from django.utils import six
+from rest_framework.settings import import_from_string
 
 logger = logging.getLogger(__name__)
 
@@ -158,4 +160,13 @@ class NoSpeciesFacade(SpeciesFacade):
     def get_all_species(self, properties=None):
         return []
 
+
+def get_species_facade_class():
+    """
+    :return: the class of the SPECIES_FACADE_CLASS setting or NoSpeciesFacade if not set
+    """
+    if settings.SPECIES_FACADE_CLASS:
+        return import_from_string(settings.SPECIES_FACADE_CLASS, 'SPECIES_FACADE_CLASS')
+    return NoSpeciesFacade
+
 # TODO: implement a cached version of Herbie (memory/disk or db?). Cache renewal policy?
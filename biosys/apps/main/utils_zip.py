@@ -3,25 +3,33 @@ from __future__ import absolute_import, unicode_literals, print_function, divisi
 import logging
 import os
 import shutil
+import sys
 import tempfile
+import zipfile
 
-from django.http import HttpResponse
+from django.http import FileResponse, StreamingHttpResponse
+
+# ZipFile.open(name, mode='w') is only available from python 3.6
+ZIP_OPEN_FOR_WRITE = sys.version_info >= (3, 6)
 
 
 def export_zip(zip_path, name, delete_after=False):
+    """
+    Stream a zip file as an attachment. The file is never read in memory.
+    """
     # Be sure that the name includes the extension .zip
     if not name.lower().endswith('.zip'):
         name += '.zip'
-    response = HttpResponse(content_type='application/zip')
+    zip_ = open(zip_path, 'rb')
+    response = FileResponse(zip_, content_type='application/zip')
     response['Content-Disposition'] = 'attachment; filename="{name}"'.format(name=name)
-    with open(zip_path, 'rb') as zip_:
-        response.write(zip_.read())
-        response["Content-Length"] = response.tell()
+    response['Content-Length'] = os.path.getsize(zip_path)
     if delete_after:
+        # the file is unlinked but its content stays readable until the response closes it.
         try:
             os.remove(zip_path)
-        except Exception as e:
-            logging.exception("Error when trying to delete the file {}".format(zip_path), e)
+        except Exception:
+            logging.exception("Error when trying to delete the file {}".format(zip_path))
     return response
 
 
@@ -37,3 +45,61 @@ def zip_dir(dir_path, zip_out_path, delete_after=True):
 def zip_dir_to_temp_zip(dir_path, delete_after=True):
     fid, out_path = tempfile.mkstemp(suffix='.zip')
     return zip_dir(dir_path, out_path, delete_after=delete_after)
+
+
+class _ZipStreamBuffer(object):
+    """
+    A write only file-like object that keeps what is written until it is consumed.
+    It has no seek() so the zipfile module writes the entries in streaming mode (data descriptors).
+    """
+
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def zip_stream(entries, compression=zipfile.ZIP_DEFLATED):
+    """
+    Generate a zip archive on the fly.
+    :param entries: iterable of (name, chunks) where chunks is an iterable of bytes
+    :return: a generator of bytes
+    """
+    buffer_ = _ZipStreamBuffer()
+    with zipfile.ZipFile(buffer_, mode='w', compression=compression, allowZip64=True) as zip_:
+        for name, chunks in entries:
+            if ZIP_OPEN_FOR_WRITE:
+                # write the entry chunk by chunk
+                with zip_.open(name, mode='w', force_zip64=True) as entry:
+                    for chunk in chunks:
+                        entry.write(chunk)
+                        data = buffer_.pop()
+                        if data:
+                            yield data
+            else:
+                zip_.writestr(name, b''.join(chunks))
+            yield buffer_.pop()
+    yield buffer_.pop()
+
+
+class ZipStreamResponse(StreamingHttpResponse):
+    def __init__(self, entries, name):
+        if not name.lower().endswith('.zip'):
+            name += '.zip'
+        super(ZipStreamResponse, self).__init__(zip_stream(entries), content_type='application/zip')
+        self['Content-Disposition'] = 'attachment; filename="{name}"'.format(name=name)
@@ -17,7 +17,9 @@ define(
                     scrollCollapse: true,
                     processing: true,
                     deferRender: true,
-                    serverSide: false,
+                    // paging, search and ordering are done by the server (see publish JSONDataTableView)
+                    serverSide: true,
+                    searchDelay: 500,
                     autowidth: true,
                     scrollx: true
                 },
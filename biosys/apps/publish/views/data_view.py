@@ -1,11 +1,14 @@
 from __future__ import absolute_import, unicode_literals, print_function, division
 
+import json
+
 from django.contrib.auth.mixins import LoginRequiredMixin
-from django.http.response import JsonResponse
+from django.http.response import StreamingHttpResponse
 from django.shortcuts import get_object_or_404
 from django.views.generic import TemplateView, View
 
 from main.models import Project, Dataset, Record
+from main.utils_misc import search_json_fields, order_by_json_field
 
 
 class DataView(LoginRequiredMixin, TemplateView):
@@ -18,12 +21,70 @@ class DataView(LoginRequiredMixin, TemplateView):
 
 
 class JSONDataTableView(LoginRequiredMixin, View):
+    """
+    Records of a dataset for a DataTables table.
+    The response is a streamed JSON. The records are read from the DB with a server side cursor and never all
+    loaded in memory.
+    If the DataTables server-side processing parameters are sent (draw, start, length, search[value], order[i][column],
+    columns[i][name]) only the requested page is returned. Search and ordering are done in the DB.
+    See https://datatables.net/manual/server-side
+    """
+
     def get(self, request, *args, **kwargs):
         ds = get_object_or_404(Dataset, pk=kwargs.get('pk'))
-        rows = []
-        records = Record.objects.filter(dataset=ds)
-        for record in records:
-            rows.append(record.data_with_id)
-        return JsonResponse({
-            'data': rows
-        })
+        records = Record.objects.filter(dataset=ds).order_by('id')
+        params = request.GET
+        header = {}
+        if 'draw' in params:
+            field_names = [f.get('name') for f in ds.schema_data.get('fields', []) if f.get('name')]
+            header = {
+                'draw': self._get_int(params, 'draw', 0),
+                'recordsTotal': records.count()
+            }
+            search = params.get('search[value]')
+            if search and field_names:
+                records = search_json_fields(records, {'data': field_names}, search)
+            header['recordsFiltered'] = records.count() if search else header['recordsTotal']
+            records = self._order(records, params, field_names)
+            start = max(self._get_int(params, 'start', 0), 0)
+            length = self._get_int(params, 'length', -1)
+            records = records[start:start + length] if length >= 0 else records[start:]
+        rows = records.values_list('id', 'data')
+        return StreamingHttpResponse(self._stream_json(header, rows), content_type='application/json')
+
+    @staticmethod
+    def _get_int(params, name, default):
+        try:
+            return int(params.get(name, default))
+        except (TypeError, ValueError):
+            return default
+
+    def _order(self, records, params, field_names):
+        column_index = params.get('order[0][column]')
+        if column_index is None:
+            return records
+        column_name = params.get('columns[{}][name]'.format(column_index)) or \
+            params.get('columns[{}][data]'.format(column_index))
+        descending = params.get('order[0][dir]') == 'desc'
+        if column_name == 'id':
+            return records.order_by('-id' if descending else 'id')
+        ordering_param = '-' + column_name if descending else column_name
+        ordered = order_by_json_field(records, 'data', field_names, ordering_param)
+        if ordered is records:
+            # not a field of the dataset: by id
+            return records
+        # the id breaks the ties: the pages of equal values are stable
+        return ordered.order_by(*(list(ordered.query.order_by) + ['id']))
+
+    @staticmethod
+    def _stream_json(header, rows):
+        """
+        Yield the JSON {**header, 'data': [{'id':.., **data}, ...]} in chunks.
+        """
+        prefix = json.dumps(header)[:-1]
+        yield prefix + (', ' if header else '') + '"data": ['
+        separator = ''
+        for record_id, data in rows.iterator():
+            yield separator + json.dumps(dict({'id': record_id}, **data))
+            separator = ', '
+        yield ']}'
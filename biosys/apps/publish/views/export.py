@@ -2,23 +2,37 @@ from __future__ import absolute_import, unicode_literals, print_function, divisi
 
 import datetime
 
+from django.http import HttpResponse, HttpResponseBadRequest
 from django.shortcuts import get_object_or_404
 from django.views.generic import View
 
-from main.models import Dataset, Record
-from main.api.exporters import DefaultExporter
+from main.models import Dataset, Record, ExportJob
+from main.api.exporters import DefaultExporter, parquet_available, PARQUET_NOT_AVAILABLE_MESSAGE
+from main.api.export_jobs import find_export_job, export_job_file_response, export_file_response
 from main.utils_http import WorkbookResponse
 
 
 class ExportDataSetView(View):
     def get(self, request, *args, **kwargs):
         ds = get_object_or_404(Dataset, pk=kwargs.get('pk'))
+        # ?output=parquet for a parquet file instead of an Excel workbook
+        output = request.GET.get('output', ExportJob.FORMAT_XLSX)
+        if output not in [ExportJob.FORMAT_XLSX, ExportJob.FORMAT_PARQUET]:
+            return HttpResponseBadRequest("Unsupported output: {}".format(output))
+        if output == ExportJob.FORMAT_PARQUET and not parquet_available():
+            return HttpResponse(PARQUET_NOT_AVAILABLE_MESSAGE, status=501)
+        # serve the file of a previous export if the records haven't changed since.
+        job = find_export_job(ds, output, {})
+        if job is not None and job.is_done:
+            return export_job_file_response(job)
         qs = Record.objects.filter(dataset=ds).order_by('id')
         exporter = DefaultExporter(ds, qs)
-        wb = exporter.to_workbook()
         now = datetime.datetime.now()
-        file_name = ds.name + '_' + now.strftime('%Y-%m-%d-%H%M%S') + '.xlsx'
-        response = WorkbookResponse(wb, file_name)
+        file_name = ds.name + '_' + now.strftime('%Y-%m-%d-%H%M%S')
+        if output == ExportJob.FORMAT_PARQUET:
+            return export_file_response(exporter, output, file_name + '.parquet')
+        wb = exporter.to_workbook()
+        response = WorkbookResponse(wb, file_name + '.xlsx')
         return response
 
 
@@ -69,6 +69,7 @@ PROJECT_APPS = (
 INSTALLED_APPS += PROJECT_APPS
 
 MIDDLEWARE = [
+    'main.middleware.RequestMetricsMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -242,6 +243,70 @@ BOOTSTRAP3 = {
 # in the environment file.
 SPECIES_FACADE_CLASS = env('SPECIES_FACADE_CLASS', None)
 
+# Vector tiles (records and sites geometries).
+# Tiles are cached with the default cache. The cache key includes the dataset/project data version so a change of data
+# invalidates the tiles. The data version itself is cached TILE_VERSION_CACHE_TIMEOUT seconds.
+# The default cache is per process (CACHES is not set): the changes not tracked by the data version (e.g. sites) are
+# counted by a tile generation kept in the database (main.models.TileGeneration), seen by all the processes.
+TILE_CACHE_TIMEOUT = env('TILE_CACHE_TIMEOUT', 60 * 60)
+TILE_VERSION_CACHE_TIMEOUT = env('TILE_VERSION_CACHE_TIMEOUT', 30)
+
+# Records export jobs (see main.api.export_jobs). How the jobs are run:
+# 'thread': in a background thread of the web process.
+# 'worker': by the run_export_jobs management command (e.g. a separate process or a cron job).
+# 'sync': in the request (mainly for tests).
+EXPORT_JOB_RUNNER = env('EXPORT_JOB_RUNNER', 'thread')
+# Number of datasets exported in parallel (one thread and db connection each) in the project data package export.
+PROJECT_EXPORT_WORKERS = env('PROJECT_EXPORT_WORKERS', 4)
+
+# Bulk deletes of records, sites, datasets and projects (see main.api.deletions). They are done at the SQL level,
+# BULK_DELETE_BATCH_SIZE records at a time. A delete of more than BULK_DELETE_JOB_THRESHOLD records runs as a
+# cancellable background job. The jobs and the deletion of the media files are run like the export jobs:
+# 'thread', 'worker' (run_deletion_jobs management command) or 'sync'.
+BULK_DELETE_BATCH_SIZE = env('BULK_DELETE_BATCH_SIZE', 10000)
+BULK_DELETE_JOB_THRESHOLD = env('BULK_DELETE_JOB_THRESHOLD', 100000)
+DELETION_JOB_RUNNER = env('DELETION_JOB_RUNNER', 'thread')
+
+# Species summary (main.models.SpeciesSummary), a table of the records per species behind the species endpoints. The
+# summary of the species whose records changed since the last refresh is recomputed:
+# 'thread': in a background thread of the web process on the next species request (it reads the previous state).
+# 'worker': by the refresh_species_summary management command (e.g. a cron job or --loop).
+# 'sync': in the request (mainly for tests).
+SPECIES_SUMMARY_REFRESH = env('SPECIES_SUMMARY_REFRESH', 'thread')
+
+# Dataset extent (the records bounding box), cached in the dataset. A stale extent (records deleted or moved) is
+# recomputed:
+# 'thread': in a background thread of the web process on the next read (it reads the previous extent).
+# 'worker': by the refresh_extents management command (e.g. a cron job).
+# 'sync': in the request (mainly for tests).
+DATASET_EXTENT_REFRESH = env('DATASET_EXTENT_REFRESH', 'thread')
+
+# Dataset primary key index, used by the records upserts. When a dataset is saved, the index of its primaryKey is
+# built (and the indexes of a previous primaryKey dropped) concurrently:
+# 'thread': in a background thread of the web process, after the commit.
+# 'worker': by the build_primary_key_indexes management command (e.g. a cron job).
+# 'sync': after the commit, in the request.
+PRIMARY_KEY_INDEX_BUILD = env('PRIMARY_KEY_INDEX_BUILD', 'thread')
+
+# Records upload: number of processes validating the rows in parallel and number of rows sent to a process at a time.
+# The processes are only started for uploads of more than UPLOAD_VALIDATION_CHUNK_SIZE rows.
+UPLOAD_VALIDATION_WORKERS = env('UPLOAD_VALIDATION_WORKERS', 1)
+UPLOAD_VALIDATION_CHUNK_SIZE = env('UPLOAD_VALIDATION_CHUNK_SIZE', 1000)
+
+# Dataset update: a schema change is checked against the existing records in the request if the dataset has at most
+# that many records. A bigger dataset must use the schema-impact end-point (with apply).
+DATASET_SCHEMA_CHECK_MAX_RECORDS = env('DATASET_SCHEMA_CHECK_MAX_RECORDS', 10000)
+
+# Per request metrics (see main.middleware.RequestMetricsMiddleware): SQL queries count and time, schema builds,
+# species facade calls and serialization time. They are returned in a Server-Timing header and exposed in the
+# prometheus format at /api/metrics (admin only). Requests slower than REQUEST_METRICS_SLOW_SECONDS or running more
+# than REQUEST_METRICS_SLOW_QUERIES queries are logged with their most repeated queries.
+# The /api/metrics counters are per process: with several gunicorn workers, every worker reports its own counters
+# (a request is served by one of them).
+REQUEST_METRICS = env('REQUEST_METRICS', False)
+REQUEST_METRICS_SLOW_SECONDS = env('REQUEST_METRICS_SLOW_SECONDS', 2.0)
+REQUEST_METRICS_SLOW_QUERIES = env('REQUEST_METRICS_SLOW_QUERIES', 100)
+
 # Logging settings - log to stdout/stderr
 LOGGING = {
     'version': 1,